@@ -1,13 +1,25 @@
 from __future__ import annotations
-import io
 import os
 import sys
+import mmap
+import hashlib
+import numpy as np
 
 codebase_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../.."))
 sys.path.append(codebase_dir)
 
 import scripts.cache_sim.witcher.misc.utils as wt_utils
+from scripts.utils.const_var import PAGE_BYTES
 from scripts.utils.logger import global_logger
+import scripts.utils.logger as log
+
+# the size of each read when comparing an image with the device
+DEV_CHUNK_BYTES = 2 * 1024 * 1024
+# the size of image digests in bytes
+DIGEST_BYTES = 16
+# the device is compared in full every this number of images written over the
+# same base image, to find the pages changed by the file system
+DEV_FULL_COMPARE_INTERVAL = 64
 
 class BinaryFile:
 
@@ -68,64 +80,236 @@ class EmptyBinaryFile:
         pass
 
 
+def coalesce_stores(stores) -> dict:
+    '''
+    Coalesce a list of (base_off, max_off, val), the last store to a range wins.
+    Return a dict of (base_off, size) : val in the order of the last store to each range.
+    '''
+    range_val_map = dict()
+    count = 0
+    for base_off, max_off, val in stores:
+        count += 1
+        assert base_off <= max_off, "invalid write range [%d - %d]" % (base_off, max_off)
+        val = val[:max_off - base_off]
+        key = (base_off, len(val))
+        if key in range_val_map:
+            del range_val_map[key]
+        range_val_map[key] = val
+
+    if log.debug:
+        log_msg = "coalesced %d stores to %d stores" % (count, len(range_val_map))
+        global_logger.debug(log_msg)
+    return range_val_map
+
+
+def dump_diff_to_dev(dev_name, img_size, get_chunk, diff_pages : set = None) -> int:
+    '''
+    Write the image to the device, only the pages that differ from the device
+    content are written. The file system changes the device when mounting it,
+    so compare with the device content instead of the last written image.
+    get_chunk(off, size) returns the image data in [off, off + size).
+    The indices of the written pages are added to diff_pages if it is given.
+    Return the number of written bytes. Required: sudo privilege.
+    '''
+    try:
+        # do not compare with the stale page cache of the device
+        rd_fd = os.open(dev_name, os.O_RDONLY | os.O_DIRECT)
+    except OSError:
+        rd_fd = os.open(dev_name, os.O_RDONLY)
+    wr_fd = os.open(dev_name, os.O_RDWR)
+    # page aligned buffer for direct io
+    dev_buf = mmap.mmap(-1, DEV_CHUNK_BYTES)
+
+    written = 0
+    for chunk_off in range(0, img_size, DEV_CHUNK_BYTES):
+        img_data = get_chunk(chunk_off, min(DEV_CHUNK_BYTES, img_size - chunk_off))
+        try:
+            n = os.preadv(rd_fd, [dev_buf], chunk_off)
+        except OSError:
+            n = 0
+        size = len(img_data)
+        if n >= size and dev_buf[:size] == img_data:
+            continue
+
+        # write the runs of different pages
+        num_pages = (size + PAGE_BYTES - 1) // PAGE_BYTES
+        img_pages = np.zeros(num_pages * PAGE_BYTES, dtype=np.uint8)
+        img_pages[:size] = np.frombuffer(img_data, dtype=np.uint8)
+        dev_pages = np.zeros(num_pages * PAGE_BYTES, dtype=np.uint8)
+        dev_pages[:min(n, size)] = np.frombuffer(dev_buf, dtype=np.uint8, count=min(n, size))
+        diff = (img_pages.reshape(num_pages, PAGE_BYTES) != dev_pages.reshape(num_pages, PAGE_BYTES)).any(axis=1)
+        if n < size:
+            diff[min(n, size) // PAGE_BYTES:] = True
+
+        page_idx = 0
+        while page_idx < num_pages:
+            if not diff[page_idx]:
+                page_idx += 1
+                continue
+            run_end = page_idx
+            while run_end < num_pages and diff[run_end]:
+                run_end += 1
+            begin = page_idx * PAGE_BYTES
+            end = min(run_end * PAGE_BYTES, size)
+            os.pwrite(wr_fd, img_data[begin:end], chunk_off + begin)
+            written += end - begin
+            if diff_pages != None:
+                diff_pages.update(range(chunk_off // PAGE_BYTES + page_idx, chunk_off // PAGE_BYTES + run_end))
+            page_idx = run_end
+
+    dev_buf.close()
+    os.close(wr_fd)
+    os.close(rd_fd)
+
+    if log.debug:
+        log_msg = "wrote %d bytes of the %d bytes image to %s" % (written, img_size, dev_name)
+        global_logger.debug(log_msg)
+    return written
+
+
+def dump_pages_to_dev(dev_name, img_size, get_chunk, page_idx_set) -> int:
+    '''Write the pages of the image in page_idx_set to the device without reading it.'''
+    fd = os.open(dev_name, os.O_RDWR)
+    written = 0
+    page_idx_list = sorted(x for x in page_idx_set if x * PAGE_BYTES < img_size)
+    i = 0
+    while i < len(page_idx_list):
+        # write the runs of contiguous pages
+        run_end = i + 1
+        while run_end < len(page_idx_list) and page_idx_list[run_end] == page_idx_list[run_end - 1] + 1:
+            run_end += 1
+        begin = page_idx_list[i] * PAGE_BYTES
+        end = min((page_idx_list[run_end - 1] + 1) * PAGE_BYTES, img_size)
+        data = get_chunk(begin, end - begin)
+        os.pwrite(fd, data, begin)
+        written += len(data)
+        i = run_end
+    os.close(fd)
+    return written
+
+
+class DevImageState:
+    '''
+    The images written to a device over the same base image: the digest of the
+    base, and the pages written over the base for the last image. Only these
+    pages, the dirty pages of the next image, and the pages the file system
+    changed when validating the images may differ from the next image.
+    The pages the file system changes are found by comparing the device in
+    full, at the 1st, 2nd, 4th, ... image and every DEV_FULL_COMPARE_INTERVAL
+    images, and they are written for the later images.
+    '''
+    __slots__ = ['base_digest', 'img_pages', 'fs_pages', 'num_imgs']
+
+    def __init__(self, base_digest : bytes):
+        self.base_digest = base_digest
+        self.img_pages = set()
+        self.fs_pages = set()
+        self.num_imgs = 0
+
+    def need_full_compare(self) -> bool:
+        return self.num_imgs % DEV_FULL_COMPARE_INTERVAL == 0 or self.num_imgs & (self.num_imgs - 1) == 0
+
+# dev name : DevImageState, a device is written by one thread at a time
+dev_img_state_map = dict()
+
+def dump_tracked_diff_to_dev(dev_name, img_size, get_chunk, base_digest : bytes, dirty_pages) -> int:
+    '''
+    Write an image of the base image (base_digest) and its dirty pages to the
+    device. The device is mostly not read if the images written to it have the
+    same base, see DevImageState. Required: sudo privilege.
+    '''
+    state : DevImageState = dev_img_state_map.get(dev_name)
+    if state == None or state.base_digest != base_digest:
+        state = DevImageState(base_digest)
+        dev_img_state_map[dev_name] = state
+
+    if state.need_full_compare():
+        diff_pages = set()
+        written = dump_diff_to_dev(dev_name, img_size, get_chunk, diff_pages)
+        if state.num_imgs > 0:
+            # the pages neither image wrote are changed by the file system
+            state.fs_pages |= diff_pages - state.img_pages - set(dirty_pages)
+    else:
+        written = dump_pages_to_dev(dev_name, img_size, get_chunk, state.img_pages | state.fs_pages | set(dirty_pages))
+        if log.debug:
+            log_msg = "wrote %d bytes of the %d bytes image to %s" % (written, img_size, dev_name)
+            global_logger.debug(log_msg)
+    state.img_pages = set(dirty_pages)
+    state.num_imgs += 1
+    return written
+
+
 class MemBinaryFile:
 
-    def __init__(self, file_name, map_base : int, pmsize):
+    def __init__(self, file_name, map_base : int, pmsize, buf : bytearray = None):
         self.file_name = file_name
         self.map_base = map_base
         self.pmsize = pmsize  # in bytes
 
-        initial_bytes = b'\x00' * pmsize
-        self.memfd = io.BytesIO(initial_bytes)
+        self.buf = buf if buf != None else bytearray(pmsize)
+        # the digest of buf, reset by writes
+        self._digest = None
 
     def __str__(self):
         return self.file_name
 
+    def __write(self, base_off, val):
+        self._digest = None
+        max_off = base_off + len(val)
+        if max_off > len(self.buf):
+            self.buf.extend(bytes(max_off - len(self.buf)))
+        self.buf[base_off:max_off] = val
+
     # Write using a store op
     def do_store(self, store_op):
         base_off = store_op.get_base_address() - self.map_base
-        max_off = store_op.get_max_address() - self.map_base
-
-        self.memfd.seek(base_off)
-        self.memfd.write(store_op.value_bytes)
-        # only flush before crash
-        # self._file_map.flush(base_off & ~4095, 4096)
-
-        # global_logger.debug(
-        #          "file_name:%s, store_op:%s, base_off:%s, max_off:%s, value:%s",
-        #          self.file_name, store_op.__str__(), hex(base_off), hex(max_off),
-        #          store_op.value_bytes.hex())
+        self.__write(base_off, store_op.value_bytes)
 
     def do_store_direct(self, base_off, max_off, val):
         assert base_off <= max_off, "invalid write range [%d - %d]" % (base_off, max_off)
-        self.memfd.seek(base_off)
-        self.memfd.write(val[:max_off - base_off])
-
-        log_msg = "base_off: %s, size %d, val: %s" % (hex(base_off), max_off-base_off, val[:8])
-        global_logger.debug(log_msg)
-        # only flush before crash
-        # self._file_map.flush(base_off & ~4095, 4096)
+        self.__write(base_off, val[:max_off - base_off])
+
+        if log.debug:
+            log_msg = "base_off: %s, size %d, val: %s" % (hex(base_off), max_off-base_off, bytes(val[:8]))
+            global_logger.debug(log_msg)
+
+    def do_stores_direct(self, stores) -> int:
+        '''
+        Apply a list of (base_off, max_off, val) in order. The stores to the
+        same range are coalesced before copying, the last one wins.
+        Return the number of copied stores.
+        '''
+        range_val_map = coalesce_stores(stores)
+        for (base_off, _), val in range_val_map.items():
+            self.__write(base_off, val)
+        return len(range_val_map)
+
+    def digest(self) -> bytes:
+        if self._digest == None:
+            self._digest = hashlib.blake2b(self.buf, digest_size=DIGEST_BYTES).digest()
+        return self._digest
+
+    def snapshot(self, fname) -> CowBinaryFile:
+        '''A copy-on-write image on top of this one, this image must not be changed while using it.'''
+        return CowBinaryFile(fname, self)
 
     def flush(self):
-        self.memfd.flush()
+        pass
 
     def copy(self, fname) -> MemBinaryFile:
-        dup = MemBinaryFile(fname, self.map_base, self.pmsize)
-        dup.memfd.seek(0)
-        dup.memfd.write(self.memfd.getbuffer())
-        return dup
+        return MemBinaryFile(fname, self.map_base, self.pmsize, bytearray(self.buf))
 
     def dumpToFile(self, fname) -> int:
         # return the size of this file
         # assert self.file_name == fname, "mismatched file name %s and %s" % (self.file_name, fname)
-        # check if the size of memfd is less than the pm size
-        assert self.memfd.getbuffer().nbytes <= self.pmsize, "too larger memfd size %d than %d" \
-            % (self.memfd.getbuffer().nbytes, self.pmsize)
+        # check if the size of the buffer is less than the pm size
+        assert len(self.buf) <= self.pmsize, "too larger buffer size %d than %d" \
+            % (len(self.buf), self.pmsize)
         # write the current data to the specified file
         fd = open(fname, "wb")
         fd.truncate(self.pmsize)
         fd.seek(0)
-        fd.write(self.memfd.getbuffer())
+        fd.write(self.buf)
 
         fd.seek(0, os.SEEK_END)
         file_size = fd.tell()
@@ -135,7 +319,137 @@ class MemBinaryFile:
 
     def dumpToDev(self, dev_name):
         '''Required: sudo privilege'''
+        dev_img_state_map.pop(dev_name, None)
         fd = os.open(dev_name, os.O_RDWR)
         os.lseek(fd, 0, os.SEEK_SET)
-        os.write(fd, self.memfd.getbuffer())
+        os.write(fd, self.buf)
+        os.close(fd)
+
+    def dumpDiffToDev(self, dev_name) -> int:
+        '''Only write the pages that may differ from the device. Required: sudo privilege'''
+        return dump_tracked_diff_to_dev(dev_name, len(self.buf), lambda off, size : self.buf[off:off + size], self.digest(), set())
+
+
+class CowBinaryFile:
+    '''
+    A page-granular copy-on-write image. It shares the pages of the base
+    MemBinaryFile and only keeps private copies of the pages it writes.
+    '''
+
+    def __init__(self, file_name, base : MemBinaryFile, dirty_pages : dict = None):
+        self.file_name = file_name
+        self.base = base
+        self.map_base = base.map_base
+        self.pmsize = base.pmsize
+
+        # page index : bytearray of the page
+        self.dirty_pages = dirty_pages if dirty_pages != None else dict()
+
+    def __str__(self):
+        return self.file_name
+
+    def __get_page(self, page_idx) -> bytearray:
+        page = self.dirty_pages.get(page_idx)
+        if page == None:
+            page_off = page_idx * PAGE_BYTES
+            page = bytearray(self.base.buf[page_off:page_off + PAGE_BYTES])
+            self.dirty_pages[page_idx] = page
+        return page
+
+    def __write(self, base_off, val):
+        val = memoryview(val).cast('B')
+        pos = 0
+        while pos < len(val):
+            page_idx, page_pos = divmod(base_off + pos, PAGE_BYTES)
+            size = min(PAGE_BYTES - page_pos, len(val) - pos)
+            page = self.__get_page(page_idx)
+            if page_pos + size > len(page):
+                page.extend(bytes(page_pos + size - len(page)))
+            page[page_pos:page_pos + size] = val[pos:pos + size]
+            pos += size
+
+    # Write using a store op
+    def do_store(self, store_op):
+        base_off = store_op.get_base_address() - self.map_base
+        self.__write(base_off, store_op.value_bytes)
+
+    def do_store_direct(self, base_off, max_off, val):
+        assert base_off <= max_off, "invalid write range [%d - %d]" % (base_off, max_off)
+        self.__write(base_off, val[:max_off - base_off])
+
+        if log.debug:
+            log_msg = "base_off: %s, size %d, val: %s" % (hex(base_off), max_off-base_off, bytes(val[:8]))
+            global_logger.debug(log_msg)
+
+    def do_stores_direct(self, stores) -> int:
+        range_val_map = coalesce_stores(stores)
+        for (base_off, _), val in range_val_map.items():
+            self.__write(base_off, val)
+        return len(range_val_map)
+
+    def flush(self):
+        pass
+
+    def digest(self) -> bytes:
+        '''
+        The digest of the base image and the dirty pages that differ from it,
+        so that the byte-identical images on the same base have the same digest.
+        '''
+        h = hashlib.blake2b(self.base.digest(), digest_size=DIGEST_BYTES)
+        for page_idx in sorted(self.dirty_pages):
+            page = self.dirty_pages[page_idx]
+            page_off = page_idx * PAGE_BYTES
+            if page == self.base.buf[page_off:page_off + len(page)]:
+                continue
+            h.update(page_idx.to_bytes(8, 'little'))
+            h.update(page)
+        return h.digest()
+
+    def copy(self, fname) -> CowBinaryFile:
+        dirty_pages = {page_idx : bytearray(page) for page_idx, page in self.dirty_pages.items()}
+        return CowBinaryFile(fname, self.base, dirty_pages)
+
+    def __write_pages(self, fd):
+        for page_idx, page in sorted(self.dirty_pages.items()):
+            os.pwrite(fd, page, page_idx * PAGE_BYTES)
+
+    def dumpToFile(self, fname) -> int:
+        file_size = self.base.dumpToFile(fname)
+        fd = os.open(fname, os.O_RDWR)
+        self.__write_pages(fd)
+        file_size = max(file_size, os.lseek(fd, 0, os.SEEK_END))
         os.close(fd)
+        return file_size
+
+    def dumpToDev(self, dev_name):
+        '''Required: sudo privilege'''
+        self.base.dumpToDev(dev_name)
+        dev_img_state_map.pop(dev_name, None)
+        fd = os.open(dev_name, os.O_RDWR)
+        self.__write_pages(fd)
+        os.close(fd)
+
+    def __get_chunk(self, off, size):
+        data = self.base.buf[off:off + size]
+        page_begin = off // PAGE_BYTES
+        page_end = (off + size + PAGE_BYTES - 1) // PAGE_BYTES
+        if len(self.dirty_pages) < page_end - page_begin:
+            page_idx_list = [x for x in self.dirty_pages if page_begin <= x < page_end]
+        else:
+            page_idx_list = [x for x in range(page_begin, page_end) if x in self.dirty_pages]
+        for page_idx in page_idx_list:
+            page = self.dirty_pages[page_idx]
+            page_off = page_idx * PAGE_BYTES - off
+            page = page[:size - page_off]
+            if page_off + len(page) > len(data):
+                data.extend(bytes(page_off + len(page) - len(data)))
+            data[page_off:page_off + len(page)] = page
+        return data
+
+    def dumpDiffToDev(self, dev_name) -> int:
+        '''Only write the pages that may differ from the device. Required: sudo privilege'''
+        img_size = len(self.base.buf)
+        if len(self.dirty_pages) > 0:
+            last_page = max(self.dirty_pages)
+            img_size = max(img_size, last_page * PAGE_BYTES + len(self.dirty_pages[last_page]))
+        return dump_tracked_diff_to_dev(dev_name, img_size, self.__get_chunk, self.base.digest(), self.dirty_pages.keys())
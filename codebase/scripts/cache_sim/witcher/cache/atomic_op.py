@@ -12,6 +12,8 @@ from scripts.cache_sim.witcher.misc.utils import Rangeable
 from scripts.utils.logger import global_logger
 
 class Flush(Rangeable):
+    __slots__ = ('seq', 'addr', 'size')
+
     def __init__(self, seq, addr, size) -> None:
         self.seq = seq
         self.addr = addr
@@ -31,6 +33,8 @@ class Flush(Rangeable):
         return self.addr + self.size
 
 class Fence:
+    __slots__ = ('seq',)
+
     def __init__(self, seq) -> None:
         self.seq = seq
 
@@ -47,16 +51,19 @@ class AtomicStoreState(Enum):
     PERSISTED = 3
 
 class Store(Rangeable):
+    # there are many stores for large data writes, do not keep a dict for each
+    __slots__ = ('seq', 'addr', 'size', 'state', 'flush_list', 'fence_list')
+
     def __init__(self, seq, addr, size) -> None:
         self.seq = seq
         self.addr = addr
         self.size = size
         # the state of this store
         self.state = AtomicStoreState.VOLATILE
-        # a list of flush ops that flush this store
-        self.flush_list = []
-        # a list of fence ops that flush this store
-        self.fence_list = []
+        # a list of flush ops that flush this store, created on the first flush
+        self.flush_list = ()
+        # a list of fence ops that flush this store, created on the first fence
+        self.fence_list = ()
 
     def __str__(self):
         return "Store, seq %d, addr %s, size %d" % \
@@ -74,7 +81,10 @@ class Store(Rangeable):
     def accept_flush(self, flush_op):
         assert isinstance(flush_op, Flush), "invalid flush op type: %s" % (type(flush_op))
 
-        self.flush_list.append(flush_op)
+        if len(self.flush_list) == 0:
+            self.flush_list = [flush_op]
+        else:
+            self.flush_list.append(flush_op)
         if self.is_flushing():
             global_logger.warning("duplicated flush: " + str(self))
         self.state = AtomicStoreState.FLUSHED
@@ -82,7 +92,10 @@ class Store(Rangeable):
     def accept_fence(self, fence_op):
         assert isinstance(fence_op, Fence), "invalid fence op type: %s" % (type(fence_op))
 
-        self.fence_list.append(fence_op)
+        if len(self.fence_list) == 0:
+            self.fence_list = [fence_op]
+        else:
+            self.fence_list.append(fence_op)
         if self.is_clear():
             global_logger.warning("missing flush: " + str(self))
         else:
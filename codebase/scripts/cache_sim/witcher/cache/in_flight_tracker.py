@@ -0,0 +1,217 @@
+import os
+import sys
+
+import numpy as np
+
+codebase_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../.."))
+sys.path.append(codebase_dir)
+
+from scripts.cache_sim.witcher.cache.atomic_op import Store, Flush, Fence, AtomicStoreState
+from scripts.cache_sim.witcher.cache.witcher_cache import WitcherCache
+from scripts.utils.const_var import CACHELINE_BYTES
+from scripts.utils.const_var import ATOMIC_WRITE_BYTES
+
+class InFlightTracker:
+    '''
+    Track the in-flight stores of a cache run in arrays, indexed by the store id
+    (the order in which stores are accepted). It produces the same in-flight
+    clusters, flushing stores and write dependencies as walking the WitcherCache
+    with get_in_fight_ops, get_all_flushing_ops and get_write_dep_seq_map at each
+    fence, but only the stores accepted or flushed since the last fence are
+    visited.
+
+    A store in the cache at a fence is either volatile or flushing, since the
+    flushing stores are persisted and written back by the fence. Thus, the
+    flushing stores at a fence are the stores flushed since the last fence, and
+    the number of fences a store has seen is the number of fences since its
+    epoch. The dependencies between two stores that both were in the cache at
+    the last fence do not change, so only the pairs with a new store are
+    computed.
+    '''
+    def __init__(self, capacity = 1024):
+        capacity = max(capacity, 1)
+        self.seqs = np.zeros(capacity, dtype=np.int64)
+        # the offset in the cacheline
+        self.offsets = np.zeros(capacity, dtype=np.int16)
+        self.sizes = np.zeros(capacity, dtype=np.int16)
+        # the 8-byte slot in the cacheline
+        self.slots = np.zeros(capacity, dtype=np.int8)
+        self.states = np.zeros(capacity, dtype=np.int8)
+        # the number of fences before the store is accepted
+        self.epochs = np.zeros(capacity, dtype=np.int64)
+        # the index of the cacheline in cl_addrs
+        self.cl_idxs = np.zeros(capacity, dtype=np.int64)
+        self.num_stores = 0
+
+        # the cacheline addresses may not fit in an int64, so they are indexed
+        self.cl_addrs = []
+        self.cl_addr_idx_map = dict()
+
+        self.fence_num = 0
+        # cacheline address : the ids of the stores in the cacheline
+        self.cl_ids_map = dict()
+        # the ids of the stores in the cache, in the accepting order
+        self.in_flight_ids = dict()
+        # the ids of the stores flushed since the last fence
+        self.flushing_ids = dict()
+        # the stores whose id is not less than it are new since the last fence
+        self.new_id_start = 0
+        # the cachelines that have new stores since the last fence
+        self.new_cls = set()
+
+    @classmethod
+    def from_op_list(cls, op_list, cache : WitcherCache = None):
+        '''Create a tracker for the ops, with the stores still in the cache.'''
+        capacity = sum(1 for op in op_list if isinstance(op, Store))
+        tracker = cls(capacity)
+        if cache != None:
+            for store_op in cache.get_all_ops():
+                tracker.load_store(store_op)
+        return tracker
+
+    def __grow(self):
+        capacity = len(self.seqs) * 2
+        self.seqs = np.resize(self.seqs, capacity)
+        self.offsets = np.resize(self.offsets, capacity)
+        self.sizes = np.resize(self.sizes, capacity)
+        self.slots = np.resize(self.slots, capacity)
+        self.states = np.resize(self.states, capacity)
+        self.epochs = np.resize(self.epochs, capacity)
+        self.cl_idxs = np.resize(self.cl_idxs, capacity)
+
+    def __add_store(self, store_op : Store, state, epoch):
+        if self.num_stores == len(self.seqs):
+            self.__grow()
+        cl_addr = store_op.addr - store_op.addr % CACHELINE_BYTES
+        offset = store_op.addr - cl_addr
+        assert offset + store_op.size <= CACHELINE_BYTES, (hex(cl_addr), store_op)
+
+        store_id = self.num_stores
+        self.num_stores += 1
+        self.seqs[store_id] = store_op.seq
+        self.offsets[store_id] = offset
+        self.sizes[store_id] = store_op.size
+        self.slots[store_id] = offset // ATOMIC_WRITE_BYTES
+        self.states[store_id] = state.value
+        self.epochs[store_id] = epoch
+        if cl_addr not in self.cl_addr_idx_map:
+            self.cl_addr_idx_map[cl_addr] = len(self.cl_addrs)
+            self.cl_addrs.append(cl_addr)
+        self.cl_idxs[store_id] = self.cl_addr_idx_map[cl_addr]
+
+        if cl_addr not in self.cl_ids_map:
+            self.cl_ids_map[cl_addr] = []
+        self.cl_ids_map[cl_addr].append(store_id)
+        self.in_flight_ids[store_id] = None
+        self.new_cls.add(cl_addr)
+        return store_id
+
+    def load_store(self, store_op : Store):
+        '''Load a store that is already in the cache.'''
+        assert not store_op.is_presisted(), store_op
+        store_id = self.__add_store(store_op, store_op.state, self.fence_num - len(store_op.fence_list))
+        if store_op.is_flushing():
+            self.flushing_ids[store_id] = None
+
+    def accept(self, op):
+        if isinstance(op, Store):
+            self.__add_store(op, AtomicStoreState.VOLATILE, self.fence_num)
+        elif isinstance(op, Flush):
+            self.accept_flush(op)
+        elif isinstance(op, Fence):
+            self.accept_fence(op)
+        else:
+            assert False, "not supported op [%s]" % (type(op))
+
+    def accept_flush(self, flush_op : Flush):
+        cl_addr = flush_op.addr - flush_op.addr % CACHELINE_BYTES
+        offset = flush_op.addr - cl_addr
+        assert offset + flush_op.size <= CACHELINE_BYTES, (hex(cl_addr), flush_op)
+        if cl_addr not in self.cl_ids_map:
+            return
+
+        ids = np.array(self.cl_ids_map[cl_addr], dtype=np.int64)
+        mask = (self.offsets[ids] >= offset) & \
+               (self.offsets[ids] + self.sizes[ids] <= offset + flush_op.size)
+        flushed_ids = ids[mask]
+        self.states[flushed_ids] = AtomicStoreState.FLUSHED.value
+        for store_id in flushed_ids.tolist():
+            self.flushing_ids[store_id] = None
+
+    def accept_fence(self, fence_op : Fence):
+        # the flushing stores are persisted and written back, the volatile stores
+        # stay in the cache
+        self.write_back_all_flushing_stores()
+        self.fence_num += 1
+        self.new_id_start = self.num_stores
+        self.new_cls = set()
+
+    def write_back_all_flushing_stores(self):
+        if len(self.flushing_ids) == 0:
+            return
+        ids = np.fromiter(self.flushing_ids, dtype=np.int64, count=len(self.flushing_ids))
+        for store_id in self.flushing_ids:
+            del self.in_flight_ids[store_id]
+        for cl_idx in np.unique(self.cl_idxs[ids]).tolist():
+            cl_addr = self.cl_addrs[cl_idx]
+            ids = [x for x in self.cl_ids_map[cl_addr] if x not in self.flushing_ids]
+            if len(ids) == 0:
+                del self.cl_ids_map[cl_addr]
+            else:
+                self.cl_ids_map[cl_addr] = ids
+        self.flushing_ids = dict()
+
+    def get_in_flight_nums(self):
+        return len(self.in_flight_ids)
+
+    def get_in_flight_seqs(self) -> list:
+        ids = np.fromiter(self.in_flight_ids, dtype=np.int64, count=len(self.in_flight_ids))
+        return self.seqs[ids].tolist()
+
+    def get_flushing_seqs(self) -> list:
+        ids = np.fromiter(self.flushing_ids, dtype=np.int64, count=len(self.flushing_ids))
+        return self.seqs[ids].tolist()
+
+    def get_new_write_dep_seq_map(self) -> dict:
+        '''
+        Return the write dependencies that involve the stores accepted since the
+        last fence, in the format of get_write_dep_seq_map.
+        A store depends on the stores in the same cacheline that have seen
+        fewer fences, and on the stores in the same 8-byte slot with a smaller seq.
+        '''
+        rst = dict()
+        for cl_addr in self.new_cls:
+            if cl_addr not in self.cl_ids_map:
+                continue
+            ids = np.array(self.cl_ids_map[cl_addr], dtype=np.int64)
+            new_mask = ids >= self.new_id_start
+            seqs = self.seqs[ids]
+            epochs = self.epochs[ids]
+            slots = self.slots[ids]
+
+            # the new stores depend on any store
+            new_seqs = seqs[new_mask]
+            dep = (epochs[new_mask][:, None] < epochs[None, :]) | \
+                  ((slots[new_mask][:, None] == slots[None, :]) & (seqs[None, :] < new_seqs[:, None]))
+            dep &= new_seqs[:, None] != seqs[None, :]
+            self.__add_dep_rows(rst, new_seqs, dep, seqs)
+
+            # the old stores depend on the new stores
+            old_mask = ~new_mask
+            if not old_mask.any():
+                continue
+            old_seqs = seqs[old_mask]
+            dep = (epochs[old_mask][:, None] < epochs[new_mask][None, :]) | \
+                  ((slots[old_mask][:, None] == slots[new_mask][None, :]) & (new_seqs[None, :] < old_seqs[:, None]))
+            dep &= old_seqs[:, None] != new_seqs[None, :]
+            self.__add_dep_rows(rst, old_seqs, dep, new_seqs)
+
+        self.new_cls = set()
+        return rst
+
+    def __add_dep_rows(self, rst : dict, row_seqs, dep, col_seqs):
+        for i in np.flatnonzero(dep.any(axis=1)).tolist():
+            seq = int(row_seqs[i])
+            if seq not in rst:
+                rst[seq] = set()
+            rst[seq].update(col_seqs[dep[i]].tolist())
@@ -0,0 +1,173 @@
+import os
+import sys
+import random
+import logging
+
+codebase_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../.."))
+sys.path.append(codebase_dir)
+
+from scripts.cache_sim.witcher.cache.atomic_op import Store, Flush, Fence
+from scripts.cache_sim.witcher.cache.witcher_cache import WitcherCache
+from scripts.cache_sim.witcher.cache.reorder_simulator import get_write_dep_seq_map
+from scripts.cache_sim.witcher.cache.in_flight_tracker import InFlightTracker
+from scripts.cache_sim.witcher.binary_file.binary_file import EmptyBinaryFile
+from scripts.utils.const_var import CACHELINE_BYTES
+from scripts.utils.const_var import ATOMIC_WRITE_BYTES
+from scripts.utils.logger import global_logger, setup_global_logger
+
+def init_log():
+    setup_global_logger(stm = sys.stderr, stm_lv=logging.INFO)
+
+def get_passed_str():
+    return '\033[92m' + 'passed' + '\033[0m'
+
+def get_failed_str():
+    return '\033[91m' + 'failed' + '\033[0m'
+
+def gen_op_specs(seed, num_ops, num_cls, seq = 1):
+    """
+    Generate (kind, seq, addr, size) of random stores, flushes and fences.
+    Stores may overwrite the same 8-byte slots, and do not cross cachelines.
+    """
+    rnd = random.Random(seed)
+    specs = []
+    for i in range(num_ops):
+        choice = rnd.random()
+        cl_addr = rnd.randrange(num_cls) * CACHELINE_BYTES
+        if choice < 0.6:
+            slot = rnd.randrange(CACHELINE_BYTES // ATOMIC_WRITE_BYTES)
+            size = rnd.choice([1, 4, ATOMIC_WRITE_BYTES, 2 * ATOMIC_WRITE_BYTES])
+            size = min(size, CACHELINE_BYTES - slot * ATOMIC_WRITE_BYTES)
+            specs.append(('store', seq, cl_addr + slot * ATOMIC_WRITE_BYTES, size))
+        elif choice < 0.85:
+            specs.append(('flush', seq, cl_addr, CACHELINE_BYTES))
+        else:
+            specs.append(('fence', seq, 0, 0))
+        seq += 1
+    return specs
+
+def build_ops(specs):
+    # the cache changes the states of stores, each walk has its own ops
+    op_list = []
+    for kind, seq, addr, size in specs:
+        if kind == 'store':
+            op_list.append(Store(seq, addr, size))
+        elif kind == 'flush':
+            op_list.append(Flush(seq, addr, size))
+        else:
+            op_list.append(Fence(seq))
+    return op_list
+
+def build_cache(prefix_specs):
+    """A cache that has run the prefix ops, some stores may still be in it."""
+    cache = WitcherCache(EmptyBinaryFile())
+    for op in build_ops(prefix_specs):
+        cache.accept(op)
+        if isinstance(op, Fence):
+            cache.write_back_all_flushing_stores()
+            cache.write_back_all_persisted_stores()
+    return cache
+
+def add_dep_map(dep_map, tmp_dep_map):
+    for k_seq, v_set in tmp_dep_map.items():
+        if k_seq not in dep_map:
+            dep_map[k_seq] = set()
+        dep_map[k_seq] |= v_set
+
+def walk_cache(prefix_specs, specs):
+    """The walk of the whole cache at each fence, as analysis_in_cache_run did before the tracker."""
+    cache = build_cache(prefix_specs)
+    dep_map = dict()
+    in_flight_nums = []
+    clusters = []
+    flushings = []
+    for op in build_ops(specs):
+        if isinstance(op, Fence):
+            in_flight_nums.append(cache.get_in_fight_nums())
+            add_dep_map(dep_map, get_write_dep_seq_map(cache))
+            clusters.append(sorted(x.seq for x in cache.get_in_fight_ops()))
+            flushings.append(sorted(x.seq for x in cache.get_all_flushing_ops()))
+            cache.accept(op)
+            cache.write_back_all_flushing_stores()
+            cache.write_back_all_persisted_stores()
+        else:
+            cache.accept(op)
+
+    add_dep_map(dep_map, get_write_dep_seq_map(cache))
+    clusters.append(sorted(x.seq for x in cache.get_in_fight_ops()))
+    flushings.append(sorted(x.seq for x in cache.get_all_flushing_ops()))
+    in_flight_nums.append(cache.get_in_fight_nums())
+    cache.write_back_all_flushing_stores()
+    clusters.append(sorted(x.seq for x in cache.get_in_fight_ops()))
+    return dep_map, in_flight_nums, clusters, flushings
+
+def walk_tracker(prefix_specs, specs):
+    """The incremental tracker, as analysis_in_cache_run does."""
+    cache = build_cache(prefix_specs)
+    op_list = build_ops(specs)
+    tracker = InFlightTracker.from_op_list(op_list, cache)
+    dep_map = dict()
+    in_flight_nums = []
+    clusters = []
+    flushings = []
+    for op in op_list:
+        if isinstance(op, Fence):
+            in_flight_nums.append(tracker.get_in_flight_nums())
+            add_dep_map(dep_map, tracker.get_new_write_dep_seq_map())
+            clusters.append(sorted(tracker.get_in_flight_seqs()))
+            flushings.append(sorted(tracker.get_flushing_seqs()))
+        tracker.accept(op)
+
+    add_dep_map(dep_map, tracker.get_new_write_dep_seq_map())
+    clusters.append(sorted(tracker.get_in_flight_seqs()))
+    flushings.append(sorted(tracker.get_flushing_seqs()))
+    in_flight_nums.append(tracker.get_in_flight_nums())
+    tracker.write_back_all_flushing_stores()
+    clusters.append(sorted(tracker.get_in_flight_seqs()))
+    return dep_map, in_flight_nums, clusters, flushings
+
+def check_equivalence(name, prefix_specs, specs):
+    old_rst = walk_cache(prefix_specs, specs)
+    new_rst = walk_tracker(prefix_specs, specs)
+    ok = True
+    for item, old, new in zip(['dep map', 'in-flight nums', 'clusters', 'flushing stores'], old_rst, new_rst):
+        if old != new:
+            global_logger.error(f"{name}: {item} mismatch, cache walk: {old}, tracker: {new}")
+            ok = False
+
+    if ok:
+        global_logger.info("%s: %s" % (name, get_passed_str()))
+    else:
+        global_logger.info("%s: %s" % (name, get_failed_str()))
+    return ok
+
+def test_no_fence():
+    specs = gen_op_specs(0, 50, 2)
+    specs = [x for x in specs if x[0] != 'fence']
+    check_equivalence("test_no_fence", [], specs)
+
+def test_overwrites_in_one_cacheline():
+    specs = gen_op_specs(1, 300, 1)
+    check_equivalence("test_overwrites_in_one_cacheline", [], specs)
+
+def test_random_streams():
+    for seed in range(20):
+        specs = gen_op_specs(seed, 400, 8)
+        check_equivalence(f"test_random_streams_{seed}", [], specs)
+
+def test_stores_left_in_cache():
+    """The tracker loads the stores that are still in the cache, e.g., from the previous op."""
+    for seed in range(5):
+        prefix_specs = gen_op_specs(seed + 100, 200, 4)
+        specs = gen_op_specs(seed + 200, 300, 4, seq = len(prefix_specs) + 1)
+        check_equivalence(f"test_stores_left_in_cache_{seed}", prefix_specs, specs)
+
+def main():
+    init_log()
+    test_no_fence()
+    test_overwrites_in_one_cacheline()
+    test_random_streams()
+    test_stores_left_in_cache()
+
+if __name__ == "__main__":
+    main()
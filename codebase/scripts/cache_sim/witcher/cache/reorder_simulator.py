@@ -2,6 +2,7 @@ import os
 import sys
 import time
 from itertools import combinations
+from math import comb
 
 codebase_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../.."))
 sys.path.append(codebase_dir)
@@ -132,126 +133,105 @@ def get_reorder_num_of_one_cacheline(op_list, allow_none : bool, consider_ow : b
     rcl = ReorderCacheLine(op_list)
     return rcl.get_combinatorial_num(allow_none, consider_ow)
 
+# fubini_nums[n] is the number of ordered set partitions of n elements
+fubini_nums = [1]
+
+def get_fubini_num(n : int) -> int:
+    while len(fubini_nums) <= n:
+        m = len(fubini_nums)
+        fubini_nums.append(sum(comb(m, k) * fubini_nums[m - k] for k in range(1, m + 1)))
+    return fubini_nums[n]
+
+def get_elementary_symmetric_nums(nums : list) -> list:
+    '''
+    rst[k] is the sum of the products of all k-combinations of nums, i.e., the
+    coefficients of prod(1 + num * x).
+    '''
+    rst = [1]
+    for num in nums:
+        rst.append(0)
+        for k in range(len(rst) - 1, 0, -1):
+            rst[k] += rst[k - 1] * num
+    return rst
+
+def get_reorder_nums_of_two_regions(prev_fence_cachelines : dict,
+                                    post_fence_cachelines : dict,
+                                    consider_ow : bool) -> int:
+    '''
+    The number of crash plans of the stores in two adjacent fenced regions.
+    The key of the dicts is the cacheline address, the value is a list of stores.
+    A cacheline that has both prev and post fence stores is a dep cacheline.
+
+    1. select at least one store from post-fence non-dep stores *
+       the combination of pre-fence stores
+    2. select at least one store from each post-fence dep store cacheline *
+       the combination of both prev and post fence non-dep stores.
+    3. the above two cases for each non-empty subset of dep cachelines.
+       A subset S of d dep cachelines is counted once for each chain of subsets
+       from S to all dep cachelines, which is the number of ordered set
+       partitions of the other d - |S| dep cachelines. Summing the products of
+       the subsets by size gives the elementary symmetric polynomials, thus,
+       the number is computed in O(d^2) rather than enumerating subsets.
+    '''
+    # the combination of prev-fence non-dep stores
+    prev_non_dep_num = 1
+    # the combination of post-fence non-dep stores
+    post_non_dep_num = 1
+    # selecting at least one store from one of the post-fence non-dep cachelines
+    # and the combination of the others, i.e., sum_i (a_i - 1) * prod_{j != i} a_j
+    post_non_dep_num_case_1 = 0
+    prev_dep_nums = []
+    post_dep_nums = []
+    for addr in prev_fence_cachelines.keys() | post_fence_cachelines.keys():
+        prev_ops = prev_fence_cachelines.get(addr, [])
+        post_ops = post_fence_cachelines.get(addr, [])
+        if len(prev_ops) > 0 and len(post_ops) > 0:
+            prev_dep_nums.append(get_reorder_num_of_one_cacheline(prev_ops, True, consider_ow))
+            post_dep_nums.append(get_reorder_num_of_one_cacheline(post_ops, False, consider_ow))
+        elif len(prev_ops) > 0:
+            prev_non_dep_num *= get_reorder_num_of_one_cacheline(prev_ops, True, consider_ow)
+        elif len(post_ops) > 0:
+            num = get_reorder_num_of_one_cacheline(post_ops, True, consider_ow)
+            post_non_dep_num_case_1 = post_non_dep_num_case_1 * num + (num - 1) * post_non_dep_num
+            post_non_dep_num *= num
+
+    if len(prev_dep_nums) == 0:
+        return post_non_dep_num_case_1 * prev_non_dep_num
+
+    num_dep_cachelines = len(prev_dep_nums)
+    prev_dep_esym_nums = get_elementary_symmetric_nums(prev_dep_nums)
+    post_dep_esym_nums = get_elementary_symmetric_nums(post_dep_nums)
+    rst = 0
+    for k in range(1, num_dep_cachelines + 1):
+        rst += get_fubini_num(num_dep_cachelines - k) * \
+               (post_non_dep_num_case_1 * prev_dep_esym_nums[k] + \
+                post_non_dep_num * post_dep_esym_nums[k])
+    return rst * prev_non_dep_num
+
+def get_two_regions_key(prev_fence_cachelines : dict,
+                        post_fence_cachelines : dict) -> tuple:
+    '''
+    The number of crash plans of two regions only depends on the number of
+    stores in each 8-byte slot of each cacheline, not on the seqs or the
+    cacheline addresses. Thus, the key is the sorted slots of the prev and post
+    fence stores of each cacheline, and the cachelines are sorted.
+    '''
+    key = []
+    for addr in prev_fence_cachelines.keys() | post_fence_cachelines.keys():
+        prev_slots = tuple(sorted((x.addr % CACHELINE_BYTES)//ATOMIC_WRITE_BYTES for x in prev_fence_cachelines.get(addr, [])))
+        post_slots = tuple(sorted((x.addr % CACHELINE_BYTES)//ATOMIC_WRITE_BYTES for x in post_fence_cachelines.get(addr, [])))
+        key.append((prev_slots, post_slots))
+    key.sort()
+    return tuple(key)
+
 class ReorderSimulator():
     """The simulator for reordering stores."""
     def __init__(self, cache : WitcherCache, consider_ow : bool):
         self.cache = cache
         self.consider_ow = consider_ow
-
-    def __get_reorder_nums_no_dep(self,
-                                  prev_fence_non_dep_cachelines,
-                                  post_fence_non_dep_cachelines):
-        # 1. select at least one store from post-fence non-dep stores *
-        #    the combination of pre-fence stores
-        tmp_list = []
-        for addr, ops in post_fence_non_dep_cachelines.items():
-            tmp_list.append(get_reorder_num_of_one_cacheline(ops, True, self.consider_ow))
-        num_cps_case_1 = 0
-        for i in range(len(tmp_list)):
-            # select at least one store from i, and combination of the rest of stores
-            tmp_num = tmp_list[i] - 1
-            if tmp_num > 0:
-                for j in range(len(tmp_list)):
-                    if i == j:
-                        continue
-                    tmp_num *= tmp_list[j]
-                num_cps_case_1 += tmp_num
-        for addr, ops in prev_fence_non_dep_cachelines.items():
-            if len(ops) > 0:
-                num_cps_case_1 *= get_reorder_num_of_one_cacheline(ops, True, self.consider_ow)
-
-        return num_cps_case_1
-
-    def __get_reorder_nums(self,
-                           prev_fence_dep_cachelines,
-                           prev_fence_non_dep_cachelines,
-                           post_fence_dep_cachelines,
-                           post_fence_non_dep_cachelines,
-                           memo : dict):
-        """
-        memo: the memorized number of crash plans of a sub case cachelines.
-              E.g., two dep cachelines with all non-dep cachelines.
-              Since sub-cases should contains all non-dep cachelines,
-              we can use the info of prev and post fence dep cachelines as  the key.
-              The key is is a tuple of the cacheline addresses, i.e.,
-              {cacheline_1_addr, cacheline_2_addr, ..., cacheline_n_addr}
-        """
-        assert len(prev_fence_dep_cachelines) == len(post_fence_dep_cachelines), \
-            "mismatched prev and post dep cachelines, %d, %d" \
-                % (len(prev_fence_dep_cachelines), len(post_fence_dep_cachelines))
-
-        global_logger.debug("prev_fence_dep_cachelines: %s" % (prev_fence_dep_cachelines))
-        global_logger.debug("post_fence_dep_cachelines: %s" % (post_fence_dep_cachelines))
-        global_logger.debug("prev_fence_non_dep_cachelines: %s" % (prev_fence_non_dep_cachelines))
-        global_logger.debug("post_fence_non_dep_cachelines: %s" % (post_fence_non_dep_cachelines))
-        global_logger.debug("memo: %s" % (str(memo)))
-
-        # 1. select at least one store from post-fence non-dep stores *
-        #    the combination of pre-fence stores
-        tmp_list = []
-        for addr, ops in post_fence_non_dep_cachelines.items():
-            tmp_list.append(get_reorder_num_of_one_cacheline(ops, True, self.consider_ow))
-        num_cps_case_1 = 0
-        for i in range(len(tmp_list)):
-            # select at least one store from i, and combination of the rest of stores
-            tmp_num = tmp_list[i] - 1
-            if tmp_num > 0:
-                for j in range(len(tmp_list)):
-                    if i == j:
-                        continue
-                    tmp_num *= tmp_list[j]
-                num_cps_case_1 += tmp_num
-        for addr, ops in prev_fence_dep_cachelines.items():
-            if len(ops) > 0:
-                num_cps_case_1 *= get_reorder_num_of_one_cacheline(ops, True, self.consider_ow)
-        for addr, ops in prev_fence_non_dep_cachelines.items():
-            if len(ops) > 0:
-                num_cps_case_1 *= get_reorder_num_of_one_cacheline(ops, True, self.consider_ow)
-
-        # 2. select at least one store from each post-fence dep store cacheline *
-        #    the combination of both prev and post fence non-dep stores.
-        num_cps_case_2 = 1
-        for addr, ops in post_fence_dep_cachelines.items():
-            if len(ops) > 0:
-                num_cps_case_2 *= get_reorder_num_of_one_cacheline(ops, False, self.consider_ow)
-        for addr, ops in prev_fence_non_dep_cachelines.items():
-            if len(ops) > 0:
-                num_cps_case_2 *= get_reorder_num_of_one_cacheline(ops, True, self.consider_ow)
-        for addr, ops in post_fence_non_dep_cachelines.items():
-            if len(ops) > 0:
-                num_cps_case_2 *= get_reorder_num_of_one_cacheline(ops, True, self.consider_ow)
-
-        # 3. calculate the number of crash plans of selecting i (i >= 1) dep cachelines and
-        #    all non-dep stores
-        num_cps_case_3 = 0
-        dep_cacheline_addr_list = [x for x in post_fence_dep_cachelines.keys()]
-        for i in range(1, len(post_fence_dep_cachelines)):
-            combo_list = list(combinations(dep_cacheline_addr_list, i))
-            for combo in combo_list:
-                if combo not in memo:
-                    new_prev_fence_dep_cachelines = {key: prev_fence_dep_cachelines[key] for key in combo}
-                    new_post_fence_dep_cachelines = {key: post_fence_dep_cachelines[key] for key in combo}
-                    memo[combo] = self.__get_reorder_nums(new_prev_fence_dep_cachelines,
-                                                          prev_fence_non_dep_cachelines,
-                                                          new_post_fence_dep_cachelines,
-                                                          post_fence_non_dep_cachelines,
-                                                          memo)
-                num_cps_case_3 += memo[combo]
-        global_logger.debug("case 1: %d, case 2: %d, case 3: %d" % (num_cps_case_1, num_cps_case_2, num_cps_case_3))
-
-        # 4. calculate the total number
-        total_number_crash_plans = num_cps_case_1 + num_cps_case_2 + num_cps_case_3
-        # for combo, num in memo.items():
-        #     # 4.1 select at least one store from the dep cachelines that are not in combo *
-        #     #     the number of crash plans of the combo
-        #     num_cps_case_4_1 = num
-        #     rest_dep_cacheline_addr_list = [x for x in dep_cacheline_addr_list if x not in combo]
-        #     for addr in rest_dep_cacheline_addr_list:
-        #         op_list = post_fence_dep_cachelines[addr]
-        #         num_cps_case_4_1 *= get_reorder_num_of_one_cacheline(op_list, False, True)
-        #     total_number_crash_plans += num_cps_case_4_1
-
-        return total_number_crash_plans
+        # the numbers of crash plans of two regions, kept across fences since
+        # the same store patterns repeat, see get_two_regions_key
+        self.two_regions_memo = dict()
 
     # @timeit
     # do not timing it since the elapsed time is ~32 macroseconds, which is less than the time to send msg to the server (~140 macroseconds).
@@ -271,101 +251,67 @@ class ReorderSimulator():
         This function only process the last two fenced regions, it does not
         consider any stores before the second to last fence.
         '''
-        num_cachelines = len(self.cache.cacheline_dict)
-
         # cachelines are stored in a dict,
         # the key is the cacheline address, the value is a list of ops.
         prev_fence_cachelines = dict()
         post_fence_cachelines = dict()
-        prev_fence_dep_cachelines = dict()
-        prev_fence_non_dep_cachelines = dict()
-        post_fence_dep_cachelines = dict()
-        post_fence_non_dep_cachelines = dict()
+        num_in_flight_stores = 0
         for cacheline in self.cache.get_cachelines():
             cacheline : WitcherCacheline
             addr = cacheline.address
-            prev_fence_cachelines[addr] = []
-            post_fence_cachelines[addr] = []
             for store in cacheline.stores_list:
                 store : Store
+                if not store.is_presisted():
+                    num_in_flight_stores += 1
                 if len(store.fence_list) == 1:
                     # fenced by the lastest fence
+                    if addr not in prev_fence_cachelines:
+                        prev_fence_cachelines[addr] = []
                     prev_fence_cachelines[addr].append(store)
                 elif len(store.fence_list) == 0:
                     # the store occurs after the lastest fence
+                    if addr not in post_fence_cachelines:
+                        post_fence_cachelines[addr] = []
                     post_fence_cachelines[addr].append(store)
                 else:
                     # the store occurs far before the lastest fence
                     # we do not need to consider them, since they cannot be reordered.
                     pass
 
-        global_logger.debug("prev_fence_cachelines: %s" % (prev_fence_cachelines))
-        global_logger.debug("post_fence_cachelines: %s" % (post_fence_cachelines))
+        rst = get_reorder_nums_of_two_regions(prev_fence_cachelines,
+                                              post_fence_cachelines,
+                                              self.consider_ow)
 
-        for cacheline in self.cache.get_cachelines():
-            cacheline : WitcherCacheline
-            addr = cacheline.address
-            if len(prev_fence_cachelines[addr]) == 0:
-                # no prev fence stores for this post fence stores
-                post_fence_non_dep_cachelines[addr] = post_fence_cachelines[addr]
-            else:
-                if len(post_fence_cachelines[addr]) == 0:
-                    # no post fence stores for this prev fence stores
-                    prev_fence_non_dep_cachelines[addr] = prev_fence_cachelines[addr]
-                else:
-                    prev_fence_dep_cachelines[addr] = prev_fence_cachelines[addr]
-                    post_fence_dep_cachelines[addr] = post_fence_cachelines[addr]
-            if len(post_fence_cachelines[addr]) == 0:
-                # no post fence stores for this prev fence stores
-                prev_fence_non_dep_cachelines[addr] = prev_fence_cachelines[addr]
-            else:
-                if len(prev_fence_cachelines[addr]) == 0:
-                    # no prev fence stores for this post fence stores
-                    post_fence_non_dep_cachelines[addr] = post_fence_cachelines[addr]
-                else:
-                    prev_fence_dep_cachelines[addr] = prev_fence_cachelines[addr]
-                    post_fence_dep_cachelines[addr] = post_fence_cachelines[addr]
-
-        global_logger.debug("prev_fence_dep_cachelines: %s" % (prev_fence_dep_cachelines))
-        global_logger.debug("post_fence_dep_cachelines: %s" % (post_fence_dep_cachelines))
-        global_logger.debug("prev_fence_non_dep_cachelines: %s" % (prev_fence_non_dep_cachelines))
-        global_logger.debug("post_fence_non_dep_cachelines: %s" % (post_fence_non_dep_cachelines))
-
-        rst = -1
-        if len(prev_fence_dep_cachelines) == 0:
-            rst = self.__get_reorder_nums_no_dep(prev_fence_non_dep_cachelines,
-                                                 post_fence_non_dep_cachelines)
-        else:
-            memo = dict()
-            rst = self.__get_reorder_nums(prev_fence_dep_cachelines,
-                                        prev_fence_non_dep_cachelines,
-                                        post_fence_dep_cachelines,
-                                        post_fence_non_dep_cachelines,
-                                        memo)
-            global_logger.debug(str(memo))
-
-        s1 = sum([len(x) for x in prev_fence_dep_cachelines.values()])
-        s2 = sum([len(x) for x in post_fence_dep_cachelines.values()])
-        s3 = sum([len(x) for x in prev_fence_non_dep_cachelines.values()])
-        s4 = sum([len(x) for x in post_fence_non_dep_cachelines.values()])
-        s1 = 99999999999999999999 if s1 > 99999999999999999999 else s1
-        s2 = 99999999999999999999 if s2 > 99999999999999999999 else s2
-        s3 = 99999999999999999999 if s3 > 99999999999999999999 else s3
-        s4 = 99999999999999999999 if s4 > 99999999999999999999 else s4
-        rst = 99999999999999999999 if rst > 99999999999999999999 else rst
-        global_logger.debug("number of crash plans: %d, %d, %d, %d, %d" % \
-                            (s1, s2, s3, s4, rst))
-
-        num_in_flight_stores = self.cache.get_in_fight_nums()
         num_computed_in_flight_stores = sum([len(x) for x in prev_fence_cachelines.values()]) \
                                       + sum([len(x) for x in post_fence_cachelines.values()])
+        if log.debug:
+            global_logger.debug("prev_fence_cachelines: %s" % (prev_fence_cachelines))
+            global_logger.debug("post_fence_cachelines: %s" % (post_fence_cachelines))
+            global_logger.debug("number of crash plans: %d" % (rst))
 
         return rst, num_in_flight_stores, num_computed_in_flight_stores
 
     def __get_reorder_nums_v2(self,
                               fence_cachelines : dict,
+                              fence_nums : dict,
                               memo : dict):
-        pass
+        rst = 0
+        prev_fence_seq = None
+        for fence_seq, cachelines in sorted(fence_cachelines.items()):
+            # the stores of the previous region can be reordered with these stores
+            # only if they are separated by one fence
+            prev_fence_cachelines = dict()
+            if prev_fence_seq != None and fence_nums[prev_fence_seq] == fence_nums[fence_seq] + 1:
+                prev_fence_cachelines = fence_cachelines[prev_fence_seq]
+
+            key = get_two_regions_key(prev_fence_cachelines, cachelines)
+            if key not in memo:
+                memo[key] = get_reorder_nums_of_two_regions(prev_fence_cachelines,
+                                                            cachelines,
+                                                            self.consider_ow)
+            rst += memo[key]
+            prev_fence_seq = fence_seq
+        return rst
 
     @timeit
     def get_reorder_nums_v2(self):
@@ -388,6 +334,8 @@ class ReorderSimulator():
         # the 1st key is the fence seq, the value is a dict,
         # the 2nd key is the cacheline address, the value is a list of ops.
         fence_cachelines = dict()
+        # fence seq : the number of fences the stores of the region have seen
+        fence_nums = dict()
         max_fence_seq = sys.maxsize
         for cacheline in self.cache.get_cachelines():
             cacheline : WitcherCacheline
@@ -399,11 +347,13 @@ class ReorderSimulator():
                     fence_seq = store.fence_list[0].seq
                 if fence_seq not in fence_cachelines:
                     fence_cachelines[fence_seq] = dict()
+                    fence_nums[fence_seq] = len(store.fence_list)
                 if cl_addr not in fence_cachelines[fence_seq]:
                     fence_cachelines[fence_seq][cl_addr] = []
                 fence_cachelines[fence_seq][cl_addr].append(store)
 
-        # the key of the memo is tuple('fence:seq', cl_addr1, cl_addr2, ...)
+        # the key of the memo is the slots of the stores of two fenced regions,
+        # see get_two_regions_key.
         # the value is the number of crash plans of two fenced regions before the fence seq.
         # E.g.,
         # cl1  s1, fence1, s3, fence2, s5, fence3
@@ -411,9 +361,9 @@ class ReorderSimulator():
         # The investigated stores are s1 and s2 if the fence seq is fence1
         # The investigated stores are s1, s2, s3 and s4 if the fence seq is fence2
         # The investigated stores are s3, s4, s5 and s6 if the fence seq is fence3
-        memo = dict()
-        rst = self.__get_reorder_nums_v2(fence_cachelines, memo)
-        global_logger.debug(str(memo))
+        rst = self.__get_reorder_nums_v2(fence_cachelines, fence_nums, self.two_regions_memo)
+        if log.debug:
+            global_logger.debug(str(self.two_regions_memo))
         return rst
 
 class CacheLineReorderSimulator():
@@ -69,6 +69,22 @@ def gen_num_crash_plans(op_list):
 
     return num_cps
 
+def gen_num_crash_plans_v2(op_list):
+    op_list.sort(key = lambda x: x.seq)
+    cache = WitcherCache(EmptyBinaryFile())
+    simulator = ReorderSimulator(cache, consider_ow = True)
+
+    num_cps = -1
+    for op in op_list:
+        if isinstance(op, Fence):
+            num_cps = simulator.get_reorder_nums_v2()
+            global_logger.info("number of crash plans: %d" % (num_cps))
+        cache.accept(op)
+
+    global_logger.info("finally: number of crash plans: %d" % (num_cps))
+
+    return num_cps
+
 """
 The naming rule of the test function:
 test_num1_num2_num3_case_num4
@@ -423,6 +439,32 @@ def test_2_1_1_case_1():
     else:
         global_logger.info("test_2_1_1_case_1: %s" % (get_failed_str()))
 
+def test_v2_1_0_0_case_1():
+    """
+    Cacheline 1: 1 store, fence, 1 store, fence, 1 store
+    the number of crash plans:
+    = (2^1 - 1) + (2^1 - 1) + (2^1 - 1)
+    = 3
+    """
+    op_list = []
+    cl1_addr = 0
+
+    for i in range(3):
+        seq = i * 20000 + 1
+        num_non_ows = 1
+        num_ows = dict()
+        op_list += gen_stores(cl1_addr, seq, num_non_ows, num_ows)
+
+        fence_seq = i * 20000 + 10000
+        fence = Fence(fence_seq)
+        op_list.append(fence)
+
+    num_cps = gen_num_crash_plans_v2(op_list)
+    if num_cps == 3:
+        global_logger.info("test_v2_1_0_0_case_1: %s" % (get_passed_str()))
+    else:
+        global_logger.info("test_v2_1_0_0_case_1: %s" % (get_failed_str()))
+
 
 if __name__ == "__main__":
     init_log()
@@ -439,3 +481,5 @@ if __name__ == "__main__":
     test_1_1_1_case_1()
 
     test_2_1_1_case_1()
+
+    test_v2_1_0_0_case_1()
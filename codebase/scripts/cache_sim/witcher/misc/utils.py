@@ -40,6 +40,8 @@ class Rangeable:
     All rangeable objects must be able to return their base and max
     addresses.
     """
+    __slots__ = ()
+
     def get_base_address(self):
         """
         Getter for the base address of the object.
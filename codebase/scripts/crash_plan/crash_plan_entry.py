@@ -17,12 +17,54 @@ def timeit(func):
         return result
     return wrapper
 
+class CrashPlanSeqTable:
+    '''
+    The seqs of the crash plans of an operation, each seq has an index, so that
+    the persisted seqs of a crash plan are a bitmask (an int) over the indices.
+    The table only grows, thus the bitmasks are valid after adding new seqs.
+    '''
+    def __init__(self):
+        self.seq_list : list = []
+        # seq : index in seq_list
+        self.seq_idx_map : dict = dict()
+
+    def __len__(self):
+        return len(self.seq_list)
+
+    def get_idx(self, seq : int) -> int:
+        idx = self.seq_idx_map.get(seq)
+        if idx == None:
+            idx = len(self.seq_list)
+            self.seq_idx_map[seq] = idx
+            self.seq_list.append(seq)
+        return idx
+
+    def encode(self, seqs) -> int:
+        if not seqs:
+            return 0
+        idx_list = [self.get_idx(seq) for seq in seqs]
+        bits = bytearray((max(idx_list) >> 3) + 1)
+        for idx in idx_list:
+            bits[idx >> 3] |= 1 << (idx & 7)
+        return int.from_bytes(bits, 'little')
+
+    def decode(self, mask : int) -> set:
+        # the i-th char of the reversed binary string is the bit of index i
+        return set(self.seq_list[i] for i, bit in enumerate(reversed(bin(mask)[2:])) if bit == '1')
+
+    def contains(self, mask : int, seq : int) -> bool:
+        idx = self.seq_idx_map.get(seq)
+        return idx != None and (mask >> idx) & 1 == 1
+
 class CrashPlanEntry:
     '''
     Used to represent a crash plan and how to construct a crash image.
     Should be used with save_value trace.
-    We use a list to store sequences, since the number of seq is small ( < 100)
+    The persisted seqs are a bitmask over the seq_table, which is shared by the
+    crash plans of an operation (e.g., CrashPlanSchemeBase.seq_table).
     '''
+    __slots__ = ['type', 'instruction_id', 'start_seq', 'seq_table', 'persist_mask', 'exp_data_seqs', 'info', 'sampling_type', 'sampling_seq', 'sampling_addr', 'num_cp_entries']
+
     def __init__(self,
                  ty : CrashPlanType,
                  instruction_id,
@@ -30,15 +72,17 @@ class CrashPlanEntry:
                  persist_seqs : set,
                  exp_data_seqs : set,
                  info : str,
-                 sampling_type : CrashPlanSamplingType = CrashPlanSamplingType.SamplingNone) -> None:
+                 sampling_type : CrashPlanSamplingType = CrashPlanSamplingType.SamplingNone,
+                 seq_table : CrashPlanSeqTable = None) -> None:
         self.type = ty
         # the instruction id of the investigated trace
         self.instruction_id : int = instruction_id
         # operations before this sequence should be all persisted
         # start sequence is not included to persist
         self.start_seq : int = start_seq
-        # a set of sequence need to persist
-        self.persist_seqs : set = persist_seqs
+        # the bitmask of the seqs need to persist, over the seq_table
+        self.seq_table : CrashPlanSeqTable = seq_table if seq_table != None else CrashPlanSeqTable()
+        self.persist_mask : int = self.seq_table.encode(persist_seqs)
         # a set of sequence that need to check the data after recovery
         # if the recovered state matches the pre-consistent state, expect old data
         # if the recovered state matches the post-consistent state, expect new data
@@ -54,6 +98,80 @@ class CrashPlanEntry:
         # If the number is larger than 1, it just represents the number of phoney CPs, and this instance cannot be used to generate crash image.
         self.num_cp_entries = 1
 
+    @property
+    def persist_seqs(self) -> set:
+        '''A set of sequence need to persist, decoded from the bitmask.'''
+        return self.seq_table.decode(self.persist_mask)
+
+    @persist_seqs.setter
+    def persist_seqs(self, seqs : set):
+        self.persist_mask = self.seq_table.encode(seqs)
+
+    def get_masked_state(self, seq_table : CrashPlanSeqTable) -> tuple:
+        '''
+        The slots except the seq_table, with the persisted seqs as the bitmask over
+        seq_table, which is pickled once by the owner (e.g., CrashPlanSchemeBase).
+        '''
+        mask = self.persist_mask if self.seq_table is seq_table else seq_table.encode(self.persist_seqs)
+        return tuple(mask if name == 'persist_mask' else getattr(self, name) for name in MASKED_STATE_SLOTS)
+
+    @classmethod
+    def from_masked_state(cls, state : tuple, seq_table : CrashPlanSeqTable):
+        cp = cls.__new__(cls)
+        for name, value in zip(MASKED_STATE_SLOTS, state):
+            setattr(cp, name, value)
+        cp.seq_table = seq_table
+        return cp
+
+    def __getstate__(self) -> dict:
+        '''
+        A crash plan pickled alone does not carry the shared seq_table, the persisted
+        seqs are pickled as a set, as the crash plans before the bitmask did.
+        The crash plans of a scheme are pickled by get_masked_state instead.
+        '''
+        state = {name : getattr(self, name) for name in self.__slots__ if name not in ('seq_table', 'persist_mask')}
+        state['persist_seqs'] = self.persist_seqs
+        return state
+
+    def __setstate__(self, state):
+        '''
+        Accept the state of __getstate__ and the __dict__ of the crash plans pickled
+        before __slots__. The crash plan gets its own seq_table, use attach_seq_table
+        to move it to the shared one.
+        '''
+        # pickle passes (None, slots) for a slotted object without __getstate__
+        if isinstance(state, tuple):
+            state = state[1]
+        state = dict(state)
+        self.sampling_type = CrashPlanSamplingType.SamplingNone
+        self.sampling_seq = None
+        self.sampling_addr = None
+        self.num_cp_entries = 1
+        persist_seqs = state.pop('persist_seqs', None)
+        persist_mask = state.pop('persist_mask', None)
+        seq_table = state.pop('seq_table', None)
+        for name, value in state.items():
+            if name in self.__slots__:
+                setattr(self, name, value)
+        self.seq_table = seq_table if seq_table != None else CrashPlanSeqTable()
+        if persist_seqs != None:
+            self.persist_mask = self.seq_table.encode(persist_seqs)
+        else:
+            self.persist_mask = persist_mask if persist_mask != None else 0
+
+    def attach_seq_table(self, seq_table : CrashPlanSeqTable):
+        '''Re-encode the persisted seqs over seq_table, e.g., the shared one after unpickling.'''
+        if self.seq_table is not seq_table:
+            persist_seqs = self.persist_seqs
+            self.seq_table = seq_table
+            self.persist_mask = seq_table.encode(persist_seqs)
+
+    def is_persisted(self, seq : int) -> bool:
+        return self.seq_table.contains(self.persist_mask, seq)
+
+    def get_num_persist_seqs(self) -> int:
+        return self.persist_mask.bit_count()
+
     def __str__(self) -> str:
         data = ""
         data += "type: %s\n" % (str(self.type))
@@ -72,17 +190,24 @@ class CrashPlanEntry:
         return self.__str__()
 
     def __member(self) -> tuple:
+        exp_data_seqs = frozenset(self.exp_data_seqs) if self.exp_data_seqs else frozenset()
         if not self.sampling_addr and not self.sampling_seq:
-            return (self.start_seq, self.persist_seqs, self.exp_data_seqs)
-            # return (self.instruction_id, self.start_seq, self.persist_seqs, self.exp_data_seqs)
+            return (self.start_seq, exp_data_seqs)
         else:
-            return (self.start_seq, self.persist_seqs, self.exp_data_seqs, self.sampling_seq, self.sampling_addr)
-            # return (self.instruction_id, self.start_seq, self.persist_seqs, self.exp_data_seqs, self.sampling_seq, self.sampling_addr)
+            return (self.start_seq, exp_data_seqs, self.sampling_seq, self.sampling_addr)
 
     def __eq__(self, other) -> bool:
         if not isinstance(other, CrashPlanEntry):
             return False
-        return self.__member() == other.__member()
+        if self.__member() != other.__member():
+            return False
+        if self.seq_table is other.seq_table:
+            return self.persist_mask == other.persist_mask
+        return self.persist_seqs == other.persist_seqs
 
     def __hash__(self) -> int:
-        return hash(self.__member())
+        # equal crash plans may have different seq tables, thus hash the seqs rather than the mask
+        return hash((self.__member(), frozenset(self.persist_seqs)))
+
+# the slots pickled by CrashPlanEntry.get_masked_state
+MASKED_STATE_SLOTS = tuple(name for name in CrashPlanEntry.__slots__ if name != 'seq_table')
@@ -55,8 +55,8 @@ class CrashPlanPMData:
                                           str(entry.stinfo_match),
                                           str(entry.var_list)[:16],
                                           str(entry.src_entry),
-                                          entry.ov_entry.data[:8],
-                                          entry.sv_entry.data[:8])
+                                          bytes(entry.ov_entry.data[:8]),
+                                          bytes(entry.sv_entry.data[:8]))
             global_logger.debug(log_msg)
 
             self.seq_to_ov_entry[seq] = [entry.addr, entry.ov_entry]
@@ -68,6 +68,6 @@ class CrashPlanPMData:
     def dbg_detail_str(self, limit_hex_length = 8) -> str:
         data = ''
         for seq, lst in self.seq_to_sv_entry.items():
-            data += "seq: %d, %s, %d, %s\n" % (seq, hex(lst[0]), lst[1].size, lst[1].data[:limit_hex_length])
+            data += "seq: %d, %s, %d, %s\n" % (seq, hex(lst[0]), lst[1].size, bytes(lst[1].data[:limit_hex_length]))
         return data
 
@@ -36,8 +36,7 @@ def timeit(func):
 
 class CrashPlanScheme2CP(CrashPlanSchemeBase):
     def __init__(self, op_entry : OpTraceEntry, mech_deduce : DeduceMech):
-        # a list of generated crash plans
-        self.cp_entry_list = []
+        super().__init__()
 
         self.op_entry = op_entry
         self.mech_deduce = mech_deduce
@@ -78,7 +77,7 @@ class CrashPlanScheme2CP(CrashPlanSchemeBase):
         # 1.4 create the cp entry
         dbg_msg = "persist itself: %d, and dep: %s, but no other seq." % (seq, str(seq_set))
         log.global_logger.debug(dbg_msg)
-        cp = CrashPlanEntry(CrashPlanType.UnprotectedPersistSelf, pmstore_entry.op.instid, min(seq_set), seq_set, {seq}, pmstore_entry.op.to_result_str())
+        cp = CrashPlanEntry(CrashPlanType.UnprotectedPersistSelf, pmstore_entry.op.instid, min(seq_set), seq_set, {seq}, pmstore_entry.op.to_result_str(), seq_table=self.seq_table)
 
         # 1.5 sampling the this store
         start_addr = pmstore_entry.op.addr
@@ -154,7 +153,7 @@ class CrashPlanScheme2CP(CrashPlanSchemeBase):
         dbg_msg = "persist all other seq: %s but not itself: %d" % (str(seq_set), seq)
         log.global_logger.debug(dbg_msg)
         min_seq = seq if len(seq_set) == 0 else min(seq, min(seq_set))
-        cp = CrashPlanEntry(CrashPlanType.UnprotectedPersistOther, pmstore_entry.op.instid, min_seq, seq_set, {seq}, pmstore_entry.op.to_result_str())
+        cp = CrashPlanEntry(CrashPlanType.UnprotectedPersistOther, pmstore_entry.op.instid, min_seq, seq_set, {seq}, pmstore_entry.op.to_result_str(), seq_table=self.seq_table)
 
         # 2.5 sampling the this store
         start_addr = pmstore_entry.op.addr
@@ -1,12 +1,14 @@
 import os
 import sys
 import time
-import pickle
+import random
+import itertools
 
 base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
 sys.path.append(base_dir)
 
-from scripts.crash_plan.crash_plan_entry import CrashPlanEntry
+from scripts.crash_plan.crash_plan_entry import CrashPlanEntry, CrashPlanSeqTable
+from scripts.crash_plan.crash_plan_store import CrashPlanStoreWriter
 from scripts.crash_plan.crash_plan_type import CrashPlanType, CrashPlanSamplingType
 import scripts.vm_comm.memcached_wrapper as mc_wrapper
 import scripts.utils.logger as log
@@ -20,33 +22,136 @@ def timeit(func):
         return result
     return wrapper
 
+def iter_combinations(items : list, max_num_combs : int, seed = None):
+    '''
+    Yield the combinations of items, from the shortest to the longest.
+    If max_num_combs is positive and less than the number of combinations,
+    yield max_num_combs distinct combinations sampled uniformly by the seed instead.
+    '''
+    num_items = len(items)
+    if max_num_combs <= 0 or 2 ** num_items <= max_num_combs:
+        for combination_length in range(0, num_items + 1):
+            yield from itertools.combinations(items, combination_length)
+        return
+
+    # each item is selected or not by a bit of the mask
+    rng = random.Random(seed)
+    visited_masks = set()
+    while len(visited_masks) < max_num_combs:
+        mask = rng.getrandbits(num_items)
+        if mask in visited_masks:
+            continue
+        visited_masks.add(mask)
+        yield tuple(items[i] for i in range(num_items) if (mask >> i) & 1)
+
+class LazyCrashPlans():
+    '''
+    A group of crash plans that are generated when they are iterated, since the
+    number of them is exponential in the number of stores (e.g., combinations).
+    gen_func(max_num_combs, seed) returns an iterator of the crash plans of
+    max_num_combs combinations, which are sampled by the seed if there are
+    more. The seed is derived from the group (e.g., the op and the group index)
+    by the caller, so that iterating again, or testing the case again, yields
+    the same crash plans.
+    The counts are computed from num_combs and num_cps_per_comb_map ({type :
+    the number of crash plans of a combination}) without iterating. They are
+    upper bounds, since gen_func may drop the duplicated crash plans.
+    '''
+    def __init__(self, gen_func, seed, num_combs : int, num_cps_per_comb_map : dict):
+        self.gen_func = gen_func
+        self.seed = seed
+        self.num_combs = num_combs
+        self.num_cps_per_comb_map = num_cps_per_comb_map
+
+    def get_num_combs(self, budget : int) -> int:
+        if budget <= 0:
+            return self.num_combs
+        return min(self.num_combs, budget)
+
+    def get_num_cps_map(self, budget : int) -> dict:
+        num_combs = self.get_num_combs(budget)
+        return {tp : num_combs * num for tp, num in self.num_cps_per_comb_map.items()}
+
+    def get_num_cps(self, budget : int) -> int:
+        return sum(self.get_num_cps_map(budget).values())
+
+    def iter_crash_plans(self, budget : int):
+        return self.gen_func(budget, self.seed)
+
 class CrashPlanSchemeBase():
     def __init__(self):
         # a list of generated crash plans
         self.cp_entry_list = []
+        # a list of LazyCrashPlans, generated after cp_entry_list when iterating
+        self.lazy_cp_list = []
+        # the max number of combinations of a LazyCrashPlans, 0 means no limit.
+        # the combinations are sampled if there are more.
+        self.cp_budget = 0
+        # the persisted seqs of the crash plans are bitmasks over this table
+        self.seq_table = CrashPlanSeqTable()
+
+    def __getstate__(self):
+        # the seq table is pickled once, the crash plans are pickled as their bitmasks over it
+        state = dict(self.__dict__)
+        state['cp_entry_list'] = [cp.get_masked_state(self.seq_table) for cp in self.cp_entry_list]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'seq_table' not in state:
+            self.seq_table = CrashPlanSeqTable()
+        cp_entry_list = []
+        for cp in self.cp_entry_list:
+            if isinstance(cp, CrashPlanEntry):
+                # pickled with its own seq table (e.g., before the bitmasks), share ours again
+                cp.attach_seq_table(self.seq_table)
+            else:
+                cp = CrashPlanEntry.from_masked_state(cp, self.seq_table)
+            cp_entry_list.append(cp)
+        self.cp_entry_list = cp_entry_list
 
     def generate_crash_plans(self):
         raise NotImplementedError("Method generate_crash_plans is not implemented.")
 
+    def iter_crash_plans(self):
+        '''Yield [cp_idx, cp] of all crash plans, the lazy ones are generated on the fly.'''
+        cp_idx = 0
+        for cp in self.cp_entry_list:
+            yield cp_idx, cp
+            cp_idx += 1
+        for lazy_cps in self.lazy_cp_list:
+            lazy_cps : LazyCrashPlans
+            for cp in lazy_cps.iter_crash_plans(self.cp_budget):
+                yield cp_idx, cp
+                cp_idx += 1
+
+    def get_num_crash_plans(self) -> int:
+        '''The number of crash plans yielded by iter_crash_plans, an upper bound if there are lazy ones.'''
+        return len(self.cp_entry_list) + sum(x.get_num_cps(self.cp_budget) for x in self.lazy_cp_list)
+
+    def get_num_cps_map(self) -> dict:
+        '''The number of crash plans of each type, including the phoney ones and the lazy ones.'''
+        num_cps_map = dict()
+        for cp in self.cp_entry_list:
+            cp : CrashPlanEntry
+            num_cps_map[cp.type] = num_cps_map.get(cp.type, 0) + cp.num_cp_entries
+        for lazy_cps in self.lazy_cp_list:
+            lazy_cps : LazyCrashPlans
+            for tp, count in lazy_cps.get_num_cps_map(self.cp_budget).items():
+                num_cps_map[tp] = num_cps_map.get(tp, 0) + count
+        return num_cps_map
+
     @timeit
-    def write_to_disk(self, dpath, file_prefix, use_pickle):
-        for cp_idx in range(len(self.cp_entry_list)):
-            cp : CrashPlanEntry = self.cp_entry_list[cp_idx]
-            fpath = f'{dpath}/{file_prefix}-{cp_idx:02d}-{cp.type.value}.cp'
-            if use_pickle:
-                with open(fpath, 'wb') as fd:
-                    pickle.dump(cp, fd)
-            else:
-                with open(fpath, 'w') as fd:
-                    fd.write(str(cp))
+    def write_to_disk(self, fpath, op_idx, op_name):
+        '''Append the crash plans of the op to the crash plan store file of the case.'''
+        with CrashPlanStoreWriter(fpath) as writer:
+            writer.write_op(op_idx, op_name, (cp for _, cp in self.iter_crash_plans()), self.seq_table)
 
     @timeit
     def send_to_memcached(self, memcached_client, existing_key):
         # we do not want to count crash plan multiple time after retesting a case
         if mc_wrapper.mc_add_wrapper(memcached_client, existing_key, '1'):
-            for cp in self.cp_entry_list:
-                cp : CrashPlanEntry
-
-                key = f'CrashPlanType.{cp.type.value}.count'
-                count = cp.num_cp_entries
-                mc_wrapper.mc_incr_wrapper(memcached_client, key, count)
+            for tp, count in self.get_num_cps_map().items():
+                tp : CrashPlanType
+                key = f'CrashPlanType.{tp.value}.count'
+                mc_wrapper.mc_incr_deferred(memcached_client, key, count)
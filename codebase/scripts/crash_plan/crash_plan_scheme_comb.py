@@ -45,8 +45,7 @@ def timeit(func):
 
 class CrashPlanSchemeComb(CrashPlanSchemeBase):
     def __init__(self, op_entry : OpTraceEntry):
-        # a list of generated crash plans
-        self.cp_entry_list = []
+        super().__init__()
 
         self.op_entry = op_entry
 
@@ -63,16 +62,13 @@ class CrashPlanSchemeComb(CrashPlanSchemeBase):
 
         num_stores_in_cache_lines = [len(cl.stores_list) for cl in cache.cacheline_dict.values()]
 
-        num_combinations = 0
-        for combination_length in range(0, len(num_stores_in_cache_lines) + 1):
-            comb_list = list(itertools.combinations(num_stores_in_cache_lines, combination_length))
-            for comb in comb_list:
-                if len(comb) == 0:
-                    num_combinations += 1
-                else:
-                    num_combinations += reduce(lambda x,y:x*y, comb)
+        # the sum of the products of the numbers of stores of each combination
+        # of cachelines (1 for the empty one), i.e., prod(1 + num).
+        num_combinations = 1
+        for num in num_stores_in_cache_lines:
+            num_combinations *= 1 + num
 
-        cp = CrashPlanEntry(CrashPlanType.Dummy, -1, -1, set(all_seqs), {-1}, 'Comb')
+        cp = CrashPlanEntry(CrashPlanType.Dummy, -1, -1, set(all_seqs), {-1}, 'Comb', seq_table=self.seq_table)
         cp.num_cp_entries = num_combinations
         self.cp_entry_list.append(cp)
 
@@ -39,8 +39,7 @@ def timeit(func):
 
 class CrashPlanSchemeMech2CP(CrashPlanSchemeBase):
     def __init__(self, trace_reader : TraceReader, stinfo_index : StInfoIndex, op_entry : OpTraceEntry, mech_deduce : DeduceMech):
-        # a list of generated crash plans
-        self.cp_entry_list = []
+        super().__init__()
 
         self.trace_reader = trace_reader
         self.stinfo_index = stinfo_index
@@ -97,7 +96,7 @@ class CrashPlanSchemeMech2CP(CrashPlanSchemeBase):
             # 1.4 create the cp entry
             dbg_msg = "persist itself: %d, and dep: %s, but no other seq." % (seq, str(seq_set))
             log.global_logger.debug(dbg_msg)
-            cp = CrashPlanEntry(CrashPlanType.UnprotectedPersistSelf, pmstore_entry.op.instid, min(seq_set), seq_set, {seq}, pmstore_entry.op.to_result_str())
+            cp = CrashPlanEntry(CrashPlanType.UnprotectedPersistSelf, pmstore_entry.op.instid, min(seq_set), seq_set, {seq}, pmstore_entry.op.to_result_str(), seq_table=self.seq_table)
 
             # 1.5 sampling the this store
             start_addr = pmstore_entry.op.addr
@@ -181,7 +180,7 @@ class CrashPlanSchemeMech2CP(CrashPlanSchemeBase):
             dbg_msg = "persist all other seq: %s but not itself: %d" % (str(seq_set), seq)
             log.global_logger.debug(dbg_msg)
             min_seq = seq if len(seq_set) == 0 else min(seq, min(seq_set))
-            cp = CrashPlanEntry(CrashPlanType.UnprotectedPersistOther, pmstore_entry.op.instid, min_seq, seq_set, {seq}, pmstore_entry.op.to_result_str())
+            cp = CrashPlanEntry(CrashPlanType.UnprotectedPersistOther, pmstore_entry.op.instid, min_seq, seq_set, {seq}, pmstore_entry.op.to_result_str(), seq_table=self.seq_table)
 
             # 2.5 sampling the this store
             start_addr = pmstore_entry.op.addr
@@ -357,4 +356,4 @@ class CrashPlanSchemeMech2CP(CrashPlanSchemeBase):
             value.append(len(self.mech_deduce.op_name_list))
             value.append(self.mech_deduce.op_name_list)
 
-        mc_wrapper.mc_set_wrapper(mc_wrapper.glo_mc_pool_client, key, value)
+        mc_wrapper.mc_set_deferred(mc_wrapper.glo_mc_pool_client, key, value)
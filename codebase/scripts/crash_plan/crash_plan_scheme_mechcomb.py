@@ -2,9 +2,8 @@ import os
 import sys
 import time
 import random
-import itertools
 import copy
-from functools import reduce
+import functools
 
 base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
 sys.path.append(base_dir)
@@ -25,7 +24,7 @@ from scripts.trace_proc.trace_stinfo.stinfo_index import StInfoIndex
 from scripts.mech_reason.mech_store.mech_pmstore_reason import MechPMStoreReason, MechPMStoreEntry
 from scripts.crash_plan.crash_plan_entry import CrashPlanEntry
 from scripts.crash_plan.crash_plan_type import CrashPlanType, CrashPlanSamplingType
-from scripts.crash_plan.crash_plan_scheme_base import CrashPlanSchemeBase
+from scripts.crash_plan.crash_plan_scheme_base import CrashPlanSchemeBase, LazyCrashPlans, iter_combinations
 from scripts.cheat_sheet.base.cheat_base import CheatSheetBase
 from scripts.executor.guest_side.deduce_mech import DeduceMech
 from scripts.utils.exceptions import GuestExceptionForDebug
@@ -34,6 +33,9 @@ from scripts.utils.const_var import CACHELINE_BYTES, ATOMIC_WRITE_BYTES
 import scripts.vm_comm.memcached_wrapper as mc_wrapper
 import scripts.utils.logger as log
 
+# the max number of the visited combinations of a group, to drop the duplicated crash plans
+MAX_NUM_VISITED_COMBS = 1 << 16
+
 def timeit(func):
     """Decorator that prints the time a function takes to execute."""
     def wrapper(*args, **kwargs):
@@ -45,8 +47,7 @@ def timeit(func):
 
 class CrashPlanSchemeMechComb(CrashPlanSchemeBase):
     def __init__(self, trace_reader : TraceReader, stinfo_index : StInfoIndex, op_entry : OpTraceEntry, mech_deduce : DeduceMech):
-        # a list of generated crash plans
-        self.cp_entry_list = []
+        super().__init__()
 
         self.trace_reader = trace_reader
         self.stinfo_index = stinfo_index
@@ -103,7 +104,7 @@ class CrashPlanSchemeMechComb(CrashPlanSchemeBase):
             # 1.4 create the cp entry
             dbg_msg = "persist itself: %d, and dep: %s, but no other seq." % (seq, str(seq_set))
             log.global_logger.debug(dbg_msg)
-            cp = CrashPlanEntry(CrashPlanType.UnprotectedPersistSelf, pmstore_entry.op.instid, min(seq_set), seq_set, {seq}, pmstore_entry.op.to_result_str())
+            cp = CrashPlanEntry(CrashPlanType.UnprotectedPersistSelf, pmstore_entry.op.instid, min(seq_set), seq_set, {seq}, pmstore_entry.op.to_result_str(), seq_table=self.seq_table)
 
             # 1.5 sampling the this store
             start_addr = pmstore_entry.op.addr
@@ -187,7 +188,7 @@ class CrashPlanSchemeMechComb(CrashPlanSchemeBase):
             dbg_msg = "persist all other seq: %s but not itself: %d" % (str(seq_set), seq)
             log.global_logger.debug(dbg_msg)
             min_seq = seq if len(seq_set) == 0 else min(seq, min(seq_set))
-            cp = CrashPlanEntry(CrashPlanType.UnprotectedPersistOther, pmstore_entry.op.instid, min_seq, seq_set, {seq}, pmstore_entry.op.to_result_str())
+            cp = CrashPlanEntry(CrashPlanType.UnprotectedPersistOther, pmstore_entry.op.instid, min_seq, seq_set, {seq}, pmstore_entry.op.to_result_str(), seq_table=self.seq_table)
 
             # 2.5 sampling the this store
             start_addr = pmstore_entry.op.addr
@@ -229,6 +230,65 @@ class CrashPlanSchemeMechComb(CrashPlanSchemeBase):
                     cp.type = cp_type
                 self.cp_entry_list.append(cp)
 
+    def _gen_comb_cps(self, atomic_ops : list,
+                      all_inflight_seq_set : set,
+                      other_inflight_seq_set : set,
+                      all_persisted_seq_set : set,
+                      max_num_combs : int,
+                      seed):
+        # different combinations may persist the same seqs due to the write
+        # dependencies, only yield the crash plans of the first one. The visited
+        # keys are capped to bound the memory, the duplicates after that are
+        # yielded, and the crash image cache skips their identical images.
+        visited : set = set()
+        for comb in iter_combinations(atomic_ops, max_num_combs, seed):
+            # persisting this com but not other in-flight stores
+            comb = list(comb)
+            tobe_persist_seq_set = set([x.seq for x in comb])
+
+            # adding must happend before writes (e.g., TSO)
+            dep_seq_set :set = set()
+            for seq in tobe_persist_seq_set:
+                if seq in self.op_entry.write_dep_seq_map:
+                    dep_seq_set |= self.op_entry.write_dep_seq_map[seq]
+            tobe_persist_seq_set |= dep_seq_set
+
+            # adding other seqs that are not in-flight
+            tobe_persist_seq_set |= all_persisted_seq_set
+
+            cp = CrashPlanEntry(CrashPlanType.CombPersistSelf, -1, self.op_entry.min_seq, tobe_persist_seq_set, {}, str(sorted(list(tobe_persist_seq_set))), seq_table=self.seq_table)
+
+            # check if visited
+            # sampled ops could have the same seq, thus, adding addr as a part of the key
+            visited_key : tuple = (cp.persist_mask, tuple([x.addr for x in comb]))
+            if visited_key in visited:
+                continue
+            elif len(visited) < MAX_NUM_VISITED_COMBS:
+                visited.add(visited_key)
+
+            if len(other_inflight_seq_set) == 0:
+                cp.type = CrashPlanType.CombPersist
+                yield cp
+
+            else:
+                yield cp
+
+                # persisting protected stores but not this comb
+                tobe_persist_seq_set = all_inflight_seq_set - set([x.seq for x in comb])
+
+                # adding must happend before writes (e.g., TSO)
+                dep_seq_set :set = set()
+                for seq in tobe_persist_seq_set:
+                    if seq in self.op_entry.write_dep_seq_map:
+                        dep_seq_set |= self.op_entry.write_dep_seq_map[seq]
+                tobe_persist_seq_set |= dep_seq_set
+
+                # adding other seqs that are not in-flight
+                tobe_persist_seq_set |= all_persisted_seq_set
+
+                cp = CrashPlanEntry(CrashPlanType.CombPersistOther, -1, self.op_entry.min_seq, tobe_persist_seq_set, {}, str(sorted(list(tobe_persist_seq_set))), seq_table=self.seq_table)
+                yield cp
+
     @timeit
     def _gen_comb_for_stores(self,
                              cluster_number : int,
@@ -261,148 +321,19 @@ class CrashPlanSchemeMechComb(CrashPlanSchemeBase):
         if len(atomic_ops) == 0:
             return
 
-        # mech filter out lots of stores, we can handle the combination
-        visited : set = set()
-        for combination_length in range(0, len(atomic_ops) + 1):
-            comb_list = list(itertools.combinations(atomic_ops, combination_length))
-
-            for comb in comb_list:
-                # persisting this com but not other in-flight stores
-                comb = list(comb)
-                comb.sort(key=lambda x:x.seq)
-                tobe_persist_seq_set = set([x.seq for x in comb])
-
-                # adding must happend before writes (e.g., TSO)
-                dep_seq_set :set = set()
-                for seq in tobe_persist_seq_set:
-                    if seq in self.op_entry.write_dep_seq_map:
-                        dep_seq_set |= self.op_entry.write_dep_seq_map[seq]
-                tobe_persist_seq_set |= dep_seq_set
-
-                # adding other seqs that are not in-flight
-                tobe_persist_seq_set |= all_persisted_seq_set
-
-                # check if visited
-                # sampled ops could have the same seq, thus, adding addr as a part of the key
-                visited_key : tuple = ((tuple(tobe_persist_seq_set), tuple([x.addr for x in comb])))
-                if visited_key in visited:
-                    continue
-                else:
-                    visited.add(visited_key)
-
-                cp = CrashPlanEntry(CrashPlanType.CombPersistSelf, -1, self.op_entry.min_seq, tobe_persist_seq_set, {}, str(sorted(list(tobe_persist_seq_set))))
-                self.cp_entry_list.append(cp)
-
-                if len(other_inflight_seq_set) == 0:
-                    self.cp_entry_list[-1].type = CrashPlanType.CombPersist
-
-                else:
-                    # persisting protected stores but not this comb
-                    tobe_persist_seq_set = all_inflight_seq_set - set([x.seq for x in comb])
-
-                    # adding must happend before writes (e.g., TSO)
-                    dep_seq_set :set = set()
-                    for seq in tobe_persist_seq_set:
-                        if seq in self.op_entry.write_dep_seq_map:
-                            dep_seq_set |= self.op_entry.write_dep_seq_map[seq]
-                    tobe_persist_seq_set |= dep_seq_set
-
-                    # adding other seqs that are not in-flight
-                    tobe_persist_seq_set |= all_persisted_seq_set
-
-                    cp = CrashPlanEntry(CrashPlanType.CombPersistOther, -1, self.op_entry.min_seq, tobe_persist_seq_set, {}, str(sorted(list(tobe_persist_seq_set))))
-                    self.cp_entry_list.append(cp)
-
-        return
-
-        if len(tobe_comb_seq_set) > 0:
-            # No real crash plans will be generated due to the large number
-            cache = WitcherCache(EmptyBinaryFile())
-            for op in atomic_ops:
-                cache.accept(op)
-
-            # respect to TSO
-            num_stores_in_cache_lines = [len(cl.stores_list) for cl in cache.cacheline_dict.values()]
-
-            num_combinations = 0
-            for combination_length in range(0, len(num_stores_in_cache_lines) + 1):
-                comb_list = list(itertools.combinations(num_stores_in_cache_lines, combination_length))
-                for comb in comb_list:
-                    if len(comb) == 0:
-                        num_combinations += 1
-                    else:
-                        num_combinations += reduce(lambda x,y:x*y, comb)
-
-            if len(other_inflight_seq_set) > 0:
-                # for each combination, persisting or not persisting other in-flight stores
-                num_combinations *= 2
-
-            cp = CrashPlanEntry(CrashPlanType.Dummy, -1, -1, tobe_comb_seq_set, {-1}, 'Comb')
-            cp.num_cp_entries = num_combinations
-            self.cp_entry_list.append(cp)
-
-            if log.debug:
-                msg = f"number of comb cps: {num_combinations}, {len(tobe_comb_seq_set), {len(other_inflight_seq_set)}}"
-                log.global_logger.debug(msg)
-
+        # mech filter out lots of stores, we can handle the combination.
+        # the crash plans are generated when they are validated, since the
+        # number of combinations is exponential.
+        # the sampling seed is derived from the op and the group, so that the
+        # sampled crash plans are reproducible.
+        seed = f'{self.op_entry.min_seq}.{len(self.lazy_cp_list)}'
+        gen_func = functools.partial(self._gen_comb_cps, atomic_ops, all_inflight_seq_set, other_inflight_seq_set, all_persisted_seq_set)
+        if len(other_inflight_seq_set) == 0:
+            num_cps_per_comb_map = {CrashPlanType.CombPersist : 1}
         else:
-            # generate real crash plans
-            # cache = WitcherCache(EmptyBinaryFile())
-            # for op in atomic_ops:
-            #     cache.accept(op)
-
-            # # respect to TSO
-            # stores_in_cache_lines = [[s.seq for s in cl.stores_list] for cl in cache.cacheline_dict.values()]
-
-            # for combination_length in range(0, len(stores_in_cache_lines) + 1):
-            #     comb_list = list(itertools.combinations(stores_in_cache_lines, combination_length))
-            #     for comb in comb_list:
-            #         # comb: [[seq1, seq3], [seq2, seq4]]
-
-            #         if len(comb) == 0:
-            #             num_combinations += 1
-            #         else:
-            #             num_combinations += reduce(lambda x,y:x*y, comb)
-
-            for combination_length in range(0, len(atomic_ops) + 1):
-                comb_list = list(itertools.combinations(atomic_ops, combination_length))
-
-                for comb in comb_list:
-                    # persisting this com but not other in-flight stores
-                    tobe_persist_seq_set = set([x.seq for x in comb])
-
-                    # adding must happend before writes (e.g., TSO)
-                    dep_seq_set :set = set()
-                    for seq in tobe_persist_seq_set:
-                        if seq in self.op_entry.write_dep_seq_map:
-                            dep_seq_set |= self.op_entry.write_dep_seq_map[seq]
-                    tobe_persist_seq_set |= dep_seq_set
-
-                    # adding other seqs that are not in-flight
-                    tobe_persist_seq_set |= all_persisted_seq_set
-
-                    cp = CrashPlanEntry(CrashPlanType.CombPersistSelf, -1, self.op_entry.min_seq, tobe_persist_seq_set, {}, str(sorted(list(tobe_persist_seq_set))))
-                    self.cp_entry_list.append(cp)
-
-                    if len(other_inflight_seq_set) == 0:
-                        self.cp_entry_list[-1].type = CrashPlanType.CombPersist
-
-                    else:
-                        # persisting protected stores but not this comb
-                        tobe_persist_seq_set = all_inflight_seq_set - set([x.seq for x in comb])
-
-                        # adding must happend before writes (e.g., TSO)
-                        dep_seq_set :set = set()
-                        for seq in tobe_persist_seq_set:
-                            if seq in self.op_entry.write_dep_seq_map:
-                                dep_seq_set |= self.op_entry.write_dep_seq_map[seq]
-                        tobe_persist_seq_set |= dep_seq_set
-
-                        # adding other seqs that are not in-flight
-                        tobe_persist_seq_set |= all_persisted_seq_set
-
-                        cp = CrashPlanEntry(CrashPlanType.CombPersistOther, -1, self.op_entry.min_seq, tobe_persist_seq_set, {}, str(sorted(list(tobe_persist_seq_set))))
-                        self.cp_entry_list.append(cp)
+            # for each combination, persisting or not persisting other in-flight stores
+            num_cps_per_comb_map = {CrashPlanType.CombPersistSelf : 1, CrashPlanType.CombPersistOther : 1}
+        self.lazy_cp_list.append(LazyCrashPlans(gen_func, seed, 2 ** len(atomic_ops), num_cps_per_comb_map))
 
     @timeit
     def generate_crash_plans(self, ignore_nonatomic_write : bool,
@@ -512,13 +443,9 @@ class CrashPlanSchemeMechComb(CrashPlanSchemeBase):
             while len(fence_seqs) > 0:
                 msg += f'flush:{fence_seqs.pop()}\n'
 
-        cp_count_map = dict()
+        # the lazy crash plans are counted but not listed
+        cp_count_map = self.get_num_cps_map()
         cp_msg = ''
-        for cp in self.cp_entry_list:
-            cp : CrashPlanEntry
-            if cp.type not in cp_count_map:
-                cp_count_map[cp.type] = 0
-            cp_count_map[cp.type] += 1
         for tp, count in cp_count_map.items():
             cp_msg += f'{tp}: {count}\n'
         for cp in self.cp_entry_list:
@@ -546,4 +473,4 @@ class CrashPlanSchemeMechComb(CrashPlanSchemeBase):
             value.append(len(self.mech_deduce.op_name_list))
             value.append(self.mech_deduce.op_name_list)
 
-        mc_wrapper.mc_set_wrapper(mc_wrapper.glo_mc_pool_client, key, value)
+        mc_wrapper.mc_set_deferred(mc_wrapper.glo_mc_pool_client, key, value)
@@ -0,0 +1,358 @@
+"""
+A single-file container of the crash plans of a test case.
+
+The file is a header followed by chunks, which are appended op by op:
+
+    header: MAGIC, FORMAT_VERSION, the values of CrashPlanType and
+            CrashPlanSamplingType (the records refer to them by index)
+    chunk:  CHUNK_MAGIC, body length (u64), then the body:
+            op_idx, op name, index of the first plan, number of plans,
+            the seqs appended to the seq table of the op since its last chunk,
+            the offsets of the records (u32, one more than the plans),
+            the records
+
+The integers in the body are varints (signed ones are zigzag encoded). A record
+is a CrashPlanEntry with the persisted seqs kept as the bitmask over the seq
+table of the op. The reader scans the chunk heads once, then a plan is read by
+(op_idx, cp_idx) with a seek.
+"""
+import os
+import sys
+import time
+import struct
+from array import array
+
+base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
+sys.path.append(base_dir)
+
+from scripts.crash_plan.crash_plan_entry import CrashPlanEntry, CrashPlanSeqTable
+from scripts.crash_plan.crash_plan_type import CrashPlanType, CrashPlanSamplingType
+import scripts.utils.logger as log
+
+def timeit(func):
+    """Decorator that prints the time a function takes to execute."""
+    def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        result = func(*args, **kwargs)
+        log.time_logger.info(f"elapsed_time.guest.cp_store.{func.__name__}:{time.perf_counter() - start_time:.6f}")
+        return result
+    return wrapper
+
+# the file name of the crash plan store in the directory of a test case
+CRASH_PLAN_STORE_FNAME = 'crash_plans.cps'
+
+MAGIC = b'SILHCPS\0'
+FORMAT_VERSION = 1
+CHUNK_MAGIC = b'CPCK'
+CHUNK_HEAD_FMT = '<4sQ'
+CHUNK_HEAD_BYTES = struct.calcsize(CHUNK_HEAD_FMT)
+# the max number of crash plans in a chunk
+CHUNK_NUM_PLANS = 4096
+
+# the flags of a record
+FLAG_SAMPLING_SEQ = 1
+FLAG_SAMPLING_ADDR = 2
+
+def _put_uvarint(buf : bytearray, value : int):
+    while value >= 0x80:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+def _put_varint(buf : bytearray, value : int):
+    # zigzag
+    _put_uvarint(buf, (value << 1) if value >= 0 else ((-value << 1) - 1))
+
+def _put_bytes(buf : bytearray, data : bytes):
+    _put_uvarint(buf, len(data))
+    buf += data
+
+def _put_str(buf : bytearray, data : str):
+    _put_bytes(buf, data.encode('utf-8'))
+
+def _get_uvarint(data, pos : int):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def _get_varint(data, pos : int):
+    value, pos = _get_uvarint(data, pos)
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1), pos
+
+def _get_bytes(data, pos : int):
+    size, pos = _get_uvarint(data, pos)
+    return bytes(data[pos : pos + size]), pos + size
+
+def _get_str(data, pos : int):
+    raw, pos = _get_bytes(data, pos)
+    return raw.decode('utf-8'), pos
+
+class CrashPlanStoreWriter:
+    '''
+    Append the crash plans of the ops to the container file. The file is
+    created with the header if it does not exist.
+    '''
+    def __init__(self, fpath : str):
+        self.fpath = fpath
+        self.fd = open(fpath, 'ab')
+        if self.fd.tell() == 0:
+            self.fd.write(self.__header())
+        self.type_idx_map = {tp : idx for idx, tp in enumerate(CrashPlanType)}
+        self.sampling_type_idx_map = {tp : idx for idx, tp in enumerate(CrashPlanSamplingType)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.fd:
+            self.fd.close()
+            self.fd = None
+
+    @staticmethod
+    def __header() -> bytes:
+        buf = bytearray(MAGIC)
+        _put_uvarint(buf, FORMAT_VERSION)
+        for enum_cls in [CrashPlanType, CrashPlanSamplingType]:
+            _put_uvarint(buf, len(enum_cls))
+            for tp in enum_cls:
+                _put_str(buf, tp.value)
+        return bytes(buf)
+
+    def __encode_cp(self, cp : CrashPlanEntry, table_map : dict) -> bytes:
+        buf = bytearray()
+        _put_uvarint(buf, self.type_idx_map[cp.type])
+        _put_varint(buf, cp.instruction_id)
+        _put_varint(buf, cp.start_seq)
+
+        mask = cp.persist_mask
+        if cp.seq_table is not table_map['table']:
+            # the plan is not from the scheme, encode it over the table of the op
+            mask = table_map['table'].encode(cp.persist_seqs)
+        _put_bytes(buf, mask.to_bytes((mask.bit_length() + 7) // 8, 'little'))
+
+        exp_data_seqs = sorted(cp.exp_data_seqs) if cp.exp_data_seqs else []
+        _put_uvarint(buf, len(exp_data_seqs))
+        for seq in exp_data_seqs:
+            _put_varint(buf, seq)
+
+        _put_str(buf, str(cp.info))
+        _put_uvarint(buf, self.sampling_type_idx_map[cp.sampling_type])
+        flags = 0
+        if cp.sampling_seq != None:
+            flags |= FLAG_SAMPLING_SEQ
+        if cp.sampling_addr != None:
+            flags |= FLAG_SAMPLING_ADDR
+        _put_uvarint(buf, flags)
+        if cp.sampling_seq != None:
+            _put_varint(buf, cp.sampling_seq)
+        if cp.sampling_addr != None:
+            _put_uvarint(buf, cp.sampling_addr)
+        _put_uvarint(buf, cp.num_cp_entries)
+        return bytes(buf)
+
+    def __write_chunk(self, op_idx : int, op_name : str, first_cp_idx : int, records : list, table_map : dict):
+        seq_table : CrashPlanSeqTable = table_map['table']
+        new_seqs = seq_table.seq_list[table_map['num_written']:]
+        table_map['num_written'] = len(seq_table)
+
+        body = bytearray()
+        _put_uvarint(body, op_idx)
+        _put_str(body, op_name)
+        _put_uvarint(body, first_cp_idx)
+        _put_uvarint(body, len(records))
+        _put_uvarint(body, len(new_seqs))
+        for seq in new_seqs:
+            _put_varint(body, seq)
+
+        offsets = array('I', [0])
+        for record in records:
+            offsets.append(offsets[-1] + len(record))
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        body += offsets.tobytes()
+        for record in records:
+            body += record
+
+        self.fd.write(struct.pack(CHUNK_HEAD_FMT, CHUNK_MAGIC, len(body)))
+        self.fd.write(body)
+
+    @timeit
+    def write_op(self, op_idx : int, op_name : str, cp_iter, seq_table : CrashPlanSeqTable = None) -> int:
+        '''
+        Write the crash plans yielded by cp_iter as the plans of op_idx.
+        The plans are expected to share the seq_table (e.g., from a scheme).
+        Returns the number of written plans.
+        '''
+        table_map = {'table' : seq_table if seq_table != None else CrashPlanSeqTable(), 'num_written' : 0}
+        records = []
+        first_cp_idx = 0
+        for cp in cp_iter:
+            records.append(self.__encode_cp(cp, table_map))
+            if len(records) == CHUNK_NUM_PLANS:
+                self.__write_chunk(op_idx, op_name, first_cp_idx, records, table_map)
+                first_cp_idx += len(records)
+                records = []
+        if len(records) > 0 or first_cp_idx == 0:
+            self.__write_chunk(op_idx, op_name, first_cp_idx, records, table_map)
+        return first_cp_idx + len(records)
+
+class CrashPlanStoreChunk:
+    def __init__(self, op_idx : int, op_name : str, first_cp_idx : int, num_plans : int, offsets_pos : int, records_pos : int):
+        self.op_idx = op_idx
+        self.op_name = op_name
+        self.first_cp_idx = first_cp_idx
+        self.num_plans = num_plans
+        # the file positions of the record offsets and the records
+        self.offsets_pos = offsets_pos
+        self.records_pos = records_pos
+
+class CrashPlanStoreReader:
+    '''Random access to the crash plans in a container file by (op_idx, cp_idx).'''
+    def __init__(self, fpath : str):
+        self.fpath = fpath
+        self.fd = open(fpath, 'rb')
+        self.cp_types = []
+        self.sampling_types = []
+        # op_idx : a list of CrashPlanStoreChunk in the plan order
+        self.op_chunks_map = dict()
+        # op_idx : CrashPlanSeqTable
+        self.op_table_map = dict()
+        self.__read_header()
+        self.__scan_chunks()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.fd:
+            self.fd.close()
+            self.fd = None
+
+    def __read_header(self):
+        # the header is small, 64 KiB is more than enough
+        data = self.fd.read(1 << 16)
+        assert data[:len(MAGIC)] == MAGIC, f"not a crash plan store: {self.fpath}"
+        pos = len(MAGIC)
+        version, pos = _get_uvarint(data, pos)
+        assert version == FORMAT_VERSION, f"unsupported crash plan store version {version}: {self.fpath}"
+        for enum_cls, tp_list in [(CrashPlanType, self.cp_types), (CrashPlanSamplingType, self.sampling_types)]:
+            num, pos = _get_uvarint(data, pos)
+            for _ in range(num):
+                value, pos = _get_str(data, pos)
+                tp_list.append(enum_cls(value))
+        self.fd.seek(pos)
+
+    def __scan_chunks(self):
+        while True:
+            chunk_pos = self.fd.tell()
+            head = self.fd.read(CHUNK_HEAD_BYTES)
+            if len(head) < CHUNK_HEAD_BYTES:
+                break
+            magic, body_len = struct.unpack(CHUNK_HEAD_FMT, head)
+            assert magic == CHUNK_MAGIC, f"invalid chunk at {chunk_pos}: {self.fpath}"
+            body = self.fd.read(body_len)
+            if len(body) < body_len:
+                # a truncated chunk, e.g., the writer was killed
+                log.global_logger.warning(f"truncated chunk at {chunk_pos}: {self.fpath}")
+                break
+
+            pos = 0
+            op_idx, pos = _get_uvarint(body, pos)
+            op_name, pos = _get_str(body, pos)
+            first_cp_idx, pos = _get_uvarint(body, pos)
+            num_plans, pos = _get_uvarint(body, pos)
+            num_new_seqs, pos = _get_uvarint(body, pos)
+
+            # a new op starts with the chunk of its first plan. If the op is
+            # written again (e.g., retesting the case), the last one is used.
+            if first_cp_idx == 0:
+                self.op_chunks_map[op_idx] = []
+                self.op_table_map[op_idx] = CrashPlanSeqTable()
+            seq_table : CrashPlanSeqTable = self.op_table_map[op_idx]
+            for _ in range(num_new_seqs):
+                seq, pos = _get_varint(body, pos)
+                seq_table.get_idx(seq)
+
+            body_pos = chunk_pos + CHUNK_HEAD_BYTES
+            offsets_pos = body_pos + pos
+            records_pos = offsets_pos + (num_plans + 1) * 4
+            chunk = CrashPlanStoreChunk(op_idx, op_name, first_cp_idx, num_plans, offsets_pos, records_pos)
+            self.op_chunks_map[op_idx].append(chunk)
+
+    def get_op_indices(self) -> list:
+        return sorted(self.op_chunks_map.keys())
+
+    def get_op_name(self, op_idx : int) -> str:
+        return self.op_chunks_map[op_idx][0].op_name
+
+    def get_num_crash_plans(self, op_idx : int) -> int:
+        return sum(chunk.num_plans for chunk in self.op_chunks_map[op_idx])
+
+    def __decode_cp(self, data, seq_table : CrashPlanSeqTable) -> CrashPlanEntry:
+        pos = 0
+        type_idx, pos = _get_uvarint(data, pos)
+        instruction_id, pos = _get_varint(data, pos)
+        start_seq, pos = _get_varint(data, pos)
+        raw_mask, pos = _get_bytes(data, pos)
+        num_exp_data_seqs, pos = _get_uvarint(data, pos)
+        exp_data_seqs = set()
+        for _ in range(num_exp_data_seqs):
+            seq, pos = _get_varint(data, pos)
+            exp_data_seqs.add(seq)
+        info, pos = _get_str(data, pos)
+        sampling_type_idx, pos = _get_uvarint(data, pos)
+        flags, pos = _get_uvarint(data, pos)
+        sampling_seq = None
+        sampling_addr = None
+        if flags & FLAG_SAMPLING_SEQ:
+            sampling_seq, pos = _get_varint(data, pos)
+        if flags & FLAG_SAMPLING_ADDR:
+            sampling_addr, pos = _get_uvarint(data, pos)
+        num_cp_entries, pos = _get_uvarint(data, pos)
+
+        cp = CrashPlanEntry(self.cp_types[type_idx], instruction_id, start_seq, None, exp_data_seqs, info, self.sampling_types[sampling_type_idx], seq_table=seq_table)
+        cp.persist_mask = int.from_bytes(raw_mask, 'little')
+        cp.sampling_seq = sampling_seq
+        cp.sampling_addr = sampling_addr
+        cp.num_cp_entries = num_cp_entries
+        return cp
+
+    def __read_offsets(self, chunk : CrashPlanStoreChunk) -> array:
+        self.fd.seek(chunk.offsets_pos)
+        offsets = array('I')
+        offsets.frombytes(self.fd.read((chunk.num_plans + 1) * 4))
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        return offsets
+
+    def get_crash_plan(self, op_idx : int, cp_idx : int) -> CrashPlanEntry:
+        for chunk in self.op_chunks_map[op_idx]:
+            chunk : CrashPlanStoreChunk
+            if chunk.first_cp_idx <= cp_idx < chunk.first_cp_idx + chunk.num_plans:
+                i = cp_idx - chunk.first_cp_idx
+                self.fd.seek(chunk.offsets_pos + i * 4)
+                start, end = struct.unpack('<II', self.fd.read(8))
+                self.fd.seek(chunk.records_pos + start)
+                return self.__decode_cp(self.fd.read(end - start), self.op_table_map[op_idx])
+        raise IndexError(f"no crash plan {cp_idx} of op {op_idx} in {self.fpath}")
+
+    def iter_crash_plans(self, op_idx : int):
+        '''Yield the crash plans of op_idx in order, a chunk is read at a time.'''
+        seq_table = self.op_table_map[op_idx]
+        for chunk in self.op_chunks_map[op_idx]:
+            offsets = self.__read_offsets(chunk)
+            data = memoryview(self.fd.read(offsets[-1]))
+            for i in range(chunk.num_plans):
+                yield self.__decode_cp(data[offsets[i] : offsets[i + 1]], seq_table)
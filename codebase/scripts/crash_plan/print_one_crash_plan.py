@@ -5,18 +5,45 @@ import pickle
 base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
 sys.path.append(base_dir)
 
-from logic_reason.crash_plan.crash_plan_entry import CrashPlanEntry, CrashPlanType, CrashPlanSamplingType
+from scripts.crash_plan.crash_plan_entry import CrashPlanEntry, CrashPlanType, CrashPlanSamplingType
+from scripts.crash_plan.crash_plan_store import CrashPlanStoreReader, MAGIC
 
 
+def is_crash_plan_store(fname):
+    with open(fname, 'rb') as fd:
+        return fd.read(len(MAGIC)) == MAGIC
+
 def main():
-    if len(sys.argv) != 2:
+    '''
+    Usage: print_one_crash_plan.py <crash plan store> [op_idx [cp_idx]]
+    Print the ops in the store, the crash plans of op_idx, or a crash plan.
+    A crash plan file of the old one-file-per-plan format is printed as is,
+    the file is pickled (use_pickle=True) or the text of the plan.
+    '''
+    if len(sys.argv) < 2 or len(sys.argv) > 4:
         print("invalid usage")
         exit(0)
-    
+
     fname = sys.argv[1]
-    with open(fname, 'rb') as fd:
-        entry = pickle.load(fd)
-        print(entry)
+    if not is_crash_plan_store(fname):
+        with open(fname, 'rb') as fd:
+            data = fd.read()
+        try:
+            print(pickle.loads(data))
+        except pickle.UnpicklingError:
+            print(data.decode('utf-8', errors='replace'))
+        return
+
+    with CrashPlanStoreReader(fname) as reader:
+        if len(sys.argv) == 2:
+            for op_idx in reader.get_op_indices():
+                print(f"op {op_idx}: {reader.get_op_name(op_idx)}, {reader.get_num_crash_plans(op_idx)} crash plans")
+        elif len(sys.argv) == 3:
+            op_idx = int(sys.argv[2])
+            for cp_idx, entry in enumerate(reader.iter_crash_plans(op_idx)):
+                print(f"crash plan {cp_idx}:\n{entry}\n")
+        else:
+            print(reader.get_crash_plan(int(sys.argv[2]), int(sys.argv[3])))
 
 if __name__ == "__main__":
     main()
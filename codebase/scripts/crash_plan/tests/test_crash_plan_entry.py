@@ -0,0 +1,146 @@
+import os
+import sys
+import random
+import pickle
+import logging
+
+base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../.."))
+sys.path.append(base_dir)
+
+import scripts.crash_plan.crash_plan_entry as cp_entry_mod
+from scripts.crash_plan.crash_plan_entry import CrashPlanEntry, CrashPlanSeqTable
+from scripts.crash_plan.crash_plan_scheme_base import CrashPlanSchemeBase
+from scripts.crash_plan.crash_plan_type import CrashPlanType, CrashPlanSamplingType
+from scripts.utils.logger import global_logger, setup_global_logger
+
+def init_log():
+    setup_global_logger(stm = sys.stderr, stm_lv=logging.INFO)
+
+def get_passed_str():
+    return '\033[92m' + 'passed' + '\033[0m'
+
+def get_failed_str():
+    return '\033[91m' + 'failed' + '\033[0m'
+
+def log_result(name, ok):
+    if ok:
+        global_logger.info("%s: %s" % (name, get_passed_str()))
+    else:
+        global_logger.info("%s: %s" % (name, get_failed_str()))
+
+def test_encode_decode():
+    '''Encoding seqs over a growing table and decoding them gives the same seqs.'''
+    rnd = random.Random(0)
+    table = CrashPlanSeqTable()
+    ok = table.encode(set()) == 0 and table.decode(0) == set()
+    seqs_mask_list = []
+    for i in range(200):
+        seqs = set(rnd.sample(range(1000), rnd.randint(0, 40)))
+        mask = table.encode(seqs)
+        seqs_mask_list.append((seqs, mask))
+        ok = ok and mask.bit_count() == len(seqs)
+
+    # the masks are still valid after adding more seqs to the table
+    for seqs, mask in seqs_mask_list:
+        ok = ok and table.decode(mask) == seqs
+        ok = ok and all(table.contains(mask, seq) for seq in seqs)
+        ok = ok and not any(table.contains(mask, seq) for seq in range(1000, 1010))
+    ok = ok and len(table) == len(set().union(*[x[0] for x in seqs_mask_list]))
+    log_result("test_encode_decode", ok)
+
+def test_entry_persist_seqs():
+    table = CrashPlanSeqTable()
+    cp1 = CrashPlanEntry(CrashPlanType.UnprotectedPersistSelf, 1, 10, {3, 5, 7}, {5}, "cp1", seq_table=table)
+    cp2 = CrashPlanEntry(CrashPlanType.UnprotectedPersistSelf, 1, 10, {7, 5, 3}, {5}, "cp2", seq_table=table)
+    cp3 = CrashPlanEntry(CrashPlanType.UnprotectedPersistSelf, 1, 10, {3, 5, 7}, {5}, "cp3")
+    ok = cp1.persist_seqs == {3, 5, 7} and cp1.get_num_persist_seqs() == 3
+    ok = ok and cp1.is_persisted(5) and not cp1.is_persisted(4)
+    ok = ok and cp1 == cp2 and cp1 == cp3 and hash(cp1) == hash(cp3)
+    cp2.persist_seqs = {3, 11}
+    ok = ok and cp2.persist_seqs == {3, 11} and cp1 != cp2
+    log_result("test_entry_persist_seqs", ok)
+
+def test_pickle_without_table():
+    '''A crash plan is pickled without its shared table, and gets its own one when loaded.'''
+    table = CrashPlanSeqTable()
+    table.encode(set(range(1000)))
+    cp = CrashPlanEntry(CrashPlanType.UnprotectedPersistSelf, 1, 10, {3, 999}, {5}, "cp", seq_table=table)
+    cp.sampling_seq = 8
+    cp.sampling_addr = 0x1000
+    data = pickle.dumps(cp)
+    loaded = pickle.loads(data)
+    ok = len(data) < len(pickle.dumps(table))
+    ok = ok and loaded == cp and loaded.persist_seqs == {3, 999}
+    ok = ok and loaded.seq_table is not table and len(loaded.seq_table) == 2
+    ok = ok and (loaded.sampling_seq, loaded.sampling_addr, loaded.info) == (8, 0x1000, "cp")
+    log_result("test_pickle_without_table", ok)
+
+class OldCrashPlanEntry:
+    '''A crash plan as pickled before __slots__, its persisted seqs are a set in __dict__.'''
+    def __init__(self, ty, instruction_id, start_seq, persist_seqs, exp_data_seqs, info):
+        self.type = ty
+        self.instruction_id = instruction_id
+        self.start_seq = start_seq
+        self.persist_seqs = persist_seqs
+        self.exp_data_seqs = exp_data_seqs
+        self.info = info
+        self.sampling_type = CrashPlanSamplingType.SamplingNone
+        self.sampling_seq = None
+        self.sampling_addr = None
+        self.num_cp_entries = 1
+
+def dump_old_crash_plan(old_cp) -> bytes:
+    # pickle the old crash plan under the name of CrashPlanEntry
+    OldCrashPlanEntry.__module__ = CrashPlanEntry.__module__
+    OldCrashPlanEntry.__qualname__ = CrashPlanEntry.__qualname__
+    cp_entry_mod.CrashPlanEntry = OldCrashPlanEntry
+    try:
+        return pickle.dumps(old_cp)
+    finally:
+        cp_entry_mod.CrashPlanEntry = CrashPlanEntry
+
+def test_unpickle_old_crash_plan():
+    old_cp = OldCrashPlanEntry(CrashPlanType.UnprotectedPersistSelf, 2, 20, {21, 25}, {25}, "old")
+    old_cp.num_cp_entries = 3
+    loaded = pickle.loads(dump_old_crash_plan(old_cp))
+    ok = isinstance(loaded, CrashPlanEntry)
+    ok = ok and loaded.persist_seqs == {21, 25} and loaded.is_persisted(21)
+    ok = ok and (loaded.type, loaded.instruction_id, loaded.start_seq, loaded.exp_data_seqs, loaded.info, loaded.num_cp_entries) == \
+            (CrashPlanType.UnprotectedPersistSelf, 2, 20, {25}, "old", 3)
+    ok = ok and loaded.sampling_type == CrashPlanSamplingType.SamplingNone and loaded.sampling_addr == None
+    log_result("test_unpickle_old_crash_plan", ok)
+
+def test_unpickle_scheme():
+    '''The crash plans of an unpickled scheme share the table of the scheme again.'''
+    scheme = CrashPlanSchemeBase()
+    for i in range(10):
+        scheme.cp_entry_list.append(CrashPlanEntry(CrashPlanType.UnprotectedPersistSelf, 1, 10, set(range(i, i + 5)), set(), f"cp{i}", seq_table=scheme.seq_table))
+    data = pickle.dumps(scheme)
+    loaded = pickle.loads(data)
+    # the plans of a scheme are pickled as bitmasks over the table, not as sets
+    ok = len(data) < len(pickle.dumps(scheme.cp_entry_list))
+    ok = ok and all(cp.seq_table is loaded.seq_table for cp in loaded.cp_entry_list)
+    ok = ok and [cp.persist_seqs for cp in loaded.cp_entry_list] == [cp.persist_seqs for cp in scheme.cp_entry_list]
+    ok = ok and len(loaded.seq_table) == len(scheme.seq_table)
+    log_result("test_unpickle_scheme", ok)
+
+def test_hash_of_same_size_plans():
+    '''The comb plans of an op have the same start seq and often the same number of seqs.'''
+    table = CrashPlanSeqTable()
+    cp_list = [CrashPlanEntry(CrashPlanType.UnprotectedPersistSelf, 1, 10, {i, i + 1}, set(), "cp", seq_table=table) for i in range(100)]
+    other = CrashPlanEntry(CrashPlanType.UnprotectedPersistSelf, 1, 10, {5, 6}, set(), "cp")
+    ok = len(set(hash(cp) for cp in cp_list)) == len(cp_list)
+    ok = ok and hash(other) == hash(cp_list[5]) and other in set(cp_list)
+    log_result("test_hash_of_same_size_plans", ok)
+
+def main():
+    init_log()
+    test_encode_decode()
+    test_entry_persist_seqs()
+    test_pickle_without_table()
+    test_unpickle_old_crash_plan()
+    test_unpickle_scheme()
+    test_hash_of_same_size_plans()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import os
+import sys
+import random
+import logging
+import tempfile
+
+base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../.."))
+sys.path.append(base_dir)
+
+import scripts.crash_plan.crash_plan_store as cp_store
+from scripts.crash_plan.crash_plan_entry import CrashPlanEntry, CrashPlanSeqTable
+from scripts.crash_plan.crash_plan_store import CrashPlanStoreWriter, CrashPlanStoreReader
+from scripts.crash_plan.crash_plan_type import CrashPlanType, CrashPlanSamplingType
+from scripts.utils.logger import global_logger, setup_global_logger
+
+def init_log():
+    setup_global_logger(stm = sys.stderr, stm_lv=logging.INFO)
+
+def get_passed_str():
+    return '\033[92m' + 'passed' + '\033[0m'
+
+def get_failed_str():
+    return '\033[91m' + 'failed' + '\033[0m'
+
+def log_result(name, ok):
+    if ok:
+        global_logger.info("%s: %s" % (name, get_passed_str()))
+    else:
+        global_logger.info("%s: %s" % (name, get_failed_str()))
+
+def gen_crash_plans(seed, num_cps, seq_table : CrashPlanSeqTable) -> list:
+    '''
+    Random crash plans over seq_table, with negative and large values for the varints.
+    The seqs of the plans are in a range, as the seqs of an op.
+    '''
+    rnd = random.Random(seed)
+    first_seq = rnd.randint(0, 1 << 40)
+    cp_list = []
+    for i in range(num_cps):
+        start_seq = first_seq + rnd.randint(0, 100)
+        persist_seqs = set(rnd.sample(range(start_seq, start_seq + 300), rnd.randint(0, 20)))
+        exp_data_seqs = set(rnd.sample(range(start_seq, start_seq + 300), rnd.randint(0, 3)))
+        cp = CrashPlanEntry(rnd.choice(list(CrashPlanType)), rnd.randint(-5, 1 << 20), start_seq,
+                            persist_seqs, exp_data_seqs, f'cp {i} é',
+                            rnd.choice(list(CrashPlanSamplingType)), seq_table=seq_table)
+        if rnd.random() < 0.3:
+            cp.sampling_seq = rnd.randint(-1, 1 << 30)
+        if rnd.random() < 0.3:
+            cp.sampling_addr = rnd.randint(0, 1 << 64)
+        cp.num_cp_entries = rnd.randint(1, 1000)
+        cp_list.append(cp)
+    return cp_list
+
+def cp_fields(cp : CrashPlanEntry) -> tuple:
+    return (cp.type, cp.instruction_id, cp.start_seq, cp.persist_seqs, cp.exp_data_seqs, cp.info,
+            cp.sampling_type, cp.sampling_seq, cp.sampling_addr, cp.num_cp_entries)
+
+def count_chunks(fpath) -> int:
+    reader = CrashPlanStoreReader(fpath)
+    num = sum(len(x) for x in reader.op_chunks_map.values())
+    reader.close()
+    return num
+
+def test_header():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fpath = f'{tmp_dir}/{cp_store.CRASH_PLAN_STORE_FNAME}'
+        with CrashPlanStoreWriter(fpath) as writer:
+            writer.write_op(0, 'empty', iter([]))
+        with open(fpath, 'rb') as fd:
+            data = fd.read()
+        with CrashPlanStoreReader(fpath) as reader:
+            ok = data.startswith(cp_store.MAGIC)
+            ok = ok and reader.cp_types == list(CrashPlanType)
+            ok = ok and reader.sampling_types == list(CrashPlanSamplingType)
+            # an op without crash plans is still listed
+            ok = ok and reader.get_op_indices() == [0] and reader.get_num_crash_plans(0) == 0
+            ok = ok and reader.get_op_name(0) == 'empty' and list(reader.iter_crash_plans(0)) == []
+    log_result("test_header", ok)
+
+def test_varint():
+    ok = True
+    for value in [0, 1, 127, 128, 300, 1 << 35, 1 << 64, (1 << 100) + 7]:
+        buf = bytearray()
+        cp_store._put_uvarint(buf, value)
+        ok = ok and cp_store._get_uvarint(buf, 0) == (value, len(buf))
+        for signed_value in [value, -value]:
+            buf = bytearray()
+            cp_store._put_varint(buf, signed_value)
+            ok = ok and cp_store._get_varint(buf, 0) == (signed_value, len(buf))
+    buf = bytearray()
+    cp_store._put_uvarint(buf, 127)
+    ok = ok and len(buf) == 1
+    log_result("test_varint", ok)
+
+def test_chunks_and_random_access():
+    num_cps = 2 * cp_store.CHUNK_NUM_PLANS + 10
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fpath = f'{tmp_dir}/{cp_store.CRASH_PLAN_STORE_FNAME}'
+        seq_table = CrashPlanSeqTable()
+        cp_list = gen_crash_plans(0, num_cps, seq_table)
+        small_cp_list = gen_crash_plans(1, 5, CrashPlanSeqTable())
+        with CrashPlanStoreWriter(fpath) as writer:
+            ok = writer.write_op(1, 'write', iter(cp_list), seq_table) == num_cps
+            # the plans do not share the given table
+            ok = ok and writer.write_op(2, 'unlink', iter(small_cp_list)) == 5
+
+        ok = ok and count_chunks(fpath) == 4
+        with CrashPlanStoreReader(fpath) as reader:
+            ok = ok and reader.get_op_indices() == [1, 2]
+            ok = ok and reader.get_op_name(1) == 'write' and reader.get_num_crash_plans(1) == num_cps
+            ok = ok and reader.op_table_map[1].seq_list == seq_table.seq_list
+            ok = ok and [cp_fields(x) for x in reader.iter_crash_plans(1)] == [cp_fields(x) for x in cp_list]
+            ok = ok and [cp_fields(x) for x in reader.iter_crash_plans(2)] == [cp_fields(x) for x in small_cp_list]
+
+            rnd = random.Random(2)
+            cp_idx_list = [0, cp_store.CHUNK_NUM_PLANS - 1, cp_store.CHUNK_NUM_PLANS, num_cps - 1] + \
+                    [rnd.randrange(num_cps) for _ in range(100)]
+            for cp_idx in cp_idx_list:
+                ok = ok and cp_fields(reader.get_crash_plan(1, cp_idx)) == cp_fields(cp_list[cp_idx])
+            try:
+                reader.get_crash_plan(1, num_cps)
+                ok = False
+            except IndexError:
+                pass
+    log_result("test_chunks_and_random_access", ok)
+
+def test_rewritten_op():
+    '''An op written again (e.g., retesting the case) is read from its last copy.'''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fpath = f'{tmp_dir}/{cp_store.CRASH_PLAN_STORE_FNAME}'
+        seq_table = CrashPlanSeqTable()
+        old_cp_list = gen_crash_plans(3, cp_store.CHUNK_NUM_PLANS + 1, seq_table)
+        with CrashPlanStoreWriter(fpath) as writer:
+            writer.write_op(0, 'mkdir', iter(old_cp_list), seq_table)
+        seq_table = CrashPlanSeqTable()
+        new_cp_list = gen_crash_plans(4, 3, seq_table)
+        with CrashPlanStoreWriter(fpath) as writer:
+            writer.write_op(0, 'mkdir', iter(new_cp_list), seq_table)
+
+        with open(fpath, 'rb') as fd:
+            data = fd.read()
+        with CrashPlanStoreReader(fpath) as reader:
+            ok = data.count(cp_store.MAGIC) == 1
+            ok = ok and reader.get_num_crash_plans(0) == 3
+            ok = ok and [cp_fields(x) for x in reader.iter_crash_plans(0)] == [cp_fields(x) for x in new_cp_list]
+            ok = ok and cp_fields(reader.get_crash_plan(0, 2)) == cp_fields(new_cp_list[2])
+    log_result("test_rewritten_op", ok)
+
+def test_truncated_chunk():
+    '''The chunks before a truncated one, e.g., the writer was killed, are still read.'''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fpath = f'{tmp_dir}/{cp_store.CRASH_PLAN_STORE_FNAME}'
+        seq_table = CrashPlanSeqTable()
+        cp_list = gen_crash_plans(5, 10, seq_table)
+        with CrashPlanStoreWriter(fpath) as writer:
+            writer.write_op(0, 'create', iter(cp_list), seq_table)
+        size = os.path.getsize(fpath)
+        with CrashPlanStoreWriter(fpath) as writer:
+            writer.write_op(1, 'rename', iter(gen_crash_plans(6, 10, CrashPlanSeqTable())))
+        with open(fpath, 'r+b') as fd:
+            fd.truncate(size + cp_store.CHUNK_HEAD_BYTES + 5)
+
+        with CrashPlanStoreReader(fpath) as reader:
+            ok = reader.get_op_indices() == [0]
+            ok = ok and [cp_fields(x) for x in reader.iter_crash_plans(0)] == [cp_fields(x) for x in cp_list]
+    log_result("test_truncated_chunk", ok)
+
+def main():
+    init_log()
+    test_header()
+    test_varint()
+    test_chunks_and_random_access()
+    test_rewritten_op()
+    test_truncated_chunk()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import os
+import sys
+import time
+import hashlib
+import threading
+
+codebase_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../.."))
+sys.path.append(codebase_dir)
+
+from scripts.cache_sim.witcher.binary_file.binary_file import CowBinaryFile, DIGEST_BYTES
+from scripts.crash_plan.crash_plan_entry import CrashPlanEntry
+from scripts.crash_plan.crash_plan_type import CrashPlanType
+from scripts.trace_proc.trace_split.split_op_mgr import OpTraceEntry
+from scripts.trace_proc.trace_reader.trace_entry import TraceEntry
+import scripts.vm_comm.memcached_wrapper as mc_wrapper
+import scripts.utils.logger as log
+
+# The pending mark of a shared crash image expires in seconds, in case the vm
+# validating it is restarted and never sets the result.
+SHARED_PENDING_EXPIRE = 600
+SHARED_PENDING = 'pending'
+# The result of a shared crash image cannot be reused (e.g., the vm failed to
+# remount it and restarts), the other vms validate the image themselves.
+SHARED_INVALID = 'invalid'
+# A vm waits for the result of a crash image validated by another vm in
+# seconds, and validates it itself if the result is not set in time.
+SHARED_WAIT_TIMEOUT = 60
+SHARED_POLL_INTERVAL = 0.5
+
+class CrashImageCache:
+    '''
+    The validation results of the crash images of one operation. Different
+    crash plans (e.g., persist-self and persist-other, sampling variants) may
+    produce byte-identical crash images, the recovery of them is the same, so
+    that an image is mounted and checked once.
+    The key is the image digest, and the expected data sequences if the
+    recovered content is checked, since the content check depends on them.
+    The value is [ValidateRstType, other msg, existing key msg, recovered CtxFileReader].
+
+    If the memcached client is given, the results are also shared by all vms
+    of the campaign. The shared key covers everything the result depends on:
+    the image digest, the operation and its oracles, and the expected data.
+    The first vm adds a pending mark to the key and validates the image, the
+    other vms wait for its result, or validate the image themselves if the
+    result is not set in time (e.g., the first vm is restarted).
+    The shared value is [ValidateRstType value, existing key msg, recovered state digest].
+    The recovered state digest does not depend on the mount point (mnt_point)
+    and the device, so that it is comparable among vms.
+    '''
+    def __init__(self, memcached_client = None, mnt_point : str = None):
+        self.rst_map = dict()
+        # CrashPlanType : number of hits
+        self.hit_counts = dict()
+        self.lock = threading.Lock()
+
+        self.memcached_client = memcached_client
+        self.mnt_point = mnt_point
+        # CrashPlanType : number of crash plans validated by other vms
+        self.shared_hit_counts = dict()
+        # the digest of the operation and its oracles
+        self.op_digest = None
+        # cp_idx : the result validated in a batch, it is put to the cache
+        # after the syslog of the batch is checked
+        self.held_rst_map = dict()
+
+    def get_key(self, img : CowBinaryFile, cp : CrashPlanEntry):
+        exp_data_seqs = None
+        if not cp.type.no_content_to_check() and cp.exp_data_seqs:
+            exp_data_seqs = tuple(sorted(cp.exp_data_seqs))
+        return (img.digest(), exp_data_seqs)
+
+    def get(self, key, cp : CrashPlanEntry) -> list:
+        with self.lock:
+            value = self.rst_map.get(key)
+            if value != None:
+                self.hit_counts[cp.type] = self.hit_counts.get(cp.type, 0) + 1
+        if value != None and log.debug:
+            log_msg = f"crash image cache hit: {cp.type.value}, {key[0].hex()}, {value[0].value}"
+            log.global_logger.debug(log_msg)
+        return value
+
+    def put(self, key, rst, other_msg, existkey_msg, recovery_stat):
+        with self.lock:
+            self.rst_map[key] = [rst, other_msg, existkey_msg, recovery_stat]
+
+    def get_shared_key(self, img : CowBinaryFile, op_entry : OpTraceEntry, cp : CrashPlanEntry) -> str:
+        if self.op_digest == None:
+            h = hashlib.blake2b(op_entry.op_name.encode(), digest_size=DIGEST_BYTES)
+            h.update(''.join(op_entry.prev_op_oracle.lines).encode())
+            h.update(''.join(op_entry.post_op_oracle.lines).encode())
+            self.op_digest = h.digest()
+
+        h = hashlib.blake2b(self.op_digest, digest_size=DIGEST_BYTES)
+        h.update(img.digest())
+        if not cp.type.no_content_to_check() and cp.exp_data_seqs:
+            # the sequences differ among cases, use the expected data instead
+            for seq in sorted(cp.exp_data_seqs):
+                trace_entry : TraceEntry = op_entry.pm_seq_entry_map[seq][0]
+                h.update((trace_entry.addr - op_entry.pm_addr).to_bytes(8, 'little'))
+                h.update(trace_entry.size.to_bytes(8, 'little'))
+                h.update(trace_entry.ov_entry.data)
+                h.update(trace_entry.sv_entry.data)
+        return f'crash_image_rst.{h.hexdigest()}'
+
+    def acquire_shared(self, shared_key, cp : CrashPlanEntry) -> list:
+        '''
+        Return None if this vm needs to validate the crash image, otherwise the
+        shared value set by the vm that validated it.
+        '''
+        vm_id = mc_wrapper.glo_vm_id
+        deadline = time.monotonic() + SHARED_WAIT_TIMEOUT
+        while True:
+            value = mc_wrapper.mc_get_wrapper(self.memcached_client, shared_key)
+            if value == None:
+                # not validated yet, or the pending mark expired
+                if mc_wrapper.mc_add_wrapper(self.memcached_client, shared_key, [SHARED_PENDING, vm_id], expire=SHARED_PENDING_EXPIRE):
+                    return None
+            elif value[0] == SHARED_INVALID:
+                return None
+            elif value[0] != SHARED_PENDING:
+                break
+            elif value[1] == vm_id:
+                # retest after this vm is restarted
+                return None
+
+            if time.monotonic() >= deadline:
+                log_msg = f"wait for shared crash image timeout, validate it locally: {cp.type.value}, {shared_key}, {value}"
+                log.global_logger.warning(log_msg)
+                return None
+            time.sleep(SHARED_POLL_INTERVAL)
+
+        with self.lock:
+            self.shared_hit_counts[cp.type] = self.shared_hit_counts.get(cp.type, 0) + 1
+        if log.debug:
+            log_msg = f"shared crash image hit: {cp.type.value}, {shared_key}, {value[0]}"
+            log.global_logger.debug(log_msg)
+        return value
+
+    def get_stat_digest(self, recovery_stat) -> str:
+        '''The digest of the recovered state without the mount point and the device id.'''
+        h = hashlib.blake2b(digest_size=DIGEST_BYTES)
+        for line in recovery_stat.lines:
+            if line.startswith('File_RootDev ID'):
+                continue
+            if self.mnt_point and line.startswith('Path'):
+                line = line.replace(self.mnt_point, '', 1)
+            h.update(line.encode())
+        return h.hexdigest()
+
+    def put_shared(self, shared_key, rst, existkey_msg, recovery_stat):
+        if rst.cannot_continue_check():
+            mc_wrapper.mc_set_wrapper(self.memcached_client, shared_key, [SHARED_INVALID, mc_wrapper.glo_vm_id])
+            return
+        stat_digest = None
+        if recovery_stat:
+            stat_digest = self.get_stat_digest(recovery_stat)
+        value = [rst.value, existkey_msg, stat_digest]
+        mc_wrapper.mc_set_wrapper(self.memcached_client, shared_key, value)
+
+    def hold(self, cp_idx, key, shared_key, rst, other_msg, existkey_msg, recovery_stat):
+        with self.lock:
+            self.held_rst_map[cp_idx] = [key, shared_key, rst, other_msg, existkey_msg, recovery_stat]
+
+    def commit(self, cp_idx):
+        '''Put the held result of the crash plan to the cache.'''
+        with self.lock:
+            value = self.held_rst_map.pop(cp_idx, None)
+        if value == None:
+            return
+        key, shared_key, rst, other_msg, existkey_msg, recovery_stat = value
+        if not rst.cannot_continue_check():
+            self.put(key, rst, other_msg, existkey_msg, recovery_stat)
+        if shared_key:
+            self.put_shared(shared_key, rst, existkey_msg, recovery_stat)
+
+    def discard(self, cp_idx):
+        with self.lock:
+            self.held_rst_map.pop(cp_idx, None)
+
+    def send_to_memcached(self, memcached_client):
+        for tp, count in self.hit_counts.items():
+            tp : CrashPlanType
+            key = f'CrashImageCacheHit.{tp.value}.count'
+            mc_wrapper.mc_incr_deferred(memcached_client, key, count)
+        for tp, count in self.shared_hit_counts.items():
+            tp : CrashPlanType
+            key = f'CrashImageSharedHit.{tp.value}.count'
+            mc_wrapper.mc_incr_deferred(memcached_client, key, count)
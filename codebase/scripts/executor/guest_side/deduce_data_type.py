@@ -25,6 +25,7 @@ from scripts.crash_plan.crash_plan_scheme_base import CrashPlanSchemeBase
 from scripts.crash_plan.crash_plan_scheme_2cp import CrashPlanScheme2CP
 from scripts.utils.exceptions import GuestExceptionForDebug, GuestExceptionToRestartVM, GuestExceptionToRestoreSnapshot
 from scripts.trace_proc.trace_stinfo.stinfo_index import StInfoIndex
+import scripts.executor.guest_side.trace_info_cache as trace_info_cache
 import scripts.utils.logger as log
 
 def timeit(func):
@@ -38,6 +39,6 @@ def timeit(func):
 
 @timeit
 def deduce_data_type(env : EnvBase, trace_reader : TraceReader):
-    stinfo_reader = StructInfoReader(env.STRUCT_LAYOUT_FNAME())
+    stinfo_reader = trace_info_cache.get_struct_info_reader(env.STRUCT_LAYOUT_FNAME())
     stinfo_index = StInfoIndex(trace_reader, stinfo_reader)
     return stinfo_index
@@ -64,7 +64,7 @@ def proc_invariant_check_rst(memcached_client, tp: InvariantCheckErrorTypes, bas
 
         key = f'InvariantCheckErrorTypes.{tp.value}.{num}'
         value = [report_time, basename, op_name_list, err_list, other_msg]
-        mc_wrapper.mc_set_wrapper(memcached_client, key, value)
+        mc_wrapper.mc_set_deferred(memcached_client, key, value)
     else:
         # such information has been inserted, do not insert it again
         pass
@@ -2,6 +2,7 @@ import os
 import sys
 import time
 import traceback
+from collections import OrderedDict
 from pymemcache.client.base import Client as CMClient
 from pymemcache.client.base import PooledClient as CMPooledClient
 from pymemcache import serde as CMSerde
@@ -24,6 +25,7 @@ from scripts.vm_comm.heartbeat_guest import start_heartbeat_service, stop_heartb
 import scripts.vm_comm.memcached_lock as mc_lock
 import scripts.vm_comm.memcached_wrapper as mc_wrapper
 from scripts.utils.exceptions import GuestExceptionForDebug, GuestExceptionToRestartVM, GuestExceptionToRestoreSnapshot
+import scripts.executor.guest_side.trace_info_cache as trace_info_cache
 import scripts.utils.logger as log
 
 def timeit(func):
@@ -35,6 +37,29 @@ def timeit(func):
         return result
     return wrapper
 
+# The op hash keys that this guest has added to memcached or found there. A
+# key in memcached is never added again, thus the ops of these keys are known
+# duplicates and skip the mc_add. It is an exact LRU set rather than a bloom
+# filter, since a false positive would drop a unique op silently.
+# key : None
+SEEN_OP_HASH_CACHE_SIZE = 1 << 16
+_seen_op_hash_cache = OrderedDict()
+
+def _seen_op_hash(key) -> bool:
+    if key in _seen_op_hash_cache:
+        _seen_op_hash_cache.move_to_end(key)
+        return True
+    return False
+
+def _add_seen_op_hash(key):
+    _seen_op_hash_cache[key] = None
+    _seen_op_hash_cache.move_to_end(key)
+    if len(_seen_op_hash_cache) > SEEN_OP_HASH_CACHE_SIZE:
+        _seen_op_hash_cache.popitem(last=False)
+
+def clear_seen_op_hashes():
+    _seen_op_hash_cache.clear()
+
 @timeit
 def load_trace(env : EnvBase) -> TraceReader:
     trace_reader = TraceReader(env.DUMP_TRACE_FUNC_FNAME())
@@ -42,7 +67,7 @@ def load_trace(env : EnvBase) -> TraceReader:
 
 @timeit
 def split_trace_by_fs_op(env : EnvBase, trace_reader : TraceReader) -> SplitOpMgr:
-    vfs_op_info = SrcInfoReader(env.INFO_POSIX_FN_FNAME())
+    vfs_op_info = trace_info_cache.get_src_info_reader(env.INFO_POSIX_FN_FNAME())
     fs_op_mgr = SplitOpMgr(trace_reader, vfs_op_info)
     return fs_op_mgr
 
@@ -56,21 +81,79 @@ def fs_op_seq_id(op_trace : OpTraceEntry):
 def simple_hash(op_id):
     return hash(op_id)
 
-def atomic_get_unique_case_count(memcached_client : CMPooledClient):
+def atomic_get_unique_case_count(memcached_client : CMPooledClient, num = 1):
+    '''Reserve num unique case counts, return the last one.'''
     key = 'unique_case_count'
-    unique_case_count = mc_wrapper.mc_incr_wrapper(memcached_client, key, 1)
+    unique_case_count = mc_wrapper.mc_incr_wrapper(memcached_client, key, num)
     return unique_case_count
 
 @timeit
 def insert_unique_ops_to_memcached(basename : str, op_name_list : list, unique_op_indices : list, memcached_client : CMPooledClient):
-    # thread-safe
-    for idx in unique_op_indices:
-        unique_case_count = atomic_get_unique_case_count(memcached_client)
+    # thread-safe, the counts of the unique ops are reserved by one incr
+    last_count = atomic_get_unique_case_count(memcached_client, len(unique_op_indices))
+    key_value_map = dict()
+    for i, idx in enumerate(unique_op_indices):
+        unique_case_count = last_count - len(unique_op_indices) + 1 + i
         key = f'unique_fs_op.{unique_case_count}'
         value = [basename, op_name_list[:idx+1]]
-        mc_wrapper.mc_set_wrapper(memcached_client, key, value)
+        key_value_map[key] = value
+    mc_wrapper.mc_set_many_wrapper(memcached_client, key_value_map)
     return True
 
+def get_op_hash_key(op_trace : OpTraceEntry):
+    '''Ops without PM stores are never unique, return None for them.'''
+    if len(op_trace.pm_sorted_store_seq) == 0:
+        # no PM stores
+        return None
+
+    op_seq_id = fs_op_seq_id(op_trace)
+    op_seq_id = tuple(op_seq_id)
+    hash_value = simple_hash(op_seq_id)
+    return f'hash_{hash_value}'
+
+def add_op_hash_to_memcached(memcached_client : CMPooledClient, op_trace : OpTraceEntry) -> bool:
+    '''
+    Return True if this op is unique (i.e., no one has added it before).
+    Ops without PM stores are never unique.
+    '''
+    key = get_op_hash_key(op_trace)
+    if key == None or _seen_op_hash(key):
+        return False
+
+    value = 1
+
+    # someone added it if failed
+    added = mc_wrapper.mc_add_wrapper(memcached_client, key, value, noreply=False) == True
+    _add_seen_op_hash(key)
+    return added
+
+def add_op_hashes_to_memcached(memcached_client : CMPooledClient, op_trace_list : list) -> list:
+    '''
+    The same as add_op_hash_to_memcached for each op, but the hashes are added
+    in one pipelined round trip. If ops have the same hash, only the first one
+    can be unique, as adding them one by one. The known duplicates are not
+    sent to memcached.
+    '''
+    key_list = [get_op_hash_key(op_trace) for op_trace in op_trace_list]
+    new_key_map = {key : 1 for key in key_list if key != None and not _seen_op_hash(key)}
+    added_map = mc_wrapper.mc_add_many_wrapper(memcached_client, new_key_map)
+    for key in new_key_map:
+        _add_seen_op_hash(key)
+
+    if log.debug:
+        msg = f"dedup: {len(key_list)} ops, {len(new_key_map)} op hashes sent to memcached"
+        log.global_logger.debug(msg)
+
+    rst = []
+    visited_keys = set()
+    for key in key_list:
+        if key == None or key in visited_keys or key not in added_map:
+            rst.append(False)
+        else:
+            visited_keys.add(key)
+            rst.append(added_map[key] == True)
+    return rst
+
 @timeit
 def deduplicate(memcached_client : CMPooledClient, fs_op_mgr : SplitOpMgr, basename):
     # track prefix and current ops
@@ -78,27 +161,41 @@ def deduplicate(memcached_client : CMPooledClient, fs_op_mgr : SplitOpMgr, basen
     # the index to op_name_list to indicate which op is unique
     unique_op_indices = []
 
+    unique_list = add_op_hashes_to_memcached(memcached_client, fs_op_mgr.op_entry_list)
     for op_idx in range(len(fs_op_mgr.op_entry_list)):
-        op_trace = fs_op_mgr.op_entry_list[op_idx]
-
-        if len(op_trace.pm_sorted_store_seq) == 0:
-            # no PM stores
-            continue
+        if unique_list[op_idx]:
+            unique_op_indices.append(op_idx)
 
-        op_seq_id = fs_op_seq_id(op_trace)
-        op_seq_id = tuple(op_seq_id)
-        hash_value = simple_hash(op_seq_id)
+    if len(unique_op_indices) > 0:
+        insert_unique_ops_to_memcached(basename, op_name_list, unique_op_indices, memcached_client)
 
-        key = f'hash_{hash_value}'
-        value = 1
+    return unique_op_indices
 
-        if mc_wrapper.mc_add_wrapper(memcached_client, key, value, noreply=False) == True:
-            unique_op_indices.append(op_idx)
-        else:
-            # someone added it
-            continue
+@timeit
+def load_split_deduplicate(memcached_client : CMPooledClient, env : EnvBase, basename):
+    '''
+    Load and split the trace in one pass, then deduplicate all ops by one
+    pipelined add of their hashes. The ops are kept until the trace is read,
+    rather than deduplicated as soon as their end functions are read.
+    Return the trace reader, the op manager, and the unique op indices.
+    '''
+    trace_reader = TraceReader(env.DUMP_TRACE_FUNC_FNAME(), streaming=True)
+    vfs_op_info = trace_info_cache.get_src_info_reader(env.INFO_POSIX_FN_FNAME())
+    fs_op_mgr = SplitOpMgr(trace_reader, vfs_op_info, streaming=True)
+
+    # the hashes are added in one round trip after streaming, in the order the
+    # ops are read as adding them one by one
+    streamed_ops = list(fs_op_mgr.stream_ops())
+    unique_op_ids = set()
+    for op_trace, unique in zip(streamed_ops, add_op_hashes_to_memcached(memcached_client, streamed_ops)):
+        if unique:
+            unique_op_ids.add(id(op_trace))
+
+    # the op list is sorted by min seq after streaming
+    op_name_list = [x.op_name for x in fs_op_mgr.op_entry_list]
+    unique_op_indices = [op_idx for op_idx, op_trace in enumerate(fs_op_mgr.op_entry_list) if id(op_trace) in unique_op_ids]
 
     if len(unique_op_indices) > 0:
         insert_unique_ops_to_memcached(basename, op_name_list, unique_op_indices, memcached_client)
 
-    return unique_op_indices
+    return trace_reader, fs_op_mgr, unique_op_indices
@@ -44,7 +44,7 @@ def put_trace_to_img(img : MemBinaryFile, trace_reader : TraceReader, start_seq,
     The start seq is included.
     The end seq is not included.
     '''
-    count = 0
+    stores = []
     for seq in trace_reader.pm_store_seq_list:
         if seq < start_seq:
             continue
@@ -52,15 +52,17 @@ def put_trace_to_img(img : MemBinaryFile, trace_reader : TraceReader, start_seq,
             break
 
         op : TraceEntry = trace_reader.seq_entry_map[seq][0]
-        if op.type.isStoreSeries() and op.sv_entry:
-            count += 1
-            img.do_store_direct(op.addr - trace_reader.pm_addr, op.addr + op.size - trace_reader.pm_addr, op.sv_entry.data)
+        sv_entry = op.sv_entry
+        if op.type.isStoreSeries() and sv_entry:
+            stores.append((op.addr - trace_reader.pm_addr, op.addr + op.size - trace_reader.pm_addr, sv_entry.data))
         else:
-            msg = f"The trace record is not store or does not have stored value: {op}, {op.sv_entry}"
+            msg = f"The trace record is not store or does not have stored value: {op}, {sv_entry}"
             log.global_logger.error(msg)
+    img.do_stores_direct(stores)
 
-    msg = f"stored {count} trace records out of {len(trace_reader.pm_store_seq_list)}"
-    log.global_logger.debug(msg)
+    if log.debug:
+        msg = f"stored {len(stores)} trace records out of {len(trace_reader.pm_store_seq_list)}"
+        log.global_logger.debug(msg)
 
 # @timeit
 # do not timing it since the elapsed time is ~68 macroseconds, which is less than the time to send msg to the server (~140 macroseconds).
@@ -70,7 +72,7 @@ def put_op_trace_to_img(img : MemBinaryFile, op_entry : OpTraceEntry, start_seq,
     The start seq is included.
     The end seq is not included.
     '''
-    count = 0
+    stores = []
     for seq in op_entry.pm_sorted_store_seq:
         if seq < start_seq:
             continue
@@ -78,23 +80,28 @@ def put_op_trace_to_img(img : MemBinaryFile, op_entry : OpTraceEntry, start_seq,
             break
 
         op : TraceEntry = op_entry.pm_seq_entry_map[seq][0]
-        if op.type.isStoreSeries() and op.sv_entry:
-            count += 1
-            img.do_store_direct(op.addr - op_entry.pm_addr, op.addr + op.size - op_entry.pm_addr, op.sv_entry.data)
+        sv_entry = op.sv_entry
+        if op.type.isStoreSeries() and sv_entry:
+            stores.append((op.addr - op_entry.pm_addr, op.addr + op.size - op_entry.pm_addr, sv_entry.data))
         else:
-            msg = f"The trace record is not store or does not have stored value: {op}, {op.sv_entry}"
+            msg = f"The trace record is not store or does not have stored value: {op}, {sv_entry}"
             log.global_logger.error(msg)
+    img.do_stores_direct(stores)
 
-    msg = f"stored {count} trace records out of {len(op_entry.pm_sorted_store_seq)}"
-    log.global_logger.debug(msg)
+    if log.debug:
+        msg = f"stored {len(stores)} trace records out of {len(op_entry.pm_sorted_store_seq)}"
+        log.global_logger.debug(msg)
 
 # @timeit
 # do not timing it since the elapsed time is ~122 macroseconds, which is less than the time to send msg to the server (~140 macroseconds).
 def put_cp_to_img(img : MemBinaryFile, op_entry : OpTraceEntry, cp : CrashPlanEntry) -> CrashPlanSchemeBase:
+    stores = []
+    # decode the bitmask once
+    persist_seqs = cp.persist_seqs
     for seq in op_entry.pm_sorted_store_seq:
         if seq < cp.start_seq:
             op : TraceEntry = op_entry.pm_seq_entry_map[seq][0]
-            img.do_store_direct(op.addr - op_entry.pm_addr, op.addr + op.size - op_entry.pm_addr, op.sv_entry.data)
+            stores.append((op.addr - op_entry.pm_addr, op.addr + op.size - op_entry.pm_addr, op.sv_entry.data))
 
         elif cp.sampling_type != CrashPlanSamplingType.SamplingNone and seq == cp.sampling_seq:
             op : TraceEntry = op_entry.pm_seq_entry_map[seq][0]
@@ -106,11 +113,13 @@ def put_cp_to_img(img : MemBinaryFile, op_entry : OpTraceEntry, cp : CrashPlanEn
                 upper_addr = alignToFloor(upper_addr, ATOMIC_WRITE_BYTES)
             if upper_addr > op.addr + op.size or upper_addr < lower_addr:
                 upper_addr = op.addr + op.size
-            img.do_store_direct(lower_addr - op_entry.pm_addr, upper_addr - op_entry.pm_addr, op.sv_entry.data)
+            stores.append((lower_addr - op_entry.pm_addr, upper_addr - op_entry.pm_addr, op.sv_entry.data))
 
-            msg = f"sampling data in image: [{lower_addr:#f}, {upper_addr:#f}); the op: [{op.addr:#f}, {op.addr + op.size:#f})"
-            log.global_logger.debug(msg)
+            if log.debug:
+                msg = f"sampling data in image: [{lower_addr:#f}, {upper_addr:#f}); the op: [{op.addr:#f}, {op.addr + op.size:#f})"
+                log.global_logger.debug(msg)
 
-        elif seq in cp.persist_seqs:
+        elif seq in persist_seqs:
             op : TraceEntry = op_entry.pm_seq_entry_map[seq][0]
-            img.do_store_direct(op.addr - op_entry.pm_addr, op.addr + op.size - op_entry.pm_addr, op.sv_entry.data)
+            stores.append((op.addr - op_entry.pm_addr, op.addr + op.size - op_entry.pm_addr, op.sv_entry.data))
+    img.do_stores_direct(stores)
@@ -1,7 +1,11 @@
 import os
 import sys
 import time
+import copy
+import pickle
 import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pymemcache.client.base import Client as CMClient
 from pymemcache.client.base import PooledClient as CMPooledClient
 from pymemcache import serde as CMSerde
@@ -40,26 +44,104 @@ def timeit(func):
         return result
     return wrapper
 
-@timeit
-def generate_crash_plans(trace_reader : TraceReader, stinfo_index : StInfoIndex, op_entry : OpTraceEntry, mech_deduce : DeduceMech, scheme : str, ignore_nonatomic_write : bool, nonatomic_as_one : bool, sampling_nonatomic_write : bool) -> CrashPlanSchemeBase:
+def _create_crash_plan_scheme(trace_reader : TraceReader, stinfo_index : StInfoIndex, op_entry : OpTraceEntry, mech_deduce : DeduceMech, scheme : str, cp_budget : int) -> CrashPlanSchemeBase:
     crash_plan_scheme = None
     if scheme.lower() == '2cp':
         crash_plan_scheme = CrashPlanScheme2CP(op_entry, mech_deduce)
-        crash_plan_scheme.generate_crash_plans(ignore_nonatomic_write, nonatomic_as_one, sampling_nonatomic_write)
     elif scheme.lower() == 'comb':
         crash_plan_scheme = CrashPlanSchemeComb(op_entry)
-        crash_plan_scheme.generate_crash_plans(ignore_nonatomic_write, nonatomic_as_one, sampling_nonatomic_write)
     elif scheme.lower() == 'mech2cp':
         crash_plan_scheme = CrashPlanSchemeMech2CP(trace_reader, stinfo_index, op_entry, mech_deduce)
-        crash_plan_scheme.generate_crash_plans(ignore_nonatomic_write, nonatomic_as_one, sampling_nonatomic_write)
-        # comment the below line if not debugging the information
-        crash_plan_scheme.sending_details_to_mc(trace_reader, op_entry)
     elif scheme.lower() == 'mechcomb':
         crash_plan_scheme = CrashPlanSchemeMechComb(trace_reader, stinfo_index, op_entry, mech_deduce)
-        crash_plan_scheme.generate_crash_plans(ignore_nonatomic_write, nonatomic_as_one, sampling_nonatomic_write)
-        # comment the below line if not debugging the information
-        crash_plan_scheme.sending_details_to_mc(trace_reader, op_entry)
     else:
         raise NotImplementedError(f"Not implemented: {scheme}")
+    crash_plan_scheme.cp_budget = cp_budget
+    return crash_plan_scheme
+
+def _send_details_to_mc(crash_plan_scheme : CrashPlanSchemeBase, trace_reader : TraceReader, op_entry : OpTraceEntry, scheme : str):
+    if scheme.lower() in ['mech2cp', 'mechcomb']:
+        # comment the below line if not debugging the information
+        crash_plan_scheme.sending_details_to_mc(trace_reader, op_entry)
+
+@timeit
+def generate_crash_plans(trace_reader : TraceReader, stinfo_index : StInfoIndex, op_entry : OpTraceEntry, mech_deduce : DeduceMech, scheme : str, ignore_nonatomic_write : bool, nonatomic_as_one : bool, sampling_nonatomic_write : bool, cp_budget : int = 0) -> CrashPlanSchemeBase:
+    crash_plan_scheme = _create_crash_plan_scheme(trace_reader, stinfo_index, op_entry, mech_deduce, scheme, cp_budget)
+    crash_plan_scheme.generate_crash_plans(ignore_nonatomic_write, nonatomic_as_one, sampling_nonatomic_write)
+    _send_details_to_mc(crash_plan_scheme, trace_reader, op_entry, scheme)
+    return crash_plan_scheme
 
+def _generate_crash_plans_in_worker(scheme_data : bytes, ignore_nonatomic_write : bool, nonatomic_as_one : bool, sampling_nonatomic_write : bool) -> CrashPlanSchemeBase:
+    crash_plan_scheme : CrashPlanSchemeBase = pickle.loads(scheme_data)
+    crash_plan_scheme.generate_crash_plans(ignore_nonatomic_write, nonatomic_as_one, sampling_nonatomic_write)
     return crash_plan_scheme
+
+class CrashPlanGenPool:
+    '''
+    Generate the crash plans of the unique operations of a test case in a process
+    pool. The mechanisms are deduced in the caller in the operation order, since
+    the deduction updates the cheat sheets. Then the scheme, with the op entry
+    and the deduced mechanisms, is shipped to a worker, without the trace reader,
+    the structure index and the memcached client, which are put back when the
+    generated scheme is got. The schemes are got by the op index, so that the
+    crash plans are validated in the operation order as before.
+    '''
+    # the attributes of a scheme that are not shipped to the workers
+    unshipped_attrs = ['trace_reader', 'stinfo_index']
+
+    def __init__(self, num_workers : int):
+        # fork the workers, so that they inherit the loggers
+        self.pool = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('fork'))
+        # op_idx : [future, scheme, op_entry, mech_deduce, unshipped attributes]
+        self.op_idx_future_map = dict()
+
+    @timeit
+    def submit(self, op_idx : int, trace_reader : TraceReader, stinfo_index : StInfoIndex, op_entry : OpTraceEntry, mech_deduce : DeduceMech, scheme : str, ignore_nonatomic_write : bool, nonatomic_as_one : bool, sampling_nonatomic_write : bool, cp_budget : int = 0):
+        '''Deduce the mechanisms of the op, then generate its crash plans in a worker.'''
+        crash_plan_scheme = _create_crash_plan_scheme(trace_reader, stinfo_index, op_entry, mech_deduce, scheme, cp_budget)
+        if hasattr(crash_plan_scheme, 'deduce_mech'):
+            crash_plan_scheme.deduce_mech()
+
+        unshipped = dict()
+        for attr in self.unshipped_attrs:
+            if hasattr(crash_plan_scheme, attr):
+                unshipped[attr] = getattr(crash_plan_scheme, attr)
+                setattr(crash_plan_scheme, attr, None)
+        if hasattr(crash_plan_scheme, 'mech_deduce'):
+            # the caller cleans the mech_deduce for the next op, keep the
+            # deduced mechanisms of this op in a copy.
+            mech_deduce = copy.copy(mech_deduce)
+            mech_deduce.memcached_client = None
+            crash_plan_scheme.mech_deduce = mech_deduce
+
+        # the copy shares the reasons and the cheat sheets, which the caller
+        # updates for the next ops while the pool pickles the work items in its
+        # own thread. Pickle the scheme here so that the worker gets this op's state.
+        scheme_data = pickle.dumps(crash_plan_scheme)
+        future = self.pool.submit(_generate_crash_plans_in_worker, scheme_data, ignore_nonatomic_write, nonatomic_as_one, sampling_nonatomic_write)
+        self.op_idx_future_map[op_idx] = [future, scheme, op_entry, mech_deduce, unshipped]
+
+    @timeit
+    def get(self, op_idx : int, memcached_client) -> CrashPlanSchemeBase:
+        '''Wait for the crash plans of the op, the exception of the worker is raised here.'''
+        future, scheme, op_entry, mech_deduce, unshipped = self.op_idx_future_map.pop(op_idx)
+        crash_plan_scheme : CrashPlanSchemeBase = future.result()
+
+        crash_plan_scheme.op_entry = op_entry
+        for attr, value in unshipped.items():
+            setattr(crash_plan_scheme, attr, value)
+        if hasattr(crash_plan_scheme, 'mech_deduce'):
+            crash_plan_scheme.mech_deduce.memcached_client = memcached_client
+
+        _send_details_to_mc(crash_plan_scheme, unshipped.get('trace_reader'), op_entry, scheme)
+        return crash_plan_scheme
+
+    def clear(self):
+        '''Drop the crash plans that are not got (e.g., the oracle is missing).'''
+        for future, _, _, _, _ in self.op_idx_future_map.values():
+            future.cancel()
+        self.op_idx_future_map = dict()
+
+    def shutdown(self):
+        self.clear()
+        self.pool.shutdown()
@@ -14,6 +14,7 @@ import glob
 import copy
 import random
 import signal
+from concurrent.futures import ThreadPoolExecutor
 from pymemcache.client.base import Client as CMClient
 from pymemcache.client.base import PooledClient as CMPooledClient
 from pymemcache import serde as CMSerde
@@ -53,8 +54,11 @@ from scripts.cheat_sheet.winefs.cheat_winefs import CheatSheetWineFS
 from scripts.utils.exceptions import GuestExceptionToRestoreSnapshot, GuestExceptionForDebug, GuestExceptionToRestartVM
 import scripts.executor.guest_side.tracing as tracing
 import scripts.executor.guest_side.dedup as dedup
+import scripts.executor.guest_side.trace_info_cache as trace_info_cache
 from scripts.crash_plan.crash_plan_entry import CrashPlanEntry
+from scripts.crash_plan.crash_plan_store import CRASH_PLAN_STORE_FNAME
 from scripts.executor.guest_side.deduce_mech import DeduceMech
+from scripts.executor.guest_side.crash_image_cache import CrashImageCache
 import scripts.executor.guest_side.deduce_data_type as deducedatatype
 import scripts.executor.guest_side.generate_crash_plan as crashplan
 import scripts.executor.guest_side.generate_crash_image as crashimage
@@ -83,6 +87,15 @@ def parse_args():
                         required=True,
                         choices=['2cp', 'comb', 'mech2cp', 'mechcomb'],
                         help="The scheme to generate crash plans.")
+    parser.add_argument("--crash_plan_budget", type=int,
+                        required=False, default=0,
+                        help="The max number of store combinations of a combination group of crash plans (e.g., mechcomb). The combinations are sampled if there are more. 0 means no limit.")
+    parser.add_argument("--crash_plan_workers", type=int,
+                        required=False, default=0,
+                        help="The number of processes to generate the crash plans of the unique operations of a test case concurrently. 0 or 1 means generating them one by one in the main process.")
+    parser.add_argument("--not_batch_memcached", type=lambda x: bool(strtobool(x)),
+                        required=False, default=False,
+                        help="If enabled, the reports and the counters are sent to memcached one by one instead of being batched.")
     parser.add_argument("--dump_crash_plan_to_disk", type=lambda x: bool(strtobool(x)),
                         required=False, default=False,
                         help="If enabled, the generated crash plans will be written to disk.")
@@ -101,6 +114,12 @@ def parse_args():
     parser.add_argument("--not_dedup_test_last", type=lambda x: bool(strtobool(x)),
                         required=False, default=True,
                         help="If enabled, the deduplication process will not be performed and only test the last meaningful operation of a test case.")
+    parser.add_argument("--not_cache_crash_image", type=lambda x: bool(strtobool(x)),
+                        required=False, default=False,
+                        help="If enabled, byte-identical crash images of an operation are validated repeatedly instead of reusing the validation result.")
+    parser.add_argument("--not_share_crash_image_rst", type=lambda x: bool(strtobool(x)),
+                        required=False, default=False,
+                        help="If enabled, the crash images validated by other VMs are validated again. Only works when not_cache_crash_image is False.")
     parser.add_argument("--keep_intermidiate_result", type=lambda x: bool(strtobool(x)),
                         required=False, default=False,
                         help="If enabled, the intermidiate result (e.g., execution trace, crash plans) of each test case will be kept (be careful of the mount point space).")
@@ -234,6 +253,8 @@ class GuestProc:
 
         # since multiple threads use this same client, init with a pooled client.
         self.memcached_client : any[CMClient, CMPooledClient] = mc_wrapper.setup_memcached_pooled_client(self.env.MEMCACHED_IP_ADDRESS_GUEST(), self.env.MEMCACHED_PORT(), vm_id=self.vm_id)
+        if not self.args.not_batch_memcached:
+            mc_wrapper.setup_memcached_batch_client(self.memcached_client)
 
         # set ramfs and directory to store result
         self.result_dir = self.env.GUEST_RESULT_STORE_DIR()
@@ -245,10 +266,24 @@ class GuestProc:
         # init heartbeat
         self._init_heartbeat()
 
+        # the PM devices and mount points to validate crash plans
+        self.validation_dev_paths = self.env.VALIDATION_DEV_PATHS()
+        self.validation_mnt_points = self.env.VALIDATION_MNT_POINTS()
+        self.validation_pool = None
+
+        # the processes to generate crash plans of unique operations concurrently
+        self.cp_gen_pool = None
+        if self.args.crash_plan_workers > 1:
+            self.cp_gen_pool = crashplan.CrashPlanGenPool(self.args.crash_plan_workers)
+
         # init the file system module
         self.fs_module = None
         self._init_fs_module()
 
+        # the devices that failed to set up are dropped by _init_fs_module
+        if len(self.validation_dev_paths) > 1:
+            self.validation_pool = ThreadPoolExecutor(max_workers=len(self.validation_dev_paths))
+
         # get executable files
         self.exec_file_list = []
         # Sometimes, the VM may crash during testing a test case.
@@ -286,6 +321,8 @@ class GuestProc:
 
         # clean up all mounted FS and modules
         self.fs_module.unmount_fs()
+        for mnt_point in self.validation_mnt_points[1:]:
+            self.fs_module.unmount_fs(mnt_point)
         self.fs_module.remove_module()
 
         # Create pmem namespace.
@@ -297,6 +334,43 @@ class GuestProc:
             log.global_logger.critical(msg)
             raise GuestExceptionForDebug
 
+        # The extra validation devices are optional, validate with fewer devices
+        # from the first one that cannot be set up (e.g., the vm has fewer PM regions).
+        for i in range(1, len(self.validation_dev_paths)):
+            if not self._init_validation_dev(i):
+                msg = f"validate crash plans with {i} PM devices rather than {len(self.validation_dev_paths)}"
+                log.global_logger.warning(msg)
+                self.validation_dev_paths = self.validation_dev_paths[:i]
+                self.validation_mnt_points = self.validation_mnt_points[:i]
+                break
+
+    @timeit
+    def _init_validation_dev(self, i) -> bool:
+        '''Create the namespace and the mount point of the i-th validation device.'''
+        cmd = f'sudo ndctl list -n namespace{i}.0'
+        cl_state = shell_cl_local_run(cmd, ttl=30, crash_on_err=False)
+        if cl_state.code != 0 or not cl_state.stdout or not cl_state.stdout.strip():
+            msg = f"no PM namespace{i}.0 for {self.validation_dev_paths[i]}"
+            log.global_logger.warning(msg)
+            return False
+
+        cmd = f'sudo ndctl create-namespace -t pmem -m fsdax -f -e namespace{i}.0'
+        cl_state = shell_cl_local_run(cmd, ttl=90, crash_on_err=False)
+        if cl_state.code != 0:
+            log.global_logger.warning(cl_state.msg("Create PM namespace failed: "))
+            return False
+        if not os.path.exists(self.validation_dev_paths[i]):
+            msg = f"no device {self.validation_dev_paths[i]} after creating namespace{i}.0"
+            log.global_logger.warning(msg)
+            return False
+
+        cmd = f'sudo mkdir -p {self.validation_mnt_points[i]}'
+        cl_state = shell_cl_local_run(cmd, ttl=10, crash_on_err=False)
+        if cl_state.code != 0:
+            log.global_logger.warning(cl_state.msg("Create mount point failed: "))
+            return False
+        return True
+
     @timeit
     def _init_test_cases(self):
         found_retest_exec = False
@@ -370,6 +444,8 @@ class GuestProc:
         mc_wrapper.mc_set_wrapper(self.memcached_client, key, value)
 
     def set_case_end(self, basename):
+        # the reports of the case are sent before the end of the case
+        mc_wrapper.mc_flush_deferred()
         key = f'{self.vm_id}.end'
         value = [basename, getTimestamp()]
         mc_wrapper.mc_set_wrapper(self.memcached_client, key, value)
@@ -389,9 +465,17 @@ class GuestProc:
         else:
             return None, None
 
+    def _get_fillfull_seqs(self, trace_reader : TraceReader, fs_op_mgr : SplitOpMgr, unique_op_indices):
+        '''The PM stores of the mount prefix and of the unique operations.'''
+        # the mount prefix is put to the image before testing operations
+        seqs = set(trace_reader.pm_store_seqs_before(fs_op_mgr.op_entry_list[0].min_seq))
+        for op_idx in unique_op_indices:
+            seqs.update(fs_op_mgr.op_entry_list[op_idx].pm_sorted_store_seq)
+        return seqs
+
     @timeit
-    def _fillfull_trace(self,  trace_reader : TraceReader, value_reader, instid_srcloc_reader):
-        trace_reader.merge_value_entries(value_reader)
+    def _fillfull_trace(self,  trace_reader : TraceReader, value_reader, instid_srcloc_reader, seqs = None):
+        trace_reader.merge_value_entries(value_reader, seqs)
         trace_reader.merge_srcloc_entries(instid_srcloc_reader)
 
     @timeit
@@ -453,8 +537,8 @@ class GuestProc:
     @timeit
     def load_other_trace_info(self):
         value_reader = TraceValueReader(self.env.DUMP_TRACE_SV_FNAME())
-        instid_srcloc_reader = InstIdSrcLocReader(self.env.INSTID_SRCLOC_MAP_FPATH())
-        stinfo_reader = StructInfoReader(self.env.STRUCT_LAYOUT_FNAME())
+        instid_srcloc_reader = trace_info_cache.get_instid_srcloc_reader(self.env.INSTID_SRCLOC_MAP_FPATH())
+        stinfo_reader = trace_info_cache.get_struct_info_reader(self.env.STRUCT_LAYOUT_FNAME())
         return value_reader, instid_srcloc_reader, stinfo_reader
 
     @timeit
@@ -477,21 +561,68 @@ class GuestProc:
         # value = op_entry.get_cache_analysis_result()
         # value = [os.path.basename(case_dir), op_name_list, value]
         value = [report_time, os.path.basename(case_dir), op_name_list, op_entry.in_fight_store_num, op_entry.num_cps_map, op_entry.mem_copy_list, op_entry.mem_set_list, op_entry.dup_flushes, op_entry.dup_fences, op_entry.unflushed_stores]
-        mc_wrapper.mc_set_wrapper(self.memcached_client, key, value)
+        mc_wrapper.mc_set_deferred(self.memcached_client, key, value)
 
     @timeit
     def cache_sim_analysis(self, op_entry : OpTraceEntry):
         cache = WitcherCache(EmptyBinaryFile())
         op_entry.analysis_in_cache_run(cache, ignore_nonatomic_write=False, nonatomic_as_one=True, sampling_nonatomic_write=False)
 
+    def cache_sim_analysis_and_report(self, case_dir, op_idx, op_entry : OpTraceEntry, op_name_list):
+        self.cache_sim_analysis(op_entry)
+        self.set_cache_sim_result_to_mc(case_dir, op_entry, op_name_list[:op_idx+1])
+        if self.args.keep_intermidiate_result:
+            self.write_cache_sim_result_to_local_file(case_dir, op_idx, op_entry)
+
     @timeit
-    def validating_cps(self, cp_scheme, case_dir, mem_image, op_entry, op_name_list, op_idx):
-        for cp_idx in range(len(cp_scheme.cp_entry_list)):
-            cp : CrashPlanEntry = cp_scheme.cp_entry_list[cp_idx]
-            if cp.type.dummy_crash_plan():
-                # cannot validate dummy crash plan
+    def prefetch_crash_plans(self, basename, case_dir, trace_reader : TraceReader, stinfo_index : StInfoIndex, mech_deduce : DeduceMech, fs_op_mgr : SplitOpMgr, unique_op_indices, op_name_list):
+        '''
+        Run the cache simulation and deduce the mechanisms of the ops in order,
+        and submit the crash plan generation of the unique ops to cp_gen_pool.
+        The validation loop gets the crash plans from cp_gen_pool by op_idx.
+        '''
+        self.cp_gen_pool.clear()
+        for op_idx in range(len(fs_op_mgr.op_entry_list)):
+            op_entry : OpTraceEntry = fs_op_mgr.op_entry_list[op_idx]
+            if self.args.skip_umount and 'put_super' in op_entry.op_name:
                 continue
-            validator.validate_crash_image(self.fs_module, self.env, self.memcached_client, case_dir, mem_image, op_entry, op_name_list[:op_idx+1], op_idx, cp, len(cp_scheme.cp_entry_list), cp_idx, self.args.dump_disk_content_to_disk, self.args.dump_crash_image_to_disk)
+
+            if op_idx not in unique_op_indices or len(op_entry.pm_sorted_store_seq) == 0:
+                if self.require_mech:
+                    # even if this operation is not a unique operation, we still would like to update necessary mech cheatsheet
+                    mech_deduce.update_necessary_computations(None, op_entry=op_entry, start_seq=op_entry.min_seq, end_seq=op_entry.max_seq, is_mount_op=False)
+                continue
+
+            self.cache_sim_analysis_and_report(case_dir, op_idx, op_entry, op_name_list)
+
+            mech_deduce.clean()
+            mech_deduce.set_info(basename, op_name_list[:op_idx+1])
+            self.cp_gen_pool.submit(op_idx, trace_reader, stinfo_index, op_entry, mech_deduce, self.crash_plan_scheme, ignore_nonatomic_write=False, nonatomic_as_one=False, sampling_nonatomic_write=True, cp_budget=self.args.crash_plan_budget)
+
+    @timeit
+    def validating_cps(self, cp_scheme, case_dir, mem_image, op_entry, op_name_list, op_idx):
+        # the results of the crash images of this operation, shared by all vms
+        img_cache = None
+        if not self.args.not_cache_crash_image:
+            img_cache = CrashImageCache(None if self.args.not_share_crash_image_rst else self.memcached_client, self.env.MOD_MNT_POINT())
+
+        # the crash plans of some schemes are generated on the fly, they are
+        # counted without generating them, thus total_cps is an upper bound.
+        total_cps = cp_scheme.get_num_crash_plans()
+        if self.validation_pool:
+            # validate crash plans concurrently on multiple PM devices
+            cp_list = ([cp_idx, cp] for cp_idx, cp in cp_scheme.iter_crash_plans() if not cp.type.dummy_crash_plan())
+            validator.validate_crash_images(self.fs_module, self.env, self.memcached_client, case_dir, mem_image, op_entry, op_name_list[:op_idx+1], op_idx, cp_list, total_cps, self.args.dump_disk_content_to_disk, self.args.dump_crash_image_to_disk, self.validation_pool, self.validation_dev_paths, self.validation_mnt_points, img_cache)
+        else:
+            for cp_idx, cp in cp_scheme.iter_crash_plans():
+                cp : CrashPlanEntry
+                if cp.type.dummy_crash_plan():
+                    # cannot validate dummy crash plan
+                    continue
+                validator.validate_crash_image(self.fs_module, self.env, self.memcached_client, case_dir, mem_image, op_entry, op_name_list[:op_idx+1], op_idx, cp, total_cps, cp_idx, self.args.dump_disk_content_to_disk, self.args.dump_crash_image_to_disk, img_cache)
+
+        if img_cache:
+            img_cache.send_to_memcached(self.memcached_client)
 
     @timeit
     def run_one_case_main(self, basename, fpath, case_dir, unique_op_indices):
@@ -522,13 +653,19 @@ class GuestProc:
             return True, ''
 
         # 2. load trace and do some preprocessing
-        trace_reader : TraceReader = dedup.load_trace(self.env)
-        fs_op_mgr : SplitOpMgr = dedup.split_trace_by_fs_op(self.env, trace_reader)
+        # 3. deduplicate
+        # when deduplicating, ops are checked once they are split while loading the trace
+        trace_reader : TraceReader = None
+        fs_op_mgr : SplitOpMgr = None
+        if not args.not_dedup and unique_op_indices == None:
+            trace_reader, fs_op_mgr, unique_op_indices = dedup.load_split_deduplicate(self.memcached_client, self.env, basename)
+        else:
+            trace_reader = dedup.load_trace(self.env)
+            fs_op_mgr = dedup.split_trace_by_fs_op(self.env, trace_reader)
 
         if len(fs_op_mgr.op_entry_list) == 0:
             return True, ''
 
-        # 3. deduplicate
         if args.not_dedup:
             if unique_op_indices == None:
                 unique_op_indices = []
@@ -557,9 +694,6 @@ class GuestProc:
             log.global_logger.debug(msg)
 
         else:
-            if unique_op_indices == None:
-                unique_op_indices = dedup.deduplicate(self.memcached_client, fs_op_mgr, basename)
-
             if len(unique_op_indices) == 0:
                 # no unique operations need to investigate
                 return True, ''
@@ -575,8 +709,10 @@ class GuestProc:
         instid_srcloc_reader : InstIdSrcLocReader
         stinfo_reader : StructInfoReader
 
-        # 5. merge stored value and source location to the trace
-        self._fillfull_trace(trace_reader, value_reader, instid_srcloc_reader)
+        # 5. merge stored value and source location to the trace, only for the
+        #    PM stores that will be put to the images
+        fillfull_seqs = self._get_fillfull_seqs(trace_reader, fs_op_mgr, unique_op_indices)
+        self._fillfull_trace(trace_reader, value_reader, instid_srcloc_reader, fillfull_seqs)
 
         # 6. deduce the data type for trace
         stinfo_index : StInfoIndex = deducedatatype.deduce_data_type(self.env, trace_reader)
@@ -598,6 +734,13 @@ class GuestProc:
         mem_image = MemBinaryFile(basename, map_base=trace_reader.pm_addr, pmsize=trace_reader.pm_size)
         crashimage.put_trace_to_img(mem_image, trace_reader, 0, fs_op_mgr.op_entry_list[0].min_seq)
 
+        # generate the crash plans of all unique ops in the process pool
+        # before validating them one by one
+        prefetched = False
+        if self.cp_gen_pool and not self.args.stop_after_cache_sim:
+            self.prefetch_crash_plans(basename, case_dir, trace_reader, stinfo_index, mech_deduce, fs_op_mgr, unique_op_indices, op_name_list)
+            prefetched = True
+
         # iterate each op
         for op_idx in range(len(fs_op_mgr.op_entry_list)):
             op_entry : OpTraceEntry = fs_op_mgr.op_entry_list[op_idx]
@@ -609,7 +752,7 @@ class GuestProc:
                     continue
 
                 if op_idx not in unique_op_indices or len(op_entry.pm_sorted_store_seq) == 0:
-                    if self.require_mech:
+                    if self.require_mech and not prefetched:
                         # even if this operation is not a unique operation, we still would like to update necessary mech cheatsheet
                         mech_deduce.update_necessary_computations(None, op_entry=op_entry, start_seq=op_entry.min_seq, end_seq=op_entry.max_seq, is_mount_op=False)
                     continue
@@ -618,10 +761,8 @@ class GuestProc:
                 log.global_logger.debug(msg)
 
                 # 8. generate performance bug and in-flight cluster maps
-                self.cache_sim_analysis(op_entry)
-                self.set_cache_sim_result_to_mc(case_dir, op_entry, op_name_list[:op_idx+1])
-                if self.args.keep_intermidiate_result:
-                    self.write_cache_sim_result_to_local_file(case_dir, op_idx, op_entry)
+                if not prefetched:
+                    self.cache_sim_analysis_and_report(case_dir, op_idx, op_entry, op_name_list)
 
                 if self.args.stop_after_cache_sim:
                     continue
@@ -641,14 +782,17 @@ class GuestProc:
                     validator.dump_ctx_to_disk(fpath, op_entry.post_op_oracle)
 
                 # 10. generate crash plans
-                mech_deduce.clean()
-                mech_deduce.set_info(basename, op_name_list[:op_idx+1])
-                cp_scheme = crashplan.generate_crash_plans(trace_reader, stinfo_index, op_entry, mech_deduce, self.crash_plan_scheme, ignore_nonatomic_write=False, nonatomic_as_one=False, sampling_nonatomic_write=True)
+                if prefetched:
+                    cp_scheme = self.cp_gen_pool.get(op_idx, self.memcached_client)
+                else:
+                    mech_deduce.clean()
+                    mech_deduce.set_info(basename, op_name_list[:op_idx+1])
+                    cp_scheme = crashplan.generate_crash_plans(trace_reader, stinfo_index, op_entry, mech_deduce, self.crash_plan_scheme, ignore_nonatomic_write=False, nonatomic_as_one=False, sampling_nonatomic_write=True, cp_budget=self.args.crash_plan_budget)
 
                 existing_key = f'{basename}.{op_idx}.crash.plan.existing'
                 cp_scheme.send_to_memcached(self.memcached_client, existing_key=existing_key)
                 if self.args.dump_crash_plan_to_disk:
-                    cp_scheme.write_to_disk(case_dir, f'{op_idx:02d}-{op_entry.op_name}', use_pickle=False)
+                    cp_scheme.write_to_disk(f'{case_dir}/{CRASH_PLAN_STORE_FNAME}', op_idx, op_entry.op_name)
 
                 if self.args.stop_after_gen_crash_plan:
                     continue
@@ -672,6 +816,9 @@ class GuestProc:
                     fpath = f'{case_dir}/{op_idx:02d}-{op_entry.op_name}-post.img'
                     mem_image.dumpToFile(fpath)
 
+        if prefetched:
+            self.cp_gen_pool.clear()
+
         return True, ''
 
     @timeit
@@ -729,6 +876,12 @@ class GuestProc:
 
             self.run_one_case(exec_fpath, None)
 
+        if self.validation_pool:
+            self.validation_pool.shutdown()
+        if self.cp_gen_pool:
+            self.cp_gen_pool.shutdown()
+        if mc_wrapper.glo_mc_batch_client:
+            mc_wrapper.glo_mc_batch_client.close()
         stop_heartbeat_service()
         self.set_state(GuestState.COMPLETE)
 
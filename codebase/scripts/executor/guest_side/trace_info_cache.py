@@ -0,0 +1,41 @@
+import os
+import sys
+
+codebase_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../.."))
+sys.path.append(codebase_dir)
+
+from scripts.trace_proc.instid_srcloc_reader.instid_src_loc_reader import InstIdSrcLocReader
+from tools.scripts.src_info_reader.src_info_reader import SrcInfoReader
+from tools.scripts.struct_info_reader.struct_info_reader import StructInfoReader
+import scripts.utils.logger as log
+
+# The struct layout, instruction id to source location, and posix function
+# info files are the same for all cases of a campaign. Read them once per
+# guest process and share the readers by all cases.
+# (reader class name, file path, mtime, size) : reader
+_reader_cache = dict()
+
+def _get_reader(reader_cls, fname):
+    st = os.stat(fname)
+    key = (reader_cls.__name__, os.path.abspath(fname), st.st_mtime_ns, st.st_size)
+    reader = _reader_cache.get(key)
+    if reader == None:
+        reader = reader_cls(fname)
+        _reader_cache[key] = reader
+        log.global_logger.debug(f"cache {reader_cls.__name__} of {fname}")
+    return reader
+
+def get_struct_info_reader(fname) -> StructInfoReader:
+    reader : StructInfoReader = _get_reader(StructInfoReader, fname)
+    # the struct sizes are updated by the trace of the previous case
+    reader.reset_struct_sizes()
+    return reader
+
+def get_instid_srcloc_reader(fname) -> InstIdSrcLocReader:
+    return _get_reader(InstIdSrcLocReader, fname)
+
+def get_src_info_reader(fname) -> SrcInfoReader:
+    return _get_reader(SrcInfoReader, fname)
+
+def clear():
+    _reader_cache.clear()
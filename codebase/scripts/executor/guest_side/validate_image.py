@@ -4,6 +4,8 @@ import time
 import traceback
 import threading
 import copy
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from pymemcache.client.base import Client as CMClient
 from pymemcache.client.base import PooledClient as CMPooledClient
@@ -36,6 +38,7 @@ from scripts.crash_plan.crash_plan_scheme_base import CrashPlanSchemeBase
 from scripts.crash_plan.crash_plan_scheme_2cp import CrashPlanScheme2CP
 from scripts.utils.exceptions import GuestExceptionForDebug, GuestExceptionToRestartVM, GuestExceptionToRestoreSnapshot, GuestExceptionForValidation
 import scripts.executor.guest_side.generate_crash_image as crashimage
+from scripts.executor.guest_side.crash_image_cache import CrashImageCache
 import scripts.utils.logger as log
 
 def timeit(func):
@@ -101,7 +104,7 @@ def add_cp_and_validate_rst_to_mc(memcached_client, case_dir, op_name_list, op_i
 
         key = f'crash_plan_to_validate_rst.{num}'
         value = [report_time, os.path.basename(case_dir), op_name_list, op_idx, total_cps, cp_idx, tp.value]
-        mc_wrapper.mc_set_wrapper(memcached_client, key, value)
+        mc_wrapper.mc_set_deferred(memcached_client, key, value)
 
 @timeit
 def proc_validate_result(tp: ValidateRstType, memcached_client, case_dir, op_entry : OpTraceEntry, op_name_list : list, cp : CrashPlanEntry, other_msg, existkey_msg):
@@ -113,7 +116,7 @@ def proc_validate_result(tp: ValidateRstType, memcached_client, case_dir, op_ent
 
         key = f'ValidateRstType.{tp.value}.{num}'
         value = [report_time, os.path.basename(case_dir), op_name_list, cp, dmesg_log, other_msg]
-        mc_wrapper.mc_set_wrapper(memcached_client, key, value)
+        mc_wrapper.mc_set_deferred(memcached_client, key, value)
 
     else:
         existing_key = f'ValidateRstType.{tp.value}.{op_name_list[-1]}.{existkey_msg}'
@@ -126,7 +129,7 @@ def proc_validate_result(tp: ValidateRstType, memcached_client, case_dir, op_ent
 
             key = f'ValidateRstType.{tp.value}.{num}'
             value = [report_time, os.path.basename(case_dir), op_name_list, cp, dmesg_log, other_msg]
-            mc_wrapper.mc_set_wrapper(memcached_client, key, value)
+            mc_wrapper.mc_set_deferred(memcached_client, key, value)
 
     msg = f"validation failed: {tp.value} for case {os.path.basename(case_dir)} in op {op_name_list}, {other_msg}"
     log.global_logger.error(msg)
@@ -178,12 +181,31 @@ def unmount_fs(fs_module : ModuleDefault) -> bool:
 
     return True
 
+@timeit
+def remount_dev(fs_module : ModuleDefault, dev_path : str, mnt_point : str) -> bool:
+    '''Remount a validation device, the module should be inserted already.'''
+    if not fs_module.remount_fs(dev_path, mnt_point):
+        msg = f'{traceback.format_exc()}\nRemount {dev_path} failed!'
+        log.global_logger.error(msg)
+        return False
+    return True
+
+@timeit
+def unmount_dev(fs_module : ModuleDefault, mnt_point : str) -> bool:
+    '''Umount a validation device without removing the module.'''
+    if not fs_module.unmount_fs(mnt_point):
+        msg = f'{traceback.format_exc()}\nUmount {mnt_point} failed!'
+        log.global_logger.error(msg)
+        return False
+    return True
+
 @timeit
 def dump_img_to_dev(img : MemBinaryFile, dev_path : str):
     '''
     The sudo permission required. Please run the main script as sudo.
+    Only the pages that differ from the device content are written.
     '''
-    img.dumpToDev(dev_path)
+    img.dumpDiffToDev(dev_path)
 
 @timeit
 def dump_ctx_to_disk(fpath : str, ctx : CtxFileReader):
@@ -229,6 +251,31 @@ def get_fs_state_thd(path : str, env : EnvBase):
     else:
         return None
 
+def rebase_fs_state(ctx : CtxFileReader, env : EnvBase, dev_path : str, mnt_point : str) -> CtxFileReader:
+    '''
+    The entries of a state are keyed by the absolute paths, and the root dev id
+    is the id of the device. Rebase the state got at a validation device onto
+    MOD_DEV_PATH and MOD_MNT_POINT, where the oracles are got, so that they are
+    comparable.
+    '''
+    if mnt_point == env.MOD_MNT_POINT():
+        return ctx
+    from_dev_id = str(os.stat(dev_path).st_rdev)
+    to_dev_id = str(os.stat(env.MOD_DEV_PATH()).st_rdev)
+    lines = []
+    for line in ctx.lines:
+        if line.startswith('Path'):
+            key, _, path = line.partition(':')
+            path = path.strip()
+            if path == mnt_point or path.startswith(mnt_point + '/'):
+                line = f'{key}: {env.MOD_MNT_POINT()}{path[len(mnt_point):]}\n'
+        elif line.startswith('File_RootDev ID'):
+            key, _, dev_id = line.partition(':')
+            if dev_id.strip() == from_dev_id:
+                line = f'{key}: {to_dev_id}\n'
+        lines.append(line)
+    return CtxFileReader(lines=lines)
+
 @timeit
 def get_fs_state(path) -> CtxFileReader:
     # Do not why sometimes the script hangs at this function
@@ -269,7 +316,7 @@ def get_post_oracle(fs_module : ModuleDefault, env : EnvBase, memcached_client,
 
     fs_module.use_raw_ko()
 
-    img_copy = img.copy('post_oracle')
+    img_copy = img.snapshot('post_oracle')
     crashimage.put_op_trace_to_img(img_copy, op_entry, op_entry.min_seq, op_entry.max_seq + 1)
 
     dump_img_to_dev(img_copy, env.MOD_DEV_PATH())
@@ -303,11 +350,12 @@ def check_oracles(recovery_stat : CtxFileReader, op_entry : OpTraceEntry, env :
         return ValidateRstType.GOOD, None, None
 
 @timeit
-def check_recovered_content(memcached_client, env : EnvBase, op_entry : OpTraceEntry, cp : CrashPlanEntry, check_old_value : bool = False, check_new_value : bool = False):
+def check_recovered_content(memcached_client, env : EnvBase, op_entry : OpTraceEntry, cp : CrashPlanEntry, check_old_value : bool = False, check_new_value : bool = False, dev_path : str = None):
     if cp.type.no_content_to_check() or (not check_old_value and not check_new_value) or (not cp.exp_data_seqs) or (len(cp.exp_data_seqs) == 0):
         return ValidateRstType.GOOD, None
 
-    with open(env.MOD_DEV_PATH(), 'rb') as fd:
+    dev_path = dev_path if dev_path else env.MOD_DEV_PATH()
+    with open(dev_path, 'rb') as fd:
         for seq in cp.exp_data_seqs:
             trace_entry : TraceEntry = op_entry.pm_seq_entry_map[seq][0]
 
@@ -501,12 +549,13 @@ def check_fs_semantic(memcached_client, op_entry : OpTraceEntry, env : EnvBase):
     return ValidateRstType.GOOD, None
 
 @timeit
-def check_writable_thd(env : EnvBase):
+def check_writable_thd(env : EnvBase, mnt_point : str = None):
+    mnt_point = mnt_point if mnt_point else env.MOD_MNT_POINT()
     def thd_func(env : EnvBase, rst_list : list):
         # get all dir and files in the mount point
-        dir_list = [env.MOD_MNT_POINT()]
+        dir_list = [mnt_point]
         file_list = []
-        for root, dirs, files in os.walk(env.MOD_MNT_POINT()):
+        for root, dirs, files in os.walk(mnt_point):
             dir_list += [os.path.join(root, x) for x in dirs]
             file_list += [os.path.join(root, x) for x in files]
 
@@ -598,8 +647,9 @@ def check_writable(env : EnvBase):
     return ValidateRstType.GOOD, None
 
 @timeit
-def check_removable(env : EnvBase):
-    cmd = f'sudo rm -rf {env.MOD_MNT_POINT()}/*'
+def check_removable(env : EnvBase, mnt_point : str = None):
+    mnt_point = mnt_point if mnt_point else env.MOD_MNT_POINT()
+    cmd = f'sudo rm -rf {mnt_point}/*'
     cl_state : ShellCLState = shell_cl_local_run(cmd, 30, False)
     if cl_state.code != 0:
         return ValidateRstType.CANNOT_REMOVE, cl_state.msg()
@@ -607,31 +657,81 @@ def check_removable(env : EnvBase):
         return ValidateRstType.GOOD, None
 
 @timeit
-def validate_crash_image_main(fs_module : ModuleDefault, env : EnvBase, memcached_client, case_dir, img : MemBinaryFile, op_entry : OpTraceEntry, op_name_list : list, op_idx : int, cp : CrashPlanEntry, cp_idx : int, dump_disk_content_to_disk : bool, dump_crash_image_to_disk : bool) -> ValidateRstType:
-    rst = ValidateRstType.UNKNOWN
-    other_msg = None
-
-    clear_syslog()
-    fs_module.use_raw_ko()
-    img_copy = img.copy('crash plan')
+def validate_crash_image_main(fs_module : ModuleDefault, env : EnvBase, memcached_client, case_dir, img : MemBinaryFile, op_entry : OpTraceEntry, op_name_list : list, op_idx : int, cp : CrashPlanEntry, cp_idx : int, dump_disk_content_to_disk : bool, dump_crash_image_to_disk : bool, dev_path : str = None, mnt_point : str = None, img_cache : CrashImageCache = None) -> ValidateRstType:
+    '''
+    If the dev path and mount point are given, the crash image is validated in
+    a batch (see validate_crash_images), the module is inserted and the syslog
+    is checked by the batch.
+    If the img cache is given, the result of a byte-identical crash image that
+    has been validated is reused. If the img cache shares results with other
+    vms, the result of the crash image validated by another vm is reused, and
+    the image is validated if that vm does not set the result in time.
+    In a batch, the result is held by the img cache until the syslog is checked.
+    '''
+    in_batch = dev_path != None
+    dev_path = dev_path if dev_path else env.MOD_DEV_PATH()
+    mnt_point = mnt_point if mnt_point else env.MOD_MNT_POINT()
+
+    if not in_batch:
+        clear_syslog()
+        fs_module.use_raw_ko()
+    img_copy = img.snapshot('crash plan')
     crashimage.put_cp_to_img(img_copy, op_entry, cp)
 
     if dump_crash_image_to_disk:
         fpath = f'{case_dir}/{op_idx:02d}-{op_entry.op_name}-{cp_idx:02d}.img'
         img_copy.dumpToFile(fpath)
 
-    dump_img_to_dev(img_copy, env.MOD_DEV_PATH())
-    if not remount_fs(fs_module):
-        return ValidateRstType.REMOUNT_FAILED, None, None
+    cache_key = None
+    if img_cache:
+        cache_key = img_cache.get_key(img_copy, cp)
+        cached_rst = img_cache.get(cache_key, cp)
+        if cached_rst != None:
+            rst, other_msg, existkey_msg, recovery_stat = cached_rst
+            if dump_disk_content_to_disk and recovery_stat:
+                dump_ctx_to_disk(f'{case_dir}/{op_idx:02d}-{op_entry.op_name}-{cp_idx:02d}.ctx', recovery_stat)
+            return rst, other_msg, existkey_msg
+
+    shared_key = None
+    if img_cache and img_cache.memcached_client:
+        shared_key = img_cache.get_shared_key(img_copy, op_entry, cp)
+        shared_rst = img_cache.acquire_shared(shared_key, cp)
+        if shared_rst != None:
+            rst_value, existkey_msg, _ = shared_rst
+            return ValidateRstType(rst_value), None, existkey_msg
+
+    rst, other_msg, existkey_msg, recovery_stat = check_crash_image(fs_module, env, memcached_client, case_dir, img_copy, op_entry, op_idx, cp, cp_idx, dump_disk_content_to_disk, in_batch, dev_path, mnt_point)
+    if img_cache:
+        img_cache.hold(cp_idx, cache_key, shared_key, rst, other_msg, existkey_msg, recovery_stat)
+        if not in_batch:
+            img_cache.commit(cp_idx)
+    return rst, other_msg, existkey_msg
+
+@timeit
+def check_crash_image(fs_module : ModuleDefault, env : EnvBase, memcached_client, case_dir, img_copy, op_entry : OpTraceEntry, op_idx : int, cp : CrashPlanEntry, cp_idx : int, dump_disk_content_to_disk : bool, in_batch : bool, dev_path : str, mnt_point : str):
+    '''Dump the crash image to the device, mount and check it. Return the result and the recovered state.'''
+    rst = ValidateRstType.UNKNOWN
+    other_msg = None
+    recovery_stat = None
+
+    dump_img_to_dev(img_copy, dev_path)
+    if in_batch:
+        if not remount_dev(fs_module, dev_path, mnt_point):
+            return ValidateRstType.REMOUNT_FAILED, None, None, None
+    elif not remount_fs(fs_module):
+        return ValidateRstType.REMOUNT_FAILED, None, None, None
 
     # 1. check syslog first. Met an error that the remount is okay, but loopping at get fs state.
-    rst, other_msg = check_syslog()
-    if rst != ValidateRstType.GOOD:
-        return rst, other_msg, None
+    if not in_batch:
+        rst, other_msg = check_syslog()
+        if rst != ValidateRstType.GOOD:
+            return rst, other_msg, None, None
 
-    recovery_stat : CtxFileReader = get_fs_state_thd(env.MOD_MNT_POINT(), env)
+    recovery_stat : CtxFileReader = get_fs_state_thd(mnt_point, env)
     if not recovery_stat:
-        return ValidateRstType.GET_FS_STATE_FAILED, None, None
+        return ValidateRstType.GET_FS_STATE_FAILED, None, None, None
+    if in_batch:
+        recovery_stat = rebase_fs_state(recovery_stat, env, dev_path, mnt_point)
 
     if dump_disk_content_to_disk:
         dump_ctx_to_disk(f'{case_dir}/{op_idx:02d}-{op_entry.op_name}-{cp_idx:02d}.ctx', recovery_stat)
@@ -644,7 +744,7 @@ def validate_crash_image_main(fs_module : ModuleDefault, env : EnvBase, memcache
     # 2. compare with prev/post-op oracle
     rst, other_msg, existing_msg = check_oracles(recovery_stat, op_entry, env)
     if rst == ValidateRstType.MISMATCH_BOTH_ORACLE:
-        return rst, other_msg, existing_msg
+        return rst, other_msg, existing_msg, recovery_stat
     match_oracle_rst = rst
     rst = ValidateRstType.GOOD # reset the type
 
@@ -652,7 +752,7 @@ def validate_crash_image_main(fs_module : ModuleDefault, env : EnvBase, memcache
     rst, other_msg = check_fs_semantic(memcached_client, op_entry, env)
     if rst != ValidateRstType.GOOD:
         found_key_insert(memcached_client, rst, '')
-        return rst, other_msg, None
+        return rst, other_msg, None, recovery_stat
 
     # 4. check subsequent operations
     # 4.1 readable
@@ -660,29 +760,32 @@ def validate_crash_image_main(fs_module : ModuleDefault, env : EnvBase, memcache
 
     # 4.2 writable
     if not found_key or not found_key_exist(memcached_client, ValidateRstType.CANNOT_WRITE, found_key):
-        rst, other_msg = check_writable_thd(env)
+        rst, other_msg = check_writable_thd(env, mnt_point)
         if rst != ValidateRstType.GOOD:
-            return rst, other_msg, other_msg
+            return rst, other_msg, other_msg, recovery_stat
 
     # 4.3 removable
     if not found_key or not found_key_exist(memcached_client, ValidateRstType.CANNOT_REMOVE, found_key):
-        rst, other_msg = check_removable(env)
+        rst, other_msg = check_removable(env, mnt_point)
         if rst != ValidateRstType.GOOD:
-            return rst, other_msg, other_msg
+            return rst, other_msg, other_msg, recovery_stat
 
     # 5. check the recovered content
     match_content_rst = ValidateRstType.GOOD
     if match_oracle_rst == ValidateRstType.MATCH_PREV_ORACLE:
-        match_content_rst, other_msg = check_recovered_content(memcached_client, env, op_entry, cp, check_old_value=True)
+        match_content_rst, other_msg = check_recovered_content(memcached_client, env, op_entry, cp, check_old_value=True, dev_path=dev_path)
     elif match_oracle_rst == ValidateRstType.MATCH_POST_ORACLE:
-        match_content_rst, other_msg = check_recovered_content(memcached_client, env, op_entry, cp, check_new_value=True)
+        match_content_rst, other_msg = check_recovered_content(memcached_client, env, op_entry, cp, check_new_value=True, dev_path=dev_path)
     else:
         # impossible
         pass
 
     # 6. umount
-    if not unmount_fs(fs_module):
-        return ValidateRstType.UMOUNT_FAILED, None
+    if in_batch:
+        if not unmount_dev(fs_module, mnt_point):
+            return ValidateRstType.UMOUNT_FAILED, None, None, recovery_stat
+    elif not unmount_fs(fs_module):
+        return ValidateRstType.UMOUNT_FAILED, None, None, recovery_stat
 
     # check the content comparison result after umount, since it is the least important checks in sometimes.
     if match_content_rst != ValidateRstType.GOOD:
@@ -690,16 +793,81 @@ def validate_crash_image_main(fs_module : ModuleDefault, env : EnvBase, memcache
         var_info = 'var_not_found'
         if other_msg and other_msg.find('vars:') > 0 and other_msg.find('call path:') > 0:
             var_info = other_msg[other_msg.find('vars:'):other_msg.find('call path:')]
-        return match_content_rst, other_msg, var_info
+        return match_content_rst, other_msg, var_info, recovery_stat
 
-    return ValidateRstType.GOOD, None, None
+    return ValidateRstType.GOOD, None, None, recovery_stat
 
 @timeit
-def validate_crash_image(fs_module : ModuleDefault, env : EnvBase, memcached_client, case_dir, img : MemBinaryFile, op_entry : OpTraceEntry, op_name_list : list, op_idx : int, cp : CrashPlanEntry, total_cps : int, cp_idx : int, dump_disk_content_to_disk : bool, dump_crash_image_to_disk : bool):
-    rst, other_msg, existkey_msg = validate_crash_image_main(fs_module, env, memcached_client, case_dir, img, op_entry, op_name_list, op_idx, cp, cp_idx, dump_disk_content_to_disk, dump_crash_image_to_disk)
+def validate_crash_image(fs_module : ModuleDefault, env : EnvBase, memcached_client, case_dir, img : MemBinaryFile, op_entry : OpTraceEntry, op_name_list : list, op_idx : int, cp : CrashPlanEntry, total_cps : int, cp_idx : int, dump_disk_content_to_disk : bool, dump_crash_image_to_disk : bool, img_cache : CrashImageCache = None):
+    rst, other_msg, existkey_msg = validate_crash_image_main(fs_module, env, memcached_client, case_dir, img, op_entry, op_name_list, op_idx, cp, cp_idx, dump_disk_content_to_disk, dump_crash_image_to_disk, img_cache=img_cache)
     if rst != ValidateRstType.GOOD:
         add_cp_and_validate_rst_to_mc(memcached_client, case_dir, op_name_list, op_idx, total_cps, cp_idx, rst)
-        # remove module if not removed
-        if rst != ValidateRstType.UMOUNT_FAILED and rst != ValidateRstType.MISMATCH_OLD_VALUE and rst != ValidateRstType.MISMATCH_NEW_VALUE:
+        # remove module if not removed, it is not mounted if the result is from the img cache
+        if rst != ValidateRstType.UMOUNT_FAILED and rst != ValidateRstType.MISMATCH_OLD_VALUE and rst != ValidateRstType.MISMATCH_NEW_VALUE and os.path.ismount(env.MOD_MNT_POINT()):
             unmount_fs(fs_module)
         proc_validate_result(rst, memcached_client, case_dir, op_entry, op_name_list, cp, other_msg, existkey_msg)
+
+def _validate_crash_image_in_slot(fs_module : ModuleDefault, env : EnvBase, memcached_client, case_dir, img : MemBinaryFile, op_entry : OpTraceEntry, op_name_list : list, op_idx : int, cp : CrashPlanEntry, cp_idx : int, dump_disk_content_to_disk : bool, dump_crash_image_to_disk : bool, dev_path : str, mnt_point : str, img_cache : CrashImageCache):
+    rst, other_msg, existkey_msg = validate_crash_image_main(fs_module, env, memcached_client, case_dir, img, op_entry, op_name_list, op_idx, cp, cp_idx, dump_disk_content_to_disk, dump_crash_image_to_disk, dev_path, mnt_point, img_cache)
+    if rst != ValidateRstType.GOOD and rst != ValidateRstType.UMOUNT_FAILED and rst != ValidateRstType.MISMATCH_OLD_VALUE and rst != ValidateRstType.MISMATCH_NEW_VALUE and os.path.ismount(mnt_point):
+        # umount if not umounted, the module is removed by the batch
+        unmount_dev(fs_module, mnt_point)
+    return rst, other_msg, existkey_msg
+
+@timeit
+def validate_crash_images(fs_module : ModuleDefault, env : EnvBase, memcached_client, case_dir, img : MemBinaryFile, op_entry : OpTraceEntry, op_name_list : list, op_idx : int, cp_list : list, total_cps : int, dump_disk_content_to_disk : bool, dump_crash_image_to_disk : bool, pool : ThreadPoolExecutor, dev_paths : list, mnt_points : list, img_cache : CrashImageCache = None):
+    '''
+    Validate crash plans concurrently on multiple PM devices.
+    cp_list is an iterable of [cp_idx, cp], the crash plans can be generated on
+    the fly. The crash plans are validated in batches
+    of len(dev_paths), one device per crash plan. The module is inserted once for
+    a batch, and the syslog is checked after all crash plans in the batch are
+    validated. Since the syslog cannot tell which crash image leads to an error,
+    the batch is validated one by one on MOD_DEV_PATH if the syslog has an error.
+    The results are reported in the order of cp_list.
+    '''
+    num_devs = len(dev_paths)
+    cp_iter = iter(cp_list)
+    while True:
+        batch = list(itertools.islice(cp_iter, num_devs))
+        if len(batch) == 0:
+            break
+
+        clear_syslog()
+        fs_module.use_raw_ko()
+        if not fs_module.insert_module():
+            msg = f'{traceback.format_exc()}\nInsert module failed!'
+            log.global_logger.critical(msg)
+            raise GuestExceptionToRestartVM(msg)
+
+        futures = []
+        for i in range(len(batch)):
+            cp_idx, cp = batch[i]
+            futures.append(pool.submit(_validate_crash_image_in_slot, fs_module, env, memcached_client, case_dir, img, op_entry, op_name_list, op_idx, cp, cp_idx, dump_disk_content_to_disk, dump_crash_image_to_disk, dev_paths[i], mnt_points[i], img_cache))
+        rst_list = [x.result() for x in futures]
+
+        syslog_rst, _ = check_syslog()
+        module_removed = fs_module.remove_module()
+        if module_removed and syslog_rst != ValidateRstType.GOOD:
+            msg = f"syslog error in validating crash plans {[x[0] for x in batch]} of {op_name_list}, validate them one by one"
+            log.global_logger.warning(msg)
+            for cp_idx, cp in batch:
+                if img_cache:
+                    img_cache.discard(cp_idx)
+                validate_crash_image(fs_module, env, memcached_client, case_dir, img, op_entry, op_name_list, op_idx, cp, total_cps, cp_idx, dump_disk_content_to_disk, dump_crash_image_to_disk, img_cache)
+            continue
+
+        for i in range(len(batch)):
+            cp_idx, cp = batch[i]
+            rst, other_msg, existkey_msg = rst_list[i]
+            if img_cache:
+                img_cache.commit(cp_idx)
+            if rst != ValidateRstType.GOOD:
+                add_cp_and_validate_rst_to_mc(memcached_client, case_dir, op_name_list, op_idx, total_cps, cp_idx, rst)
+                proc_validate_result(rst, memcached_client, case_dir, op_entry, op_name_list, cp, other_msg, existkey_msg)
+
+        if not module_removed:
+            # a device is still mounted but its crash plan does not fail at umounting
+            msg = f'{traceback.format_exc()}\nRemove module failed!'
+            log.global_logger.critical(msg)
+            raise GuestExceptionToRestartVM(msg)
@@ -50,6 +50,15 @@ def parse_args():
                         required=True,
                         choices=['2cp', 'comb', 'mech2cp', 'mechcomb'],
                         help="The scheme to generate crash plans.")
+    parser.add_argument("--crash_plan_budget", type=int,
+                        required=False, default=0,
+                        help="The max number of store combinations of a combination group of crash plans (e.g., mechcomb). The combinations are sampled if there are more. 0 means no limit.")
+    parser.add_argument("--crash_plan_workers", type=int,
+                        required=False, default=0,
+                        help="The number of processes to generate the crash plans of the unique operations of a test case concurrently in a VM. 0 or 1 means generating them one by one.")
+    parser.add_argument("--not_batch_memcached", type=lambda x: bool(strtobool(x)),
+                        required=False, default=False,
+                        help="If enabled, the reports and the counters are sent to memcached one by one instead of being batched in VMs.")
     parser.add_argument("--debug_vm", type=lambda x: bool(strtobool(x)),
                         required=False, default=False,
                         help="If enabled, the VM will be terminated if the guest script raises a debug.")
@@ -97,6 +106,12 @@ def parse_args():
     parser.add_argument("--not_dedup_test_last", type=lambda x: bool(strtobool(x)),
                         required=False, default=True,
                         help="If enabled, the guest script will not proform the deduplication process and will only test the last meaningful operation of a test case. Only works when not_dedup is True.")
+    parser.add_argument("--not_cache_crash_image", type=lambda x: bool(strtobool(x)),
+                        required=False, default=False,
+                        help="If enabled, the guest script validates byte-identical crash images of an operation repeatedly.")
+    parser.add_argument("--not_share_crash_image_rst", type=lambda x: bool(strtobool(x)),
+                        required=False, default=False,
+                        help="If enabled, each VM validates the crash images that have been validated by other VMs.")
     parser.add_argument("--keep_intermidiate_result", type=lambda x: bool(strtobool(x)),
                         required=False, default=False,
                         help="If enabled, the intermidiate result (e.g., execution trace, crash plans) of each test case will be kept (be careful of the mount point space) in the guest VM.")
@@ -282,6 +297,13 @@ class HostProc():
             key = f'CrashPlanType.{tp.value}.count'
             mc_wrapper.mc_set_wrapper(self.memcached_client, key, 0)
 
+        # for number of crash plans whose crash images are validated before
+        for tp in CrashPlanType:
+            key = f'CrashImageCacheHit.{tp.value}.count'
+            mc_wrapper.mc_set_wrapper(self.memcached_client, key, 0)
+            key = f'CrashImageSharedHit.{tp.value}.count'
+            mc_wrapper.mc_set_wrapper(self.memcached_client, key, 0)
+
         # for validation result
         for tp in ValidateRstType:
             key = f'ValidateRstType.{tp.value}.count'
@@ -383,6 +405,9 @@ class HostProc():
             f'nohup sudo python3 {self.guest_script} '
             f'--fs_type={self.fs_type} '
             f'--crash_plan_scheme {self.cp_scheme} '
+            f'--crash_plan_budget {self.args.crash_plan_budget} '
+            f'--crash_plan_workers {self.args.crash_plan_workers} '
+            f'--not_batch_memcached {self.args.not_batch_memcached} '
             f'--test_case_basename {test_case_basename} '
             f'--vm_id {vm_id} '
             f'--num_cases_to_test {self.args.num_cases_to_test} '
@@ -390,6 +415,8 @@ class HostProc():
             f'--shuffle_seed {self.args.shuffle_seed} '
             f'--not_dedup {self.args.not_dedup} '
             f'--not_dedup_test_last {self.args.not_dedup_test_last} '
+            f'--not_cache_crash_image {self.args.not_cache_crash_image} '
+            f'--not_share_crash_image_rst {self.args.not_share_crash_image_rst} '
             f'--keep_intermidiate_result {self.args.keep_intermidiate_result} '
             f'--skip_umount {self.args.skip_umount} '
             f'--stop_after_tracing {self.args.stop_after_tracing} '
@@ -33,6 +33,15 @@ def iterate_result(memcached_client) -> list:
             rst_dict[tp] = count
     return rst_dict
 
+def iterate_img_cache_hit_result(memcached_client, key_prefix) -> list:
+    rst_dict = dict()
+    for tp in CrashPlanType:
+        key = f'{key_prefix}.{tp.value}.count'
+        count = memcached_client.get(key)
+        if count != None:
+            rst_dict[tp] = count
+    return rst_dict
+
 def main(args):
     output_dir = args.output_dir
     my_utils.mkdirDirs(output_dir, exist_ok=True)
@@ -46,6 +55,11 @@ def main(args):
     for tp, count in rst_dict.items():
         data += f'CrashPlanType.{tp.value}: {count}\n'
 
+    for key_prefix in ['CrashImageCacheHit', 'CrashImageSharedHit']:
+        rst_dict = iterate_img_cache_hit_result(memcached_client, key_prefix)
+        for tp, count in rst_dict.items():
+            data += f'{key_prefix}.{tp.value}: {count}\n'
+
     with open(f"{output_dir}/result.txt", 'w') as fd:
         fd.write(data)
 
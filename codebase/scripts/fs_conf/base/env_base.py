@@ -143,6 +143,23 @@ class EnvBase(ABC):
         '''the fs mount point'''
         return '/mnt/pmem0'
 
+    def VALIDATION_DEV_NUM(self) -> int:
+        '''
+        The number of PM devices used to validate crash plans concurrently in a vm, 0 indicates the number of cpus of a vm.
+        Each device requires a PM namespace of PM_SIZE_MB in the vm (e.g., one memmap region per device in the kernel command line).
+        '''
+        return 1
+
+    def VALIDATION_DEV_PATHS(self) -> list:
+        '''the devices to validate crash plans, the first one is MOD_DEV_PATH'''
+        num = self.VALIDATION_DEV_NUM() if self.VALIDATION_DEV_NUM() > 0 else self.NUM_CPU()
+        return [self.MOD_DEV_PATH()] + ['/dev/pmem%d' % (i) for i in range(1, num)]
+
+    def VALIDATION_MNT_POINTS(self) -> list:
+        '''the mount points of VALIDATION_DEV_PATHS, the first one is MOD_MNT_POINT'''
+        num = len(self.VALIDATION_DEV_PATHS())
+        return [self.MOD_MNT_POINT()] + ['/mnt/pmem%d' % (i) for i in range(1, num)]
+
     def MODULE_MAKE_DIR(self) -> str:
         '''the makefile dir for making the file system source code'''
         return "%s/codebase/trace/build-llvm15" % (self.GUEST_REPO_HOME())
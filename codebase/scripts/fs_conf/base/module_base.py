@@ -72,7 +72,7 @@ class ModuleBase(ABC, metaclass=ModuleMeta):
         pass
 
     @abstractmethod
-    def remount_fs(self) -> bool:
+    def remount_fs(self, dev_path=None, mnt_point=None) -> bool:
         '''remount FS'''
         pass
 
@@ -82,7 +82,7 @@ class ModuleBase(ABC, metaclass=ModuleMeta):
         pass
 
     @abstractmethod
-    def unmount_fs(self) -> bool:
+    def unmount_fs(self, mnt_point=None) -> bool:
         '''unmount FS'''
         pass
 
@@ -158,9 +158,11 @@ class ModuleDefault(ModuleBase):
 
         return cl_state.code == 0
 
-    def remount_fs(self):
-        '''mount FS'''
-        cmd = "sudo mount -t %s -o %s %s %s" % (self.mnt_type, self.remnt_para, self.dev_path, self.mnt_point)
+    def remount_fs(self, dev_path=None, mnt_point=None):
+        '''mount FS, the dev path and mount point in env are used if not given'''
+        dev_path = dev_path if dev_path else self.dev_path
+        mnt_point = mnt_point if mnt_point else self.mnt_point
+        cmd = "sudo mount -t %s -o %s %s %s" % (self.mnt_type, self.remnt_para, dev_path, mnt_point)
 
         cl_state = self.cmd_agent(cmd, self.guest_name, ttl=super().TTL_MOUNT)
 
@@ -184,9 +186,10 @@ class ModuleDefault(ModuleBase):
 
         return cl_state.code == 0
 
-    def unmount_fs(self):
-        '''unmount FS'''
-        cmd = "sudo umount %s" % (self.mnt_point)
+    def unmount_fs(self, mnt_point=None):
+        '''unmount FS, the mount point in env is used if not given'''
+        mnt_point = mnt_point if mnt_point else self.mnt_point
+        cmd = "sudo umount %s" % (mnt_point)
 
         cl_state = self.cmd_agent(cmd, self.guest_name, ttl=super().TTL_MOUNT)
 
@@ -141,7 +141,7 @@ class MechPMStoreEntry:
         data = "addr: %s, size: %s, flush seq: %s, fence seq: %s, first fence op: %s" % \
             (hex(self.addr), self.size, str(flush_seq), str(fence_seq), str(self.first_fence_op))
         if self.size <= 8:
-            data += ", new data: %s, old data: %s\n" % (str(self.new_data), str(self.old_data))
+            data += ", new data: %s, old data: %s\n" % (str(bytes(self.new_data)), str(bytes(self.old_data)))
         else:
             data += "\n"
         data += f"{self.op.var_list}, {str(self.op)}"
@@ -1,5 +1,7 @@
 import os
+import re
 import sys
+from collections.abc import Mapping
 
 scripts_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
 sys.path.append(scripts_dir)
@@ -24,29 +26,51 @@ class InstIdSrcLocEntry:
             return "NoSrc:0"
         return self.src + ":" + str(self.lno)
     
+class InstIdSrcLocMap(Mapping):
+    """inst_id : entry, the line of an instruction id is parsed on its first lookup"""
+    # the instruction id at the beginning of each line
+    INSTID_PATTERN = re.compile(rb'^[ \t]*(-?\d+)[ \t]*:', re.M)
+
+    def __init__(self, data = b''):
+        self.data = data
+        # inst_id : the start of its line in the data
+        self.line_start_map = {int(m.group(1)) : m.start() for m in self.INSTID_PATTERN.finditer(data)}
+        self.entry_map = dict()
+
+    def __getitem__(self, instid):
+        entry = self.entry_map.get(instid)
+        if entry == None:
+            start = self.line_start_map[instid]
+            end = self.data.find(b'\n', start)
+            if end < 0:
+                end = len(self.data)
+            ll = self.data[start:end].decode().strip().split(":")
+            entry = InstIdSrcLocEntry(int(ll[0]), ll[1], int(ll[2]))
+            self.entry_map[instid] = entry
+        return entry
+
+    def __contains__(self, instid):
+        return instid in self.line_start_map
+
+    def __iter__(self):
+        return iter(self.line_start_map)
+
+    def __len__(self):
+        return len(self.line_start_map)
+
 class InstIdSrcLocReader:
     """Read instructrion id source location."""
     def __init__(self, fname = None):
         # inst_id : entry
-        self.id_loc_map = dict()
+        self.id_loc_map = InstIdSrcLocMap()
         if fname != None:
             self.read_from_file(fname)
 
     def read_from_file(self, fname):
-        cnt = 0
-        fd = open(fname, 'r')
-        for line in fd:
-            line = line.strip()
-            if len(line) == 0:
-                continue
-
-            cnt += 1
-            ll = line.strip().split(":")
-            entry = InstIdSrcLocEntry(int(ll[0]), ll[1], int(ll[2]))
-            self.id_loc_map[int(ll[0])] = entry
-        fd.close()
+        with open(fname, 'rb') as fd:
+            self.id_loc_map = InstIdSrcLocMap(fd.read())
 
-        global_logger.info("read %d entries from %s" % (cnt, fname))
+        global_logger.info("read %d entries from %s" % (len(self.id_loc_map), fname))
 
     def clear(self):
-        self.id_loc_map.clear()
+        self.id_loc_map = InstIdSrcLocMap()
@@ -0,0 +1,171 @@
+import os
+import sys
+import random
+import logging
+import tempfile
+
+codebase_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../.."))
+sys.path.append(codebase_dir)
+
+from scripts.trace_proc.trace_reader.trace_reader import TraceReader
+from scripts.trace_proc.trace_reader.trace_bin import convert_text_trace_to_bin, is_bin_trace_file
+from scripts.utils.logger import global_logger, setup_global_logger
+
+PM_ADDR = 0xffff888000000000
+PM_SIZE_MB = 16
+DRAM_ADDR = 0xffff880000000000
+
+def init_log():
+    setup_global_logger(stm = sys.stderr, stm_lv=logging.INFO)
+
+def get_passed_str():
+    return '\033[92m' + 'passed' + '\033[0m'
+
+def get_failed_str():
+    return '\033[91m' + 'failed' + '\033[0m'
+
+def gen_text_trace(fname, seed, num_pids = 2, num_records = 2000):
+    """
+    Generate a text trace of interleaved pids, each pid has nested calls and
+    functions, PM and DRAM stores, NT stores, flushes, fences and struct pointers.
+    """
+    rnd = random.Random(seed)
+    lines = []
+    seq = 0
+    pm_end = PM_ADDR + PM_SIZE_MB * 1048576
+    lines.append(f'{seq} 1 DaxDevInfo id: 0 {hex(PM_ADDR)} {hex(pm_end)} {PM_SIZE_MB}')
+    seq += 1
+
+    # pid -> the stack of (caller, callee, function name)
+    pid_stacks = {pid : [] for pid in range(100, 100 + num_pids)}
+    # ptr_fn is called through a function pointer, its function is real_fn
+    fn_names = ['nova_write', 'nova_append', 'memcpy_to_pmem', 'nova_flush_buffer', 'ptr_fn']
+    for i in range(num_records):
+        pid = rnd.choice(list(pid_stacks.keys()))
+        stack = pid_stacks[pid]
+        instid = rnd.randint(1, 500)
+        choice = rnd.random()
+        addr = rnd.choice([PM_ADDR, DRAM_ADDR]) + rnd.randrange(0, 4096, 8)
+        if choice < 0.1 and len(stack) < 6:
+            caller = stack[-1][2] if stack else 'root'
+            callee = rnd.choice(fn_names)
+            fn = callee if callee != 'ptr_fn' else 'real_fn'
+            lines.append(f'{seq} {pid} startCall id: {instid} caller: {caller} callee: {callee}')
+            seq += 1
+            lines.append(f'{seq} {pid} startFunc id: {instid} addr: 0x0 name: {fn}')
+            stack.append((caller, callee, fn))
+        elif choice < 0.2 and len(stack) > 0:
+            caller, callee, fn = stack.pop()
+            lines.append(f'{seq} {pid} endFunc id: {instid} addr: 0x0 name: {fn}')
+            seq += 1
+            lines.append(f'{seq} {pid} endCall id: {instid} caller: {caller} callee: {callee}')
+        elif choice < 0.5:
+            lines.append(f'{seq} {pid} store id: {instid} addr: {hex(addr)} size: {rnd.choice([1, 2, 4, 8, 16])}')
+        elif choice < 0.6:
+            lines.append(f'{seq} {pid} asmmemsetnt id: {instid} addr: {hex(addr)} size: {rnd.choice([8, 64, 100])}')
+        elif choice < 0.7:
+            lines.append(f'{seq} {pid} asmFlush id: {instid} addr: {hex(addr)}')
+        elif choice < 0.8:
+            lines.append(f'{seq} {pid} asmFence id: {instid}')
+        elif choice < 0.9:
+            lines.append(f'{seq} {pid} PMStructPtr id: {instid} name: nova_inode addr: {hex(addr)} x: 0 x: 0 size: 128')
+        else:
+            lines.append(f'{seq} {pid} load id: {instid} addr: {hex(addr)} size: 8')
+        seq += 1
+
+    # end all functions so that the call stacks are empty
+    for pid, stack in pid_stacks.items():
+        while len(stack) > 0:
+            caller, callee, fn = stack.pop()
+            lines.append(f'{seq} {pid} endFunc id: 1 addr: 0x0 name: {fn}')
+            seq += 1
+            lines.append(f'{seq} {pid} endCall id: 1 caller: {caller} callee: {callee}')
+            seq += 1
+
+    with open(fname, 'w') as fd:
+        fd.write('not a trace line\n')
+        for line in lines:
+            fd.write(line + '\n')
+
+def entry_fields(entry):
+    return (entry.type, entry.seq, entry.pid, entry.instid, entry.addr, entry.size,
+            entry.st_name, entry.fn_name, entry.caller, entry.callee,
+            entry.raw_line.strip(), entry.call_path, entry.is_nt_store)
+
+def compare_readers(text_reader : TraceReader, bin_reader : TraceReader) -> bool:
+    if (text_reader.pm_addr, text_reader.pm_size) != (bin_reader.pm_addr, bin_reader.pm_size):
+        global_logger.error("pm info mismatch")
+        return False
+    if text_reader.pm_store_seq_list != bin_reader.pm_store_seq_list:
+        global_logger.error("pm store seq list mismatch")
+        return False
+    if len(text_reader.seq_entry_map) != len(bin_reader.seq_entry_map) or \
+            list(text_reader.seq_entry_map.keys()) != list(bin_reader.seq_entry_map.keys()):
+        global_logger.error("seqs mismatch")
+        return False
+    for seq, entry_list in text_reader.seq_entry_map.items():
+        bin_entry_list = bin_reader.seq_entry_map[seq]
+        if [entry_fields(x) for x in entry_list] != [entry_fields(x) for x in bin_entry_list]:
+            global_logger.error(f"entry mismatch at seq {seq}: {entry_list[0]} vs {bin_entry_list[0]}")
+            return False
+        if text_reader.seq_to_pid_map[seq] != bin_reader.seq_to_pid_map[seq]:
+            global_logger.error(f"pid mismatch at seq {seq}")
+            return False
+    if sorted(text_reader.pid_seq_entry_map.keys()) != sorted(bin_reader.pid_seq_entry_map.keys()):
+        global_logger.error("pids mismatch")
+        return False
+    for pid, seq_map in text_reader.pid_seq_entry_map.items():
+        if list(seq_map.keys()) != list(bin_reader.pid_seq_entry_map[pid].keys()):
+            global_logger.error(f"seqs of pid {pid} mismatch")
+            return False
+    if -1 in bin_reader.seq_entry_map:
+        global_logger.error("unexpected seq in binary trace")
+        return False
+    return True
+
+def test_text_to_bin_round_trip(seed):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        text_fname = f'{tmp_dir}/trace.log'
+        bin_fname = f'{tmp_dir}/trace.bin'
+        gen_text_trace(text_fname, seed)
+        num = convert_text_trace_to_bin(text_fname, bin_fname)
+
+        text_reader = TraceReader(text_fname)
+        bin_reader = TraceReader(bin_fname)
+        ok = is_bin_trace_file(bin_fname) and not is_bin_trace_file(text_fname) and \
+                num == len(text_reader.seq_entry_map) and \
+                bin_reader.bin_file != None and \
+                compare_readers(text_reader, bin_reader)
+
+    if ok:
+        global_logger.info("test_text_to_bin_round_trip_%d: %s" % (seed, get_passed_str()))
+    else:
+        global_logger.info("test_text_to_bin_round_trip_%d: %s" % (seed, get_failed_str()))
+
+def test_streaming_reader_of_bin_trace():
+    """A binary trace is never streamed, stream_entries yields the loaded entries."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        text_fname = f'{tmp_dir}/trace.log'
+        bin_fname = f'{tmp_dir}/trace.bin'
+        gen_text_trace(text_fname, 0, num_records=200)
+        convert_text_trace_to_bin(text_fname, bin_fname)
+
+        text_reader = TraceReader(text_fname, streaming=True)
+        text_seqs = [x[0].seq for x in text_reader.stream_entries()]
+        bin_reader = TraceReader(bin_fname, streaming=True)
+        bin_seqs = [x[0].seq for x in bin_reader.stream_entries()]
+        ok = not bin_reader.streaming and text_seqs == bin_seqs
+
+    if ok:
+        global_logger.info("test_streaming_reader_of_bin_trace: %s" % (get_passed_str()))
+    else:
+        global_logger.info("test_streaming_reader_of_bin_trace: %s" % (get_failed_str()))
+
+def main():
+    init_log()
+    for seed in range(3):
+        test_text_to_bin_round_trip(seed)
+    test_streaming_reader_of_bin_trace()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+import os
+import sys
+import mmap
+import time
+import struct
+import logging
+from collections.abc import Mapping
+
+import numpy as np
+
+codebase_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../.."))
+sys.path.append(codebase_dir)
+
+from scripts.trace_proc.trace_reader.trace_type import TraceType
+from scripts.trace_proc.trace_reader.trace_entry import TraceEntry, TraceEntryTables
+from scripts.trace_proc.trace_reader.trace_entry import get_entry_list_from_entry
+from scripts.utils.logger import global_logger, time_logger
+import scripts.utils.logger as log
+
+'''
+Binary columnar layout of a function trace:
+
+    header      : BIN_TRACE_HEADER
+    records     : num_records * BIN_TRACE_REC_DTYPE, in file order
+    str offsets : (num_strings + 1) * uint64
+    str blob    : utf-8 bytes of the interned strings (fn/caller/callee/struct names)
+    raw offsets : (num_records + 1) * uint64
+    raw blob    : utf-8 bytes of the raw text lines
+
+String index 0 is always the empty string.
+Addresses are stored as uint64, UINT64_MAX represents -1 (no address).
+'''
+
+BIN_TRACE_MAGIC = b'SILTRBIN'
+BIN_TRACE_VERSION = 1
+
+# magic, version, reserved, num_records, num_strings,
+# rec_off, str_off_off, str_blob_off, raw_off_off, raw_blob_off, pm_addr, pm_size
+BIN_TRACE_HEADER = struct.Struct('<8sIIQQQQQQQQq')
+
+BIN_TRACE_REC_DTYPE = np.dtype([
+    ('seq',     '<i8'),
+    ('pid',     '<i8'),
+    ('instid',  '<i8'),
+    ('addr',    '<u8'),
+    ('size',    '<i8'),
+    ('st_name', '<u4'),
+    ('fn_name', '<u4'),
+    ('caller',  '<u4'),
+    ('callee',  '<u4'),
+    ('type',    '<u4'),
+    ('flags',   '<u4'),
+])
+
+UINT64_MASK = 0xFFFFFFFFFFFFFFFF
+
+# type value -> TraceType, avoid the enum lookup per record
+TRACE_TYPE_MAP = {ty.value : ty for ty in TraceType}
+
+def timeit(func):
+    """Decorator that prints the time a function takes to execute."""
+    def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        result = func(*args, **kwargs)
+        log.time_logger.info(f"elapsed_time.guest.trace_bin.{func.__name__}:{time.perf_counter() - start_time:.6f}")
+        return result
+    return wrapper
+
+def is_bin_trace_file(fname) -> bool:
+    if not os.path.isfile(fname) or os.path.getsize(fname) < BIN_TRACE_HEADER.size:
+        return False
+    with open(fname, 'rb') as fd:
+        return fd.read(len(BIN_TRACE_MAGIC)) == BIN_TRACE_MAGIC
+
+@timeit
+def convert_text_trace_to_bin(text_fname, bin_fname):
+    '''
+    Parse the text function trace once and dump it as a binary trace.
+    Return the number of records.
+    '''
+    str_idx_map = {"" : 0}
+    str_list = [""]
+    def intern(s):
+        idx = str_idx_map.get(s)
+        if idx is None:
+            idx = len(str_list)
+            str_idx_map[s] = idx
+            str_list.append(s)
+        return idx
+
+    rec_list = []
+    raw_list = []
+    seq_set = set()
+    pm_addr = -1
+    pm_size = -1
+    with open(text_fname, 'r') as fd:
+        for line in fd:
+            if not TraceEntry.is_valid_trace_line(line):
+                continue
+            entry = TraceEntry(line)
+            if entry.seq in seq_set:
+                log_msg = "entry seq [%d] is aleardy in map, line [%s]" % (entry.seq, line)
+                global_logger.critical(log_msg)
+                assert False, log_msg
+            seq_set.add(entry.seq)
+
+            if entry.type.isDaxDevTy():
+                pm_addr = entry.addr
+                pm_size = entry.size
+
+            rec_list.append((entry.seq, entry.pid, entry.instid,
+                             entry.addr & UINT64_MASK, entry.size,
+                             intern(entry.st_name), intern(entry.fn_name),
+                             intern(entry.caller), intern(entry.callee),
+                             entry.type.value, 0))
+            raw_list.append(line.encode('utf-8'))
+
+    recs = np.array(rec_list, dtype=BIN_TRACE_REC_DTYPE)
+
+    str_bytes = [s.encode('utf-8') for s in str_list]
+    str_offs = np.zeros(len(str_bytes) + 1, dtype='<u8')
+    str_offs[1:] = np.cumsum([len(b) for b in str_bytes], dtype=np.uint64)
+    raw_offs = np.zeros(len(raw_list) + 1, dtype='<u8')
+    raw_offs[1:] = np.cumsum([len(b) for b in raw_list], dtype=np.uint64)
+
+    rec_off = BIN_TRACE_HEADER.size
+    str_off_off = rec_off + recs.nbytes
+    str_blob_off = str_off_off + str_offs.nbytes
+    raw_off_off = str_blob_off + int(str_offs[-1])
+    raw_blob_off = raw_off_off + raw_offs.nbytes
+
+    with open(bin_fname, 'wb') as fd:
+        fd.write(BIN_TRACE_HEADER.pack(BIN_TRACE_MAGIC, BIN_TRACE_VERSION, 0,
+                                       len(rec_list), len(str_list),
+                                       rec_off, str_off_off, str_blob_off,
+                                       raw_off_off, raw_blob_off,
+                                       pm_addr & UINT64_MASK, pm_size))
+        fd.write(recs.tobytes())
+        fd.write(str_offs.tobytes())
+        fd.write(b''.join(str_bytes))
+        fd.write(raw_offs.tobytes())
+        fd.write(b''.join(raw_list))
+
+    log_msg = "Convert [%d] records, [%d] strings, from [%s] to [%s]" % \
+            (len(rec_list), len(str_list), text_fname, bin_fname)
+    global_logger.debug(log_msg)
+    return len(rec_list)
+
+class BinTraceFile:
+    """ A memory-mapped binary trace, records are materialized on demand. """
+    def __init__(self, fname, tables : TraceEntryTables):
+        self.fname = fname
+        self.tables = tables
+        self.tables.bin_file = self
+        self.fd = open(fname, 'rb')
+        self.mm = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, _, num_records, num_strings, \
+                rec_off, str_off_off, str_blob_off, \
+                raw_off_off, raw_blob_off, pm_addr, pm_size = \
+                BIN_TRACE_HEADER.unpack_from(self.mm, 0)
+        if magic != BIN_TRACE_MAGIC or version != BIN_TRACE_VERSION:
+            log_msg = "invalid binary trace file [%s], magic [%s], version [%d]" % (fname, magic, version)
+            global_logger.critical(log_msg)
+            assert False, log_msg
+
+        self.pm_addr = pm_addr if pm_addr != UINT64_MASK else -1
+        self.pm_size = pm_size
+
+        # zero-copy views over the mapped file
+        self.recs = np.frombuffer(self.mm, dtype=BIN_TRACE_REC_DTYPE, count=num_records, offset=rec_off)
+        self.str_offs = np.frombuffer(self.mm, dtype='<u8', count=num_strings + 1, offset=str_off_off)
+        self.str_blob_off = str_blob_off
+        self.raw_offs = np.frombuffer(self.mm, dtype='<u8', count=num_records + 1, offset=raw_off_off)
+        self.raw_blob_off = raw_blob_off
+
+        # the seq index, seqs[seq_order] is sorted
+        self.seqs = self.recs['seq']
+        self.seq_order = np.argsort(self.seqs, kind='stable')
+        self.sorted_seqs = self.seqs[self.seq_order]
+
+        # decoded strings, filled lazily
+        self.str_cache = [None] * num_strings
+
+        # row -> entry_list, the materialized entries are shared by all views
+        self.entry_cache = dict()
+
+    def __len__(self):
+        return len(self.recs)
+
+    def get_str(self, idx) -> str:
+        s = self.str_cache[idx]
+        if s is None:
+            start = self.str_blob_off + int(self.str_offs[idx])
+            end = self.str_blob_off + int(self.str_offs[idx + 1])
+            s = self.mm[start:end].decode('utf-8')
+            self.str_cache[idx] = s
+        return s
+
+    def get_raw_line(self, row) -> str:
+        start = self.raw_blob_off + int(self.raw_offs[row])
+        end = self.raw_blob_off + int(self.raw_offs[row + 1])
+        return self.mm[start:end].decode('utf-8')
+
+    def row_of_seq(self, seq) -> int:
+        ''' Return the row of the seq, -1 if not found. '''
+        i = int(np.searchsorted(self.sorted_seqs, seq))
+        if i < len(self.sorted_seqs) and self.sorted_seqs[i] == seq:
+            return int(self.seq_order[i])
+        return -1
+
+    def get_entry_list(self, row) -> list:
+        entry_list = self.entry_cache.get(row)
+        if entry_list is None:
+            seq, pid, instid, addr, size, st_name, fn_name, caller, callee, ty, _ = self.recs[row].tolist()
+            entry = TraceEntry.from_fields(TRACE_TYPE_MAP[ty], seq, pid, instid,
+                                           addr if addr != UINT64_MASK else -1,
+                                           size,
+                                           self.get_str(st_name),
+                                           self.get_str(fn_name),
+                                           self.get_str(caller),
+                                           self.get_str(callee),
+                                           row, self.tables)
+            entry_list = get_entry_list_from_entry(entry)
+            self.entry_cache[row] = entry_list
+        return entry_list
+
+    def rows_of_types(self, types, rows=None):
+        ''' Return the rows (in file order) whose type is in types. '''
+        values = np.array([ty.value for ty in types], dtype='<u4')
+        if rows is None:
+            return np.nonzero(np.isin(self.recs['type'], values))[0]
+        return rows[np.isin(self.recs['type'][rows], values)]
+
+    def pids(self) -> list:
+        return [int(pid) for pid in np.unique(self.recs['pid'])]
+
+class BinSeqEntryMap(Mapping):
+    """ A read-only dict(seq, entry_list) view over (a subset of) a BinTraceFile. """
+    def __init__(self, bin_file : BinTraceFile, rows=None):
+        self.bin_file = bin_file
+        # rows in file order, None means all rows
+        self.rows = rows
+        self.row_set = None
+
+    def __contains_row(self, row):
+        if self.rows is None:
+            return True
+        if self.row_set is None:
+            self.row_set = set(self.rows.tolist())
+        return row in self.row_set
+
+    def __getitem__(self, seq):
+        row = self.bin_file.row_of_seq(seq)
+        if row < 0 or not self.__contains_row(row):
+            raise KeyError(seq)
+        return self.bin_file.get_entry_list(row)
+
+    def __contains__(self, seq):
+        row = self.bin_file.row_of_seq(seq)
+        return row >= 0 and self.__contains_row(row)
+
+    def __iter__(self):
+        seqs = self.bin_file.seqs if self.rows is None else self.bin_file.seqs[self.rows]
+        for seq in seqs.tolist():
+            yield seq
+
+    def __len__(self):
+        return len(self.bin_file) if self.rows is None else len(self.rows)
+
+    def items(self):
+        rows = range(len(self.bin_file)) if self.rows is None else self.rows.tolist()
+        seqs = self.bin_file.seqs.tolist() if self.rows is None else self.bin_file.seqs[self.rows].tolist()
+        for seq, row in zip(seqs, rows):
+            yield seq, self.bin_file.get_entry_list(row)
+
+    def values(self):
+        for _, entry_list in self.items():
+            yield entry_list
+
+    def sorted_items_of_types(self, types):
+        ''' The (seq, entry_list) pairs of the given types, sorted by seq. '''
+        rows = self.bin_file.rows_of_types(types, self.rows)
+        rows = rows[np.argsort(self.bin_file.seqs[rows], kind='stable')]
+        for row in rows.tolist():
+            yield int(self.bin_file.seqs[row]), self.bin_file.get_entry_list(row)
+
+class BinSeqToPidMap(Mapping):
+    """ A read-only dict(seq, pid) view over a BinTraceFile. """
+    def __init__(self, bin_file : BinTraceFile):
+        self.bin_file = bin_file
+
+    def __getitem__(self, seq):
+        row = self.bin_file.row_of_seq(seq)
+        if row < 0:
+            raise KeyError(seq)
+        return int(self.bin_file.recs['pid'][row])
+
+    def __contains__(self, seq):
+        return self.bin_file.row_of_seq(seq) >= 0
+
+    def __iter__(self):
+        for seq in self.bin_file.seqs.tolist():
+            yield seq
+
+    def __len__(self):
+        return len(self.bin_file)
+
+@timeit
+def load_bin_trace(fname, tables : TraceEntryTables):
+    '''
+    Return (bin_file, seq_entry_map, seq_to_pid_map, pid_seq_entry_map).
+    The maps are lazy views, an entry list is built when it is accessed.
+    '''
+    bin_file = BinTraceFile(fname, tables)
+    seq_entry_map = BinSeqEntryMap(bin_file)
+    seq_to_pid_map = BinSeqToPidMap(bin_file)
+    pid_seq_entry_map = dict()
+    pids = bin_file.recs['pid']
+    for pid in bin_file.pids():
+        pid_seq_entry_map[pid] = BinSeqEntryMap(bin_file, np.nonzero(pids == pid)[0])
+    return bin_file, seq_entry_map, seq_to_pid_map, pid_seq_entry_map
+
+def main(argc, argv):
+    if argc != 3:
+        print("usage: %s <text trace file> <binary trace file>" % (argv[0]))
+        exit(1)
+
+    log.setup_global_logger(fname="trace_bin.log", file_lv=logging.INFO, stm=sys.stderr)
+    num = convert_text_trace_to_bin(argv[1], argv[2])
+    print("convert %d records to %s" % (num, argv[2]))
+
+if __name__ == "__main__":
+    argc = len(sys.argv)
+    argv = sys.argv
+    main(argc, argv)
@@ -1,6 +1,6 @@
 import os
 import sys
-from copy import copy
+from copy import copy, deepcopy
 
 codebase_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../.."))
 sys.path.append(codebase_dir)
@@ -15,10 +15,60 @@ from scripts.utils.const_var import CACHELINE_BYTES
 from scripts.utils import utils as my_utils
 
 
+class TraceEntryTables:
+    """
+    Tables shared by all entries of a trace.
+    The heavy fields of TraceEntry are resolved from them on access.
+    """
+    def __init__(self):
+        # the raw lines, either from a memory-mapped text trace (row is the
+        # byte offset of the line) or a binary trace (row is the record index)
+        self.text_mm = None
+        self.bin_file = None
+        # (pid, seq) -> call path, an interned tuple
+        self.call_path_fn = None
+        # TraceValueReader, for old and new values
+        self.value_reader = None
+        # InstIdSrcLocReader, for source locations
+        self.loc_reader = None
+
+    def get_raw_line(self, row) -> str:
+        if self.bin_file:
+            return self.bin_file.get_raw_line(row)
+        if self.text_mm:
+            end = self.text_mm.find(b'\n', row)
+            if end < 0:
+                end = len(self.text_mm)
+            return self.text_mm[row:end + 1].decode('utf-8')
+        return None
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        # the tables are shared, never copy them
+        return self
+
 class TraceEntry:
     """ TraceEntry repersents one trace record. """
 
+    __slots__ = ('type', 'seq', 'pid', 'instid', 'addr', 'size',
+                 'st_name', 'fn_name', 'caller', 'callee',
+                 'stinfo_match', 'is_nt_store',
+                 '_raw_line', '_row', '_tables', '_call_path',
+                 '_ov_entry', '_sv_entry', '_src_entry',
+                 '_stinfo_list', '_var_list')
+
     def __init__(self, line):
+        self.__init_members(line)
+
+        self.__parse_line(line)
+
+        self.is_nt_store = False
+        if self.type.isStoreAndFlushTy():
+            self.is_nt_store = True
+
+    def __init_members(self, line):
         self.type   : TraceType = None
         self.seq    : int       = -1  # seq number
         self.pid    : int       = -1  # process id
@@ -30,24 +80,152 @@ class TraceEntry:
         self.caller : str       = ""  # caller name (for call record)
         self.callee : str       = ""  # callee name (for call record)
 
-        self.raw_line: str = line  # the raw line read from file
+        # the raw line read from file, or None if it is resolved from the
+        # shared tables by the row
+        self._raw_line: str = line
+        self._row : int = -1
+        self._tables : TraceEntryTables = None
 
-        self.ov_entry: TraceValueEntry = None  # old value entry
-        self.sv_entry: TraceValueEntry = None  # new value entry
+        # below are resolved from the shared tables if not set explicitly
+        self._ov_entry: TraceValueEntry = None  # old value entry
+        self._sv_entry: TraceValueEntry = None  # new value entry
 
-        self.src_entry: InstIdSrcLocEntry = None  # source location
+        self._src_entry: InstIdSrcLocEntry = None  # source location
 
-        self.stinfo_list = []   # a list of a list AddrToStInfoEntry
+        self._stinfo_list = None   # a list of a list AddrToStInfoEntry
         self.stinfo_match : AddrToStInfoEntry = None  # the best matched AddrToStInfoEntry
-        self.var_list = [] # a list of StructMemberVar, if stinfo_match is not None, this is all matched variables of it
+        self._var_list = None # a list of StructMemberVar, if stinfo_match is not None, this is all matched variables of it
 
-        self.call_path = [] # the calling path to this seq, a list of function name
+        self._call_path = None # the calling path to this seq, a tuple of function names shared by entries, or a list
 
-        self.__parse_line(line)
-
-        self.is_nt_store = False
-        if self.type.isStoreAndFlushTy():
-            self.is_nt_store = True
+    @classmethod
+    def from_fields(cls, ty : TraceType, seq, pid, instid, addr, size,
+                    st_name, fn_name, caller, callee, row, tables):
+        '''
+        Build an entry from already-parsed fields (e.g., a binary trace record)
+        without parsing the text line again.
+        '''
+        entry = cls.__new__(cls)
+        entry.__init_members(None)
+        entry.type = ty
+        entry.seq = seq
+        entry.pid = pid
+        entry.instid = instid
+        entry.addr = addr
+        entry.size = size
+        entry.st_name = st_name
+        entry.fn_name = fn_name
+        entry.caller = caller
+        entry.callee = callee
+        entry.is_nt_store = ty.isStoreAndFlushTy()
+        entry.set_tables(row, tables)
+        return entry
+
+    def set_tables(self, row, tables : TraceEntryTables):
+        ''' Resolve the raw line and other heavy fields from the shared tables. '''
+        self._row = row
+        self._tables = tables
+        self._raw_line = None
+
+    @property
+    def raw_line(self) -> str:
+        if self._raw_line is None and self._tables:
+            return self._tables.get_raw_line(self._row)
+        return self._raw_line
+
+    @raw_line.setter
+    def raw_line(self, line):
+        self._raw_line = line
+
+    @property
+    def call_path(self) -> list:
+        # the call paths are interned as tuples, return a list as before
+        if self._call_path is None:
+            if self._tables and self._tables.call_path_fn:
+                return list(self._tables.call_path_fn(self.pid, self.seq))
+            return []
+        return list(self._call_path)
+
+    @call_path.setter
+    def call_path(self, call_path):
+        self._call_path = call_path
+
+    @property
+    def ov_entry(self) -> TraceValueEntry:
+        if self._ov_entry is None and self._tables and self._tables.value_reader and \
+                self.type != TraceType.kAsmFlush:
+            return self._tables.value_reader.ov_map.get(self.seq)
+        return self._ov_entry
+
+    @ov_entry.setter
+    def ov_entry(self, entry):
+        self._ov_entry = entry
+
+    @property
+    def sv_entry(self) -> TraceValueEntry:
+        if self._sv_entry is None and self._tables and self._tables.value_reader and \
+                self.type != TraceType.kAsmFlush:
+            return self._tables.value_reader.sv_map.get(self.seq)
+        return self._sv_entry
+
+    @sv_entry.setter
+    def sv_entry(self, entry):
+        self._sv_entry = entry
+
+    @property
+    def src_entry(self) -> InstIdSrcLocEntry:
+        if self._src_entry is None and self._tables and self._tables.loc_reader:
+            return self._tables.loc_reader.id_loc_map.get(self.instid)
+        return self._src_entry
+
+    @src_entry.setter
+    def src_entry(self, entry):
+        self._src_entry = entry
+
+    @property
+    def stinfo_list(self) -> list:
+        return self._stinfo_list if self._stinfo_list is not None else []
+
+    @stinfo_list.setter
+    def stinfo_list(self, lst):
+        self._stinfo_list = lst
+
+    @property
+    def var_list(self) -> list:
+        return self._var_list if self._var_list is not None else []
+
+    @var_list.setter
+    def var_list(self, lst):
+        self._var_list = lst
+
+    def __copy__(self):
+        # share the tables and the resolved fields
+        entry = self.__class__.__new__(self.__class__)
+        for name in TraceEntry.__slots__:
+            setattr(entry, name, getattr(self, name))
+        return entry
+
+    def __deepcopy__(self, memo):
+        entry = self.__class__.__new__(self.__class__)
+        memo[id(self)] = entry
+        for name in TraceEntry.__slots__:
+            setattr(entry, name, deepcopy(getattr(self, name), memo))
+        return entry
+
+    def __getstate__(self):
+        # resolve the lazy fields, the shared tables are not picklable
+        state = {name : getattr(self, name) for name in TraceEntry.__slots__}
+        state['_raw_line'] = self.raw_line
+        state['_call_path'] = self.call_path
+        state['_ov_entry'] = self.ov_entry
+        state['_sv_entry'] = self.sv_entry
+        state['_src_entry'] = self.src_entry
+        state['_tables'] = None
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
 
     @classmethod
     def is_valid_trace_line(cls, line):
@@ -109,19 +287,19 @@ class TraceEntry:
         if items[2] == "startFunc" or items[2] == "endFunc" or \
                 items[2] == "startBB" or items[2] == "endBB":
             self.addr = int(items[6], 0)
-            self.fn_name = items[8]
+            self.fn_name = sys.intern(items[8])
         elif items[2] == "startCall" or items[2] == "endCall":
-            self.caller = items[6]
-            self.callee = items[8]
+            self.caller = sys.intern(items[6])
+            self.callee = sys.intern(items[8])
         elif items[2] == "ukasm":
-            self.caller = items[7]
+            self.caller = sys.intern(items[7])
         elif items[2] == "DRAMStructPtr" or items[2] == "PMStructPtr" or \
                 items[2] == "UKStructPtr":
-            self.st_name = items[6]
+            self.st_name = sys.intern(items[6])
             self.addr = int(items[8], 0)
             self.size = int(items[12])
         elif items[2] == "dbgStore":
-            self.st_name = items[6]
+            self.st_name = sys.intern(items[6])
             self.addr = int(items[8], 0)
             self.size = int(items[10])
         elif items[2] == "asmmemsetnt" or \
@@ -172,7 +350,13 @@ def get_entry_list_from_line(line) -> list:
        that is followed by a flush.
        https://stackoverflow.com/questions/34501243/what-happens-with-a-non-temporal-store-if-the-data-is-already-in-cache
     '''
-    entry = TraceEntry(line)
+    return get_entry_list_from_entry(TraceEntry(line))
+
+def get_entry_list_from_entry(entry : TraceEntry) -> list:
+    '''
+    The same sanitization as get_entry_list_from_line, but for an entry that
+    has been constructed already.
+    '''
     entry_list = [entry]
 
     if entry.type.isStoreAndFlushTy() or entry.type.isCASTy():
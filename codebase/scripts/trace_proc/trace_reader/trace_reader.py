@@ -1,8 +1,9 @@
 import os
 import sys
+import mmap
 import time
+from bisect import bisect_right
 from copy import copy
-from intervaltree import Interval, IntervalTree
 
 codebase_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../.."))
 sys.path.append(codebase_dir)
@@ -10,10 +11,11 @@ sys.path.append(codebase_dir)
 from scripts.trace_proc.instid_srcloc_reader.instid_src_loc_reader import InstIdSrcLocEntry
 from scripts.trace_proc.pm_trace.pm_trace_split import is_pm_addr
 from scripts.trace_proc.trace_reader.trace_type import TraceType
-from scripts.trace_proc.trace_reader.trace_entry import TraceEntry
+from scripts.trace_proc.trace_reader.trace_entry import TraceEntry, TraceEntryTables
 from scripts.trace_proc.trace_reader.trace_entry import get_entry_list_from_line
 from scripts.trace_proc.trace_reader.trace_value_reader import TraceValueEntry
 from scripts.trace_proc.trace_reader.trace_value_reader import TraceValueReader
+from scripts.trace_proc.trace_reader.trace_bin import is_bin_trace_file, load_bin_trace
 from scripts.trace_proc.instid_srcloc_reader.instid_src_loc_reader import InstIdSrcLocReader
 from scripts.utils.logger import global_logger, time_logger
 import scripts.utils.logger as log
@@ -30,7 +32,11 @@ def timeit(func):
 
 class TraceReader:
     """ Read trace records from a file. """
-    def __init__(self, fname):
+    def __init__(self, fname, streaming=False):
+        '''
+        If streaming, the text trace is not loaded here, the entries are
+        loaded while iterating stream_entries().
+        '''
         self.fname = fname
 
         # the pm information got from the trace
@@ -46,89 +52,205 @@ class TraceReader:
         # dict(pid, dict(seq, entry_list))
         self.pid_seq_entry_map = dict()
 
-        # the seq range to function tree, e.g.,
-        # [1, 100] : [fn1], [5, 20] : [fn1, fn2], [10, 15] : [fn1, fn2, fn3]
-        # if a entry's seq in [10, 15], the call path is fn1 -> fn2 -> fn3
-        # if a entry's seq in [1, 5], ths call path is fn1
-        # pid -> Interval tree, which maps seq interval to function names
-        self.pid_seq_func_tree = dict()
+        # The call path changes only at the start and the end of functions, e.g.,
+        # seqs:  [1,       5,            10,                15,           20,      100]
+        # paths: [(fn1,), (fn1, fn2), (fn1, fn2, fn3), (fn1, fn2), (fn1,), ()]
+        # if a entry's seq in [10, 15), the call path is fn1 -> fn2 -> fn3
+        # if a entry's seq in [1, 5), ths call path is fn1
+        # pid -> the seqs that the call path changes
+        self.pid_call_path_seqs = dict()
+        # pid -> the call paths from the seqs at the same index
+        self.pid_call_paths = dict()
+        # the call paths are tuples of function names, interned to share them among entries
+        self.call_path_intern = dict()
 
-        self.__load_entries(fname)
-        self.__match_functions()
-        self.__set_call_path()
+        # the memory-mapped binary trace, None if reading a text trace
+        self.bin_file = None
+
+        # shared by all entries to resolve raw lines, call paths, values and source locations
+        self.entry_tables = TraceEntryTables()
+        self.entry_tables.call_path_fn = self.__get_call_path
+
+        # pid -> the stack of unpaired call and function entries
+        self.pid_call_stack = dict()
 
         # all pm store related seq
         self.pm_store_seq_list = []
+
+        # the binary trace is mapped lazily, no need to stream it
+        self.streaming = streaming and not is_bin_trace_file(fname)
+        if self.streaming:
+            return
+
+        if is_bin_trace_file(fname):
+            self.__load_bin_entries(fname)
+        else:
+            self.__load_entries(fname)
+        self.__match_functions()
+
         self.__init_pm_store_seq_list()
 
+    def stream_entries(self):
+        '''
+        Load the trace and yield the entry lists in the file order.
+        Call and function records are matched before they are yielded, thus
+        records of the same pid must be in the seq order.
+        Call paths of functions that are never ended are dropped after the
+        stream is exhausted.
+        If not in streaming mode, yield the loaded entry lists.
+        '''
+        if not self.streaming:
+            for entry_list in self.seq_entry_map.values():
+                yield entry_list
+            return
+
+        pid_last_seq = dict()
+        for row, line in self.__iter_trace_lines(self.fname):
+            entry_list = self.__add_line(row, line)
+            entry : TraceEntry = entry_list[0]
+
+            if entry.pid in pid_last_seq and pid_last_seq[entry.pid] > entry.seq:
+                log_msg = "out of order seq [%d] after [%d] of pid [%d], cannot stream the trace" % \
+                        (entry.seq, pid_last_seq[entry.pid], entry.pid)
+                global_logger.critical(log_msg)
+                assert False, log_msg
+            pid_last_seq[entry.pid] = entry.seq
+
+            self.__match_entry(entry)
+            yield entry_list
+
+        self.__check_dax_dev()
+        self.__check_call_stacks()
+        self.__init_pm_store_seq_list()
+        self.streaming = False
+
+        log_msg = "Stream [%d] entries, [%d] pids, from [%s]" % \
+                (len(self.seq_entry_map), len(self.pid_seq_entry_map), self.fname)
+        global_logger.debug(log_msg)
+
     @timeit
-    def merge_value_entries(self, value_reader : TraceValueReader):
-        for seq, entry_list in self.seq_entry_map.items():
-            for entry in entry_list:
-                entry : TraceEntry
-
-                if entry.type != TraceType.kAsmFlush:
-                    if entry.seq in value_reader.ov_map and entry.seq in value_reader.sv_map:
-                        entry.ov_entry = value_reader.ov_map[entry.seq]
-                        entry.sv_entry = value_reader.sv_map[entry.seq]
-                    elif entry.seq in value_reader.ov_map or entry.seq in value_reader.sv_map:
+    def merge_value_entries(self, value_reader : TraceValueReader, seqs = None):
+        '''
+        Entries look up their values on access. Only check the given seqs if
+        there are, otherwise check the seqs that have one of the values.
+        '''
+        if seqs == None:
+            seqs = value_reader.unpaired_seqs()
+        for seq in seqs:
+            if seq in self.seq_entry_map and \
+                    (seq in value_reader.ov_map) != (seq in value_reader.sv_map):
+                for entry in self.seq_entry_map[seq]:
+                    if entry.type != TraceType.kAsmFlush:
                         log_msg = "seq [%d] only exist in ov or sv map!" % (entry.seq)
                         global_logger.error(log_msg)
                         assert False, log_msg
+        self.entry_tables.value_reader = value_reader
 
     @timeit
     def merge_srcloc_entries(self, loc_reader : InstIdSrcLocReader):
-        for seq, elist in self.seq_entry_map.items():
-            instruction_id = elist[0].instid
-            if instruction_id in loc_reader.id_loc_map:
-                for entry in elist:
-                    entry.src_entry = loc_reader.id_loc_map[instruction_id]
+        # entries look up their source locations by instruction id on access,
+        # the reader parses the location of an instruction id on its first lookup
+        self.entry_tables.loc_reader = loc_reader
 
-    @timeit
-    def __load_entries(self, fname):
-        fd = open(fname, 'r')
-        for line in fd:
+    def pm_store_seqs_before(self, end_seq) -> list:
+        '''
+        The PM store seqs that are smaller than the end seq.
+        pm_store_seq_list is in the file order, which is not the seq order in
+        the traces of multiple threads, thus it is filtered rather than bisected.
+        '''
+        return [seq for seq in self.pm_store_seq_list if seq < end_seq]
+
+    def __iter_trace_lines(self, fname):
+        ''' Yield (row, line) of valid lines, row is the byte offset of the line. '''
+        fd = open(fname, 'rb')
+        if os.path.getsize(fname) > 0:
+            # raw lines are read back from the mapped file on access
+            self.entry_tables.text_mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        off = 0
+        for raw in fd:
+            row = off
+            off += len(raw)
+            line = raw.decode('utf-8')
             if TraceEntry.is_valid_trace_line(line):
-                entry_list = get_entry_list_from_line(line)
-
-                if len(entry_list) == 0:
-                    log_msg = "parse entry failed from line [%s]" % (line)
-                    global_logger.critical(log_msg)
-                    assert False, log_msg
-                elif entry_list[0].seq in self.seq_entry_map:
-                    log_msg = "entry seq [%d] is aleardy in map, line [%s]" % (entry_list[0].seq, line)
-                    global_logger.critical(log_msg)
-                    assert False, log_msg
-                else:
-                    ty = entry_list[0].type
-                    pid = entry_list[0].pid
-                    seq = entry_list[0].seq
-
-                    self.seq_entry_map[seq] = entry_list
-
-                    if ty.isDaxDevTy():
-                        self.pm_addr = entry_list[0].addr
-                        self.pm_size = entry_list[0].size
-
-                    if pid not in self.pid_seq_entry_map:
-                        self.pid_seq_entry_map[pid] = dict()
-                    if seq in self.pid_seq_entry_map[pid]:
-                        log_msg = "entry seq [%d] is aleardy in map, line [%s]" % (entry_list[0].seq, line)
-                        global_logger.critical(log_msg)
-                        assert False, log_msg
+                yield row, line
+        fd.close()
+
+    def __add_line(self, row, line) -> list:
+        entry_list = get_entry_list_from_line(line)
+        for entry in entry_list:
+            entry.set_tables(row, self.entry_tables)
+
+        if len(entry_list) == 0:
+            log_msg = "parse entry failed from line [%s]" % (line)
+            global_logger.critical(log_msg)
+            assert False, log_msg
+        elif entry_list[0].seq in self.seq_entry_map:
+            log_msg = "entry seq [%d] is aleardy in map, line [%s]" % (entry_list[0].seq, line)
+            global_logger.critical(log_msg)
+            assert False, log_msg
+        else:
+            ty = entry_list[0].type
+            pid = entry_list[0].pid
+            seq = entry_list[0].seq
+
+            self.seq_entry_map[seq] = entry_list
+
+            if ty.isDaxDevTy():
+                self.pm_addr = entry_list[0].addr
+                self.pm_size = entry_list[0].size
 
-                    self.seq_to_pid_map[seq] = pid
-                    self.pid_seq_entry_map[pid][seq] = entry_list
+            if pid not in self.pid_seq_entry_map:
+                self.pid_seq_entry_map[pid] = dict()
+            if seq in self.pid_seq_entry_map[pid]:
+                log_msg = "entry seq [%d] is aleardy in map, line [%s]" % (entry_list[0].seq, line)
+                global_logger.critical(log_msg)
+                assert False, log_msg
 
+            self.seq_to_pid_map[seq] = pid
+            self.pid_seq_entry_map[pid][seq] = entry_list
+
+        return entry_list
+
+    def __check_dax_dev(self):
         if not my_utils.isKernelSpaceAddr(self.pm_addr):
             log_msg = "invalid dax device information [%d, %d]" % (self.pm_addr, self.pm_size)
             global_logger.critical(log_msg)
             assert False, log_msg
 
+    @timeit
+    def __load_entries(self, fname):
+        for row, line in self.__iter_trace_lines(fname):
+            self.__add_line(row, line)
+
+        self.__check_dax_dev()
+
         log_msg = "Load [%d] entries, [%d] pids, from [%s]" % \
                 (len(self.seq_entry_map), len(self.pid_seq_entry_map), fname)
         global_logger.debug(log_msg)
 
+    @timeit
+    def __load_bin_entries(self, fname):
+        '''
+        The maps are lazy views over the binary trace, entry lists are built
+        when they are accessed.
+        '''
+        self.bin_file, self.seq_entry_map, self.seq_to_pid_map, self.pid_seq_entry_map = \
+                load_bin_trace(fname, self.entry_tables)
+        self.pm_addr = self.bin_file.pm_addr
+        self.pm_size = self.bin_file.pm_size
+
+        self.__check_dax_dev()
+
+        log_msg = "Load [%d] entries, [%d] pids, from binary trace [%s]" % \
+                (len(self.seq_entry_map), len(self.pid_seq_entry_map), fname)
+        global_logger.debug(log_msg)
+
+    def __sorted_call_func_items(self, seq_map):
+        if self.bin_file:
+            # only materialize the call and function records
+            return seq_map.sorted_items_of_types([TraceType.kStartCall, TraceType.kEndCall, TraceType.kStartFn, TraceType.kEndFn])
+        return sorted(seq_map.items())
+
     @timeit
     def __match_functions(self):
         '''
@@ -144,73 +266,119 @@ class TraceReader:
         start_call -> start_func -> end_func -> end_call
         '''
         for pid, seq_map in self.pid_seq_entry_map.items():
-            if pid not in self.pid_seq_func_tree:
-                self.pid_seq_func_tree[pid] = IntervalTree()
-            call_stack = []
-            for seq, entry_list in sorted(seq_map.items()):
-                entry = entry_list[0]
-                entry : TraceEntry
-
-                if entry.type == TraceType.kStartCall:
-                    log_msg = f'start of call [{entry.callee}]'
-                    global_logger.debug(log_msg)
-                    call_stack.append(entry)
-                elif entry.type == TraceType.kEndCall:
-                    log_msg = f'end of call [{entry.callee}]'
-                    global_logger.debug(log_msg)
-                    if len(call_stack) == 0 or \
-                            not TraceEntry.is_pair_call_entry(call_stack[-1], entry):
-                        log_msg = "invalid pair of call entries:\n%s\n%s\n" % (call_stack[-1].__str__(), entry.__str__())
-                        global_logger.critical(log_msg)
-                        assert False, log_msg
-                    else:
-                        call_stack[-1].callee = call_stack[-1].fn_name
-                        entry.callee = call_stack[-1].callee
-                        # reset fn_name
-                        call_stack[-1].fn_name = ""
-                        # remove the last one
-                        call_stack.pop(-1)
-                elif entry.type == TraceType.kStartFn:
-                    log_msg = f'start of func [{entry.fn_name}]'
+            for seq, entry_list in self.__sorted_call_func_items(seq_map):
+                self.__match_entry(entry_list[0])
+        self.__check_call_stacks()
+
+    def __match_entry(self, entry : TraceEntry):
+        ''' Match one call or function entry with the call stack of its pid. '''
+        pid = entry.pid
+        if pid not in self.pid_call_stack:
+            self.pid_call_stack[pid] = []
+            self.pid_call_path_seqs[pid] = []
+            self.pid_call_paths[pid] = []
+        call_stack = self.pid_call_stack[pid]
+
+        if entry.type == TraceType.kStartCall:
+            if log.debug:
+                log_msg = f'start of call [{entry.callee}]'
+                global_logger.debug(log_msg)
+            call_stack.append(entry)
+        elif entry.type == TraceType.kEndCall:
+            if log.debug:
+                log_msg = f'end of call [{entry.callee}]'
+                global_logger.debug(log_msg)
+            if len(call_stack) == 0 or \
+                    not TraceEntry.is_pair_call_entry(call_stack[-1], entry):
+                log_msg = "invalid pair of call entries:\n%s\n%s\n" % (call_stack[-1].__str__(), entry.__str__())
+                global_logger.critical(log_msg)
+                assert False, log_msg
+            else:
+                call_stack[-1].callee = call_stack[-1].fn_name
+                entry.callee = call_stack[-1].callee
+                # reset fn_name
+                call_stack[-1].fn_name = ""
+                # remove the last one
+                call_stack.pop(-1)
+        elif entry.type == TraceType.kStartFn:
+            if log.debug:
+                log_msg = f'start of func [{entry.fn_name}]'
+                global_logger.debug(log_msg)
+            if len(call_stack) > 0 and call_stack[-1].type == TraceType.kStartCall:
+                # call entry's fn_name is empty, use it as a temp store.
+                if log.debug:
+                    log_msg = f'change start call func name [{call_stack[-1].fn_name}] -> [{entry.fn_name}]'
                     global_logger.debug(log_msg)
-                    if len(call_stack) > 0 and call_stack[-1].type == TraceType.kStartCall:
-                        # call entry's fn_name is empty, use it as a temp store.
-                        log_msg = f'change start call func name [{call_stack[-1].fn_name}] -> [{entry.fn_name}]'
-                        global_logger.debug(log_msg)
-                        call_stack[-1].fn_name = entry.fn_name
-                    call_stack.append(entry)
-                elif entry.type == TraceType.kEndFn:
-                    log_msg = f'end of func [{entry.fn_name}]'
+                call_stack[-1].fn_name = entry.fn_name
+            call_stack.append(entry)
+            self.__add_call_path(pid, entry.seq, call_stack)
+        elif entry.type == TraceType.kEndFn:
+            if log.debug:
+                log_msg = f'end of func [{entry.fn_name}]'
+                global_logger.debug(log_msg)
+            if len(call_stack) == 0 or \
+                    not TraceEntry.is_pair_func_entry(call_stack[-1], entry):
+                log_msg = "invalid pair of function entries:\n%s\n%s\n" % (call_stack[-1].__str__(), entry.__str__())
+                global_logger.critical(log_msg)
+                assert False, log_msg
+            else:
+                if log.debug:
+                    log_msg = f'pair of end of func [{call_stack[-1].fn_name}]'
                     global_logger.debug(log_msg)
-                    if len(call_stack) == 0 or \
-                            not TraceEntry.is_pair_func_entry(call_stack[-1], entry):
-                        log_msg = "invalid pair of function entries:\n%s\n%s\n" % (call_stack[-1].__str__(), entry.__str__())
-                        global_logger.critical(log_msg)
-                        assert False, log_msg
-                    else:
-                        log_msg = f'pair of end of func [{call_stack[-1].fn_name}]'
-                        global_logger.debug(log_msg)
-                        self.pid_seq_func_tree[pid][call_stack[-1].seq : entry.seq] = entry.fn_name
-                        call_stack.pop(-1)
-                else:
-                    pass
+                call_stack.pop(-1)
+                self.__add_call_path(pid, entry.seq, call_stack)
+        else:
+            pass
+
+    def __add_call_path(self, pid, seq, call_stack):
+        ''' The call path from this seq is the functions in the call stack. '''
+        path = tuple(e.fn_name for e in call_stack if e.type == TraceType.kStartFn)
+        path = self.call_path_intern.setdefault(path, path)
+        self.pid_call_path_seqs[pid].append(seq)
+        self.pid_call_paths[pid].append(path)
 
+    def __check_call_stacks(self):
+        for pid, call_stack in self.pid_call_stack.items():
             if len(call_stack) > 0:
                 log_msg = "Remaining entries in call stack:\n"
                 for call in call_stack:
                     log_msg += call.__str__().strip() + "\n"
                 global_logger.warning(log_msg)
+                self.__drop_unended_functions(pid, call_stack)
 
-    @timeit
-    def __set_call_path(self):
-        for seq, elist in self.seq_entry_map.items():
-            pid = elist[0].pid
-            if pid in self.pid_seq_func_tree:
-                for entry in elist:
-                    entry.call_path = [iv.data for iv in sorted(self.pid_seq_func_tree[pid][seq])]
+    def __drop_unended_functions(self, pid, call_stack):
+        '''
+        Functions that are never ended are not in any call path.
+        Such a function stays at the same depth of the call path since its start.
+        '''
+        fn_entries = [e for e in call_stack if e.type == TraceType.kStartFn]
+        seqs = self.pid_call_path_seqs[pid]
+        paths = self.pid_call_paths[pid]
+        for i in range(len(seqs)):
+            drop = set(depth for depth, e in enumerate(fn_entries) if e.seq <= seqs[i])
+            if len(drop) > 0:
+                path = tuple(x for depth, x in enumerate(paths[i]) if depth not in drop)
+                paths[i] = self.call_path_intern.setdefault(path, path)
+
+    def __get_call_path(self, pid, seq) -> tuple:
+        seqs = self.pid_call_path_seqs.get(pid)
+        if not seqs:
+            return ()
+        idx = bisect_right(seqs, seq) - 1
+        return self.pid_call_paths[pid][idx] if idx >= 0 else ()
 
     @timeit
     def __init_pm_store_seq_list(self):
+        if self.bin_file:
+            recs = self.bin_file.recs
+            store_tys = [ty for ty in TraceType if ty.isStoreSeries()]
+            rows = self.bin_file.rows_of_types(store_tys)
+            # the same range as is_pm_addr
+            addrs = recs['addr'][rows]
+            rows = rows[(addrs >= self.pm_addr) & (addrs <= self.pm_addr + self.pm_size)]
+            self.pm_store_seq_list = recs['seq'][rows].tolist()
+            return
+
         for seq, lst in self.seq_entry_map.items():
             entry : TraceEntry = lst[0]
             if entry.type.isStoreSeries():
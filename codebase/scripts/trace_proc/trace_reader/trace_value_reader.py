@@ -1,12 +1,28 @@
 import os
 import sys
+import time
+import mmap
+import struct
 import binascii
+from array import array
+from collections.abc import Mapping
+
+import numpy as np
 
 codebase_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../.."))
 sys.path.append(codebase_dir)
 
 from scripts.utils.logger import global_logger, time_logger
 
+def timeit(func):
+    """Decorator that prints the time a function takes to execute."""
+    def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        result = func(*args, **kwargs)
+        time_logger.info(f"elapsed_time.guest.trace_value_reader.{func.__name__}:{time.perf_counter() - start_time:.6f}")
+        return result
+    return wrapper
+
 class TraceValueEntry:
     """docstring for TraceValueEntry."""
     # this number is hard-coded in the Kernel tracing .c file
@@ -15,6 +31,7 @@ class TraceValueEntry:
     def __init__(self, seq, data, size):
         self.seq  : int   = seq
         self.size : int   = size
+        # bytes, or a memoryview of the mapped value file
         self.data : bytes = data
 
     def data_eq(self, other) -> bool:
@@ -32,7 +49,7 @@ class TraceValueEntry:
     def to_int(self):
         if self.size <= 8:
             return int.from_bytes(self.data, byteorder='little', signed=False)
-        return str(self.data)
+        return str(bytes(self.data))
 
     def to_str_full(self, max_bytes_print=8) -> str:
         if self.size > max_bytes_print:
@@ -43,6 +60,10 @@ class TraceValueEntry:
     def __str__(self):
         return self.to_str_full()
 
+    def __reduce__(self):
+        # memoryviews cannot be pickled or copied
+        return (self.__class__, (self.seq, bytes(self.data), self.size))
+
     @classmethod
     def is_old_value_seq(cls, seq):
         if seq >= cls.OLD_VALUE_SEQ_BASE:
@@ -58,63 +79,118 @@ class TraceValueEntry:
         else:
             return seq
 
+class TraceValueMap(Mapping):
+    """seq : TraceValueEntry, backed by sorted seq/offset/size arrays over the
+    mapped value file. Entries are created on access and their data is a
+    memoryview slice of the file."""
+    def __init__(self, buf = None, seqs = None, offsets = None, sizes = None):
+        self.buf = buf
+        self.seqs = seqs if seqs is not None else np.empty(0, dtype=np.uint64)
+        self.offsets = offsets if offsets is not None else np.empty(0, dtype=np.uint64)
+        self.sizes = sizes if sizes is not None else np.empty(0, dtype=np.uint64)
+
+    def __index_of(self, seq):
+        if not isinstance(seq, (int, np.integer)) or seq < 0:
+            return -1
+        idx = int(np.searchsorted(self.seqs, seq))
+        if idx < len(self.seqs) and self.seqs[idx] == seq:
+            return idx
+        return -1
+
+    def __getitem__(self, seq):
+        idx = self.__index_of(seq)
+        if idx < 0:
+            raise KeyError(seq)
+        offset = int(self.offsets[idx])
+        size = int(self.sizes[idx])
+        return TraceValueEntry(int(seq), self.buf[offset:offset+size], size)
+
+    def __contains__(self, seq):
+        return self.__index_of(seq) >= 0
+
+    def __iter__(self):
+        return iter(self.seqs.tolist())
+
+    def __len__(self):
+        return len(self.seqs)
+
 class TraceValueReader:
     """Load trace vlaue file."""
+    # each record is seq (8 bytes), size (8 bytes), and the data
+    REC_HEADER = struct.Struct('<QQ')
+
     def __init__(self, fname = None):
         # seq : entry
-        self.ov_map = dict()
-        self.sv_map = dict()
+        self.ov_map = TraceValueMap()
+        self.sv_map = TraceValueMap()
+        self.mm = None
         if fname != None:
             self.read_from_file(fname)
 
+    @timeit
     def read_from_file(self, fname):
-        cnt_ov = 0
-        cnt_sv = 0
-        fd = open(fname, 'rb')
-        while True:
-            seq_data = fd.read(8)
-
-            if not seq_data:
-                # reach EOF
-                break
-
-            if len(seq_data) != 8:
-                log_msg = f'incorrect seq data length {len(seq_data)}'
+        # only index the records here, the data stays in the mapped file
+        with open(fname, 'rb') as fd:
+            if os.fstat(fd.fileno()).st_size > 0:
+                self.mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm == None:
+            global_logger.debug("add 0 ov, add 0 sv from %s" % (fname))
+            return
+
+        file_size = len(self.mm)
+        seqs = array('Q')
+        offsets = array('Q')
+        sizes = array('Q')
+        unpack_from = self.REC_HEADER.unpack_from
+        header_size = self.REC_HEADER.size
+        pos = 0
+        while pos < file_size:
+            if pos + 8 > file_size:
+                log_msg = f'incorrect seq data length {file_size - pos}'
                 global_logger.critical(log_msg)
                 assert False, log_msg
 
-            size_data = fd.read(8)
-            if not size_data or len(size_data) != 8:
-                log_msg = f'incorrect size data length {len(size_data)}'
+            if pos + header_size > file_size:
+                log_msg = f'incorrect size data length {file_size - pos - 8}'
                 global_logger.critical(log_msg)
                 assert False, log_msg
 
-            seq = int.from_bytes(seq_data, byteorder='little', signed=False)
-            size = int.from_bytes(size_data, byteorder='little', signed=False)
-            data = fd.read(size)
-
-            if TraceValueEntry.is_old_value_seq(seq):
-                seq = TraceValueEntry.conv_to_trace_seq(seq)
-                if seq in self.ov_map:
-                    log_msg = f'seq {seq} is already in the ov map'
-                    global_logger.critical(log_msg)
-                    assert False, log_msg
-                else:
-                    cnt_ov += 1
-                    self.ov_map[seq] = TraceValueEntry(seq, data, size)
-            else:
-                if seq in self.sv_map:
-                    log_msg = f'seq {seq} is already in the sv map'
-                    global_logger.critical(log_msg)
-                    assert False, log_msg
-                else:
-                    cnt_sv += 1
-                    self.sv_map[seq] = TraceValueEntry(seq, data, size)
-
-        fd.close()
-        global_logger.debug("add %d ov, add %s sv from %s" % (cnt_ov, cnt_sv, fname))
+            seq, size = unpack_from(self.mm, pos)
+            pos += header_size
+            seqs.append(seq)
+            offsets.append(pos)
+            sizes.append(size)
+            pos += size
+
+        seqs = np.frombuffer(seqs, dtype=np.uint64)
+        offsets = np.frombuffer(offsets, dtype=np.uint64)
+        sizes = np.frombuffer(sizes, dtype=np.uint64)
+
+        buf = memoryview(self.mm)
+        is_ov = seqs >= TraceValueEntry.OLD_VALUE_SEQ_BASE
+        self.ov_map = self.__build_map(buf, seqs[is_ov] - TraceValueEntry.OLD_VALUE_SEQ_BASE,
+                                       offsets[is_ov], sizes[is_ov], 'ov')
+        self.sv_map = self.__build_map(buf, seqs[~is_ov],
+                                       offsets[~is_ov], sizes[~is_ov], 'sv')
+
+        global_logger.debug("add %d ov, add %s sv from %s" % (len(self.ov_map), len(self.sv_map), fname))
+
+    def __build_map(self, buf, seqs, offsets, sizes, name) -> TraceValueMap:
+        order = np.argsort(seqs, kind='stable')
+        seqs = seqs[order]
+        dup = np.flatnonzero(seqs[1:] == seqs[:-1])
+        if len(dup) > 0:
+            log_msg = f'seq {int(seqs[dup[0]])} is already in the {name} map'
+            global_logger.critical(log_msg)
+            assert False, log_msg
+        return TraceValueMap(buf, seqs, offsets[order], sizes[order])
+
+    def unpaired_seqs(self) -> list:
+        '''seqs that only have an old value or a new value'''
+        return np.setxor1d(self.ov_map.seqs, self.sv_map.seqs, assume_unique=True).tolist()
 
     def clear(self):
-        self.ov_map.clear()
-        self.sv_map.clear()
-
+        # the mapped file is closed once no entry refers to it
+        self.ov_map = TraceValueMap()
+        self.sv_map = TraceValueMap()
+        self.mm = None
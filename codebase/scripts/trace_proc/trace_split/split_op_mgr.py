@@ -20,11 +20,16 @@ from scripts.trace_proc.trace_split.vfs_op_trace_entry import OpTraceEntry
 from scripts.trace_proc.trace_reader.trace_type import TraceType
 from scripts.trace_proc.trace_reader.trace_entry import TraceEntry
 from scripts.trace_proc.trace_reader.trace_reader import TraceReader
+from scripts.utils.utils import isKernelSpaceAddr
 from utils.logger import global_logger
 
 class SplitOpMgr(object):
     """SplitOpMgr."""
-    def __init__(self, trace_reader : TraceReader, vfs_op_info : SrcInfoReader):
+    def __init__(self, trace_reader : TraceReader, vfs_op_info : SrcInfoReader, streaming=False):
+        '''
+        If streaming, the trace is split while it is being loaded by iterating
+        stream_ops().
+        '''
         self.trace_reader = trace_reader
         self.vfs_op_info = vfs_op_info
 
@@ -32,37 +37,67 @@ class SplitOpMgr(object):
         # The list will be sorted by min seq after initialization.
         self.op_entry_list = list()
 
+        # the states of splitting
+        self.first_mount = True
+        # pid -> the op entry that has not been ended
+        self.pid_op_entry_map = dict()
+
+        if streaming:
+            return
+
         self.__split_trace(trace_reader, vfs_op_info)
         self.op_entry_list.sort(key = lambda x : x.min_seq)
 
+    def stream_ops(self):
+        '''
+        Yield each op entry once its end function is read.
+        The op entry list is sorted by min seq after the stream is exhausted.
+        '''
+        for entry_list in self.trace_reader.stream_entries():
+            op_entry = self.__split_entry_list(entry_list)
+            if op_entry:
+                yield op_entry
+        self.op_entry_list.sort(key = lambda x : x.min_seq)
+
     def __split_trace(self, trace_reader : TraceReader, vfs_op_info : SrcInfoReader):
-        first_mount = True
         for pid, seq_map in trace_reader.pid_seq_entry_map.items():
-            op_entry = None
-
             for seq, entry_list in sorted(seq_map.items()):
-                entry = entry_list[0]
-                entry : TraceEntry
-
-                # the pairs of function entries have been verified in trace reader.
-                if op_entry == None and entry.fn_name in vfs_op_info and entry.type == TraceType.kStartFn:
-                    op_entry = OpTraceEntry(entry, entry.fn_name, trace_reader.pm_addr, trace_reader.pm_size, pid)
-                    op_entry.add_entry_list(entry_list, add_to_pm=True)
-                    global_logger.debug("found new start function: %s" % (entry.fn_name))
-                elif op_entry and TraceEntry.is_pair_func_entry(op_entry.start_fn_entry, entry):
-                    op_entry.end_fn_entry = entry
-                    op_entry.add_entry_list(entry_list, add_to_pm=True)
-                    op_entry.finalize()
-                    if first_mount and "fill_super" in op_entry.op_name:
-                        first_mount = False
-                        continue
-                    self.op_entry_list.append(op_entry)
-                    op_entry = None
-                    global_logger.debug("found the end function: %s" % (entry.fn_name))
-                elif op_entry:
-                    op_entry.add_entry_list(entry_list, add_to_pm=True)
-                else:
-                    pass
+                self.__split_entry_list(entry_list)
+
+    def __split_entry_list(self, entry_list) -> OpTraceEntry:
+        ''' Return the op entry if it is ended by this entry list. '''
+        entry = entry_list[0]
+        entry : TraceEntry
+        pid = entry.pid
+        op_entry = self.pid_op_entry_map.get(pid)
+
+        # the pairs of function entries have been verified in trace reader.
+        if op_entry == None and entry.fn_name in self.vfs_op_info and entry.type == TraceType.kStartFn:
+            if not isKernelSpaceAddr(self.trace_reader.pm_addr):
+                log_msg = "no dax device information before the op [%s]" % (str(entry))
+                global_logger.critical(log_msg)
+                assert False, log_msg
+            op_entry = OpTraceEntry(entry, entry.fn_name, self.trace_reader.pm_addr, self.trace_reader.pm_size, pid)
+            op_entry.add_entry_list(entry_list, add_to_pm=True)
+            self.pid_op_entry_map[pid] = op_entry
+            global_logger.debug("found new start function: %s" % (entry.fn_name))
+        elif op_entry and TraceEntry.is_pair_func_entry(op_entry.start_fn_entry, entry):
+            op_entry.end_fn_entry = entry
+            op_entry.add_entry_list(entry_list, add_to_pm=True)
+            op_entry.finalize()
+            if self.first_mount and "fill_super" in op_entry.op_name:
+                # keep adding the following entries to the mount op
+                self.first_mount = False
+                return None
+            self.op_entry_list.append(op_entry)
+            self.pid_op_entry_map[pid] = None
+            global_logger.debug("found the end function: %s" % (entry.fn_name))
+            return op_entry
+        elif op_entry:
+            op_entry.add_entry_list(entry_list, add_to_pm=True)
+        else:
+            pass
+        return None
 
     def analysis_in_cache_run(self, cache, clear_per_split):
         cache.write_back_all_stores()
@@ -1,6 +1,7 @@
 import os
 import sys
 import time
+from bisect import bisect_left, bisect_right
 
 codebase_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../.."))
 sys.path.append(codebase_dir)
@@ -10,12 +11,14 @@ from scripts.trace_proc.pm_trace.pm_trace_split import is_pm_entry
 from scripts.trace_proc.pm_trace.pm_trace_split import pm_split_seq_entrylist_map
 from scripts.cache_sim.witcher.cache.entry_op_conv import convert_seq_entrylist_dict
 from scripts.cache_sim.witcher.cache.atomic_op import Store, Flush, Fence
-from scripts.cache_sim.witcher.cache.reorder_simulator import ReorderSimulator, get_write_dep_seq_map
+from scripts.cache_sim.witcher.cache.reorder_simulator import ReorderSimulator
+from scripts.cache_sim.witcher.cache.in_flight_tracker import InFlightTracker
 from tools.scripts.disk_content.ctx_file_reader import CtxFileReader, DiskEntryAttrs
 from scripts.utils.logger import global_logger
 import scripts.utils.logger as log
 from scripts.utils.utils import isUserSpaceAddr
 from scripts.utils.utils import getTimestamp
+from scripts.utils.const_var import CACHELINE_BYTES
 
 def timeit(func):
     """Decorator that prints the time a function takes to execute."""
@@ -64,6 +67,11 @@ class OpTraceEntry:
         self.pm_sorted_store_seq = []
         # the id is a list of instruction id in seq order.
         self.pm_op_id = []
+        # maps the cacheline of the start address of pm entries to the sorted
+        # seqs of them, built with pm_sorted_seq in finalize
+        self.pm_cl_seq_map = dict()
+        # the pm map is changed after the index is built
+        self.pm_index_dirty = True
 
         # this is atomic operation list of PM store-related operations
         self.atomic_op_list = []
@@ -112,19 +120,48 @@ class OpTraceEntry:
             return self.pm_seq_entry_map[seq]
         return None
 
+    def __build_pm_index(self):
+        self.pm_sorted_seq = sorted(self.pm_seq_entry_map.keys())
+        self.pm_cl_seq_map = dict()
+        for seq in self.pm_sorted_seq:
+            for entry in self.pm_seq_entry_map[seq]:
+                cl = entry.addr // CACHELINE_BYTES
+                seq_list = self.pm_cl_seq_map.get(cl)
+                if seq_list == None:
+                    self.pm_cl_seq_map[cl] = [seq]
+                elif seq_list[-1] != seq:
+                    seq_list.append(seq)
+        self.pm_index_dirty = False
+
+    def __get_pm_seqs_by_addr_range(self, addr1, addr2) -> list:
+        '''the sorted seqs of pm entries that start in [addr1, addr2]'''
+        if self.pm_index_dirty:
+            self.__build_pm_index()
+        if addr2 < addr1:
+            return []
+        cl1 = addr1 // CACHELINE_BYTES
+        cl2 = addr2 // CACHELINE_BYTES
+        if cl2 - cl1 + 1 > len(self.pm_cl_seq_map):
+            seq_lists = [v for k, v in self.pm_cl_seq_map.items() if cl1 <= k <= cl2]
+        else:
+            seq_lists = [self.pm_cl_seq_map[cl] for cl in range(cl1, cl2 + 1) if cl in self.pm_cl_seq_map]
+        if len(seq_lists) == 1:
+            return seq_lists[0]
+        return sorted(set().union(*seq_lists))
+
     def get_pm_ops_by_seq_range(self, seq1, seq2):
         '''return a list of a list of entries'''
-        rst = []
-        for seq, entry_list in self.pm_seq_entry_map.items():
-            if seq1 <= seq <= seq2:
-                rst.append(entry_list)
-        return rst
+        if self.pm_index_dirty:
+            self.__build_pm_index()
+        begin = bisect_left(self.pm_sorted_seq, seq1)
+        end = bisect_right(self.pm_sorted_seq, seq2)
+        return [self.pm_seq_entry_map[seq] for seq in self.pm_sorted_seq[begin:end]]
 
     def get_pm_ops_by_addr_range(self, addr1, addr2):
         '''return a list of a list of entries'''
         rst = []
-        for seq, entry_list in self.pm_seq_entry_map.items():
-            for entry in entry_list:
+        for seq in self.__get_pm_seqs_by_addr_range(addr1, addr2):
+            for entry in self.pm_seq_entry_map[seq]:
                 entry : TraceEntry
                 if addr1 <= entry.addr and entry.addr + entry.size <= addr2:
                     rst.append(entry)
@@ -133,10 +170,9 @@ class OpTraceEntry:
     def get_pm_ops_by_seq_addr_range(self, seq1, seq2, addr1, addr2):
         '''return a list of a list of entries'''
         rst = []
-        for seq, entry_list in self.pm_seq_entry_map.items():
-            if seq < seq1 or seq2 < seq:
-                continue
-            for entry in entry_list:
+        seq_list = self.__get_pm_seqs_by_addr_range(addr1, addr2)
+        for seq in seq_list[bisect_left(seq_list, seq1):bisect_right(seq_list, seq2)]:
+            for entry in self.pm_seq_entry_map[seq]:
                 entry : TraceEntry
                 if addr1 <= entry.addr and entry.addr + entry.size <= addr2:
                     rst.append(entry)
@@ -163,16 +199,20 @@ class OpTraceEntry:
 
         if add_to_pm and is_pm_entry(entry, self.pm_addr, self.pm_size):
             self.pm_seq_entry_map[entry.seq] = entry_list
+            self.pm_index_dirty = True
 
     def init_pm_entries(self):
         '''Even we could add entries to pm in adding, we still provide an function to rebuild pm map in needed'''
         self.pm_seq_entry_map = pm_split_seq_entrylist_map(self.seq_entry_map, self.pm_addr, self.pm_size)
+        self.pm_index_dirty = True
 
     def finalize(self):
-        self.pm_sorted_seq = []
+        # the mount op may be finalized more than once
+        self.__build_pm_index()
         self.pm_op_id = []
-        for seq, entry_list in sorted(self.pm_seq_entry_map.items()):
-            self.pm_sorted_seq.append(seq)
+        self.pm_sorted_store_seq = []
+        for seq in self.pm_sorted_seq:
+            entry_list = self.pm_seq_entry_map[seq]
             self.pm_op_id.append(entry_list[0].instid)
             if entry_list[0].type.isStoreSeries():
                 self.pm_sorted_store_seq.append(entry_list[0].seq)
@@ -203,6 +243,9 @@ class OpTraceEntry:
                                     force=force)
 
         self.reorder_simulator = ReorderSimulator(cache, consider_ow=True)
+        # the in-flight clusters and write deps are computed from the stores
+        # changed since the last fence, instead of walking the whole cache
+        tracker = InFlightTracker.from_op_list(self.atomic_op_list, cache)
         self.in_fight_store_num = []
         self.in_flight_seq_cluster_map = dict()
         self.in_flight_cluster_seq_map = dict()
@@ -211,60 +254,40 @@ class OpTraceEntry:
         for op in self.atomic_op_list:
             if isinstance(op, Store):
                 cache.accept(op)
+                tracker.accept(op)
             elif isinstance(op, Flush):
                 cache.accept(op)
+                tracker.accept(op)
             elif isinstance(op, Fence):
-                self.in_fight_store_num.append(cache.get_in_fight_nums())
+                self.in_fight_store_num.append(tracker.get_in_flight_nums())
                 if self.reorder_simulator:
                     self.num_cps_map[op.seq] = self.reorder_simulator.get_reorder_nums()
 
-                tmp_dep_map = get_write_dep_seq_map(cache)
-                for k_seq, v_set in tmp_dep_map.items():
-                    if k_seq not in self.write_dep_seq_map:
-                        self.write_dep_seq_map[k_seq] = set()
-                    self.write_dep_seq_map[k_seq] |= v_set
-
                 in_flight_cluster_num += 1
-                self.in_flight_cluster_seq_map[in_flight_cluster_num] = []
-                self.in_flight_cluster_flushing_map[in_flight_cluster_num] = [x.seq for x in cache.get_all_flushing_ops()]
-                for op in cache.get_in_fight_ops():
-                    self.in_flight_cluster_seq_map[in_flight_cluster_num].append(op.seq)
-                    if op.seq not in self.in_flight_seq_cluster_map:
-                        self.in_flight_seq_cluster_map[op.seq] = []
-                    self.in_flight_seq_cluster_map[op.seq].append(in_flight_cluster_num)
+                self.__add_in_flight_cluster(tracker, in_flight_cluster_num)
 
                 cache.accept(op)
                 cache.write_back_all_flushing_stores()
                 cache.write_back_all_persisted_stores()
+                tracker.accept(op)
             else:
                 assert False, "invalid op type, %s, %s" % (type(op), str(op))
 
         # the last ops that still in cache
-        tmp_dep_map = get_write_dep_seq_map(cache)
-        for k_seq, v_set in tmp_dep_map.items():
-            if k_seq not in self.write_dep_seq_map:
-                self.write_dep_seq_map[k_seq] = set()
-            self.write_dep_seq_map[k_seq] |= v_set
-
         in_flight_cluster_num += 1
-        self.in_flight_cluster_seq_map[in_flight_cluster_num] = []
-        self.in_flight_cluster_flushing_map[in_flight_cluster_num] = [x.seq for x in cache.get_all_flushing_ops()]
-        for op in cache.get_in_fight_ops():
-            self.in_flight_cluster_seq_map[in_flight_cluster_num].append(op.seq)
-            if op.seq not in self.in_flight_seq_cluster_map:
-                self.in_flight_seq_cluster_map[op.seq] = []
-            self.in_flight_seq_cluster_map[op.seq].append(in_flight_cluster_num)
+        self.__add_in_flight_cluster(tracker, in_flight_cluster_num)
 
         # Q: do we need to flush all stores at the end of the function?
         # A: yes, the end of VFS op triggers a context switch, which implies a fence
-        self.in_fight_store_num.append(cache.get_in_fight_nums())
+        self.in_fight_store_num.append(tracker.get_in_flight_nums())
         if self.reorder_simulator:
             self.num_cps_map[sys.maxsize] = self.reorder_simulator.get_reorder_nums()
         cache.write_back_all_flushing_stores()
+        tracker.write_back_all_flushing_stores()
 
         in_flight_cluster_num += 1
-        self.in_flight_cluster_seq_map[in_flight_cluster_num] = [x.seq for x in cache.get_in_fight_ops()]
-        self.in_flight_cluster_flushing_map[in_flight_cluster_num] = [x.seq for x in cache.get_in_fight_ops()]
+        self.in_flight_cluster_seq_map[in_flight_cluster_num] = tracker.get_in_flight_seqs()
+        self.in_flight_cluster_flushing_map[in_flight_cluster_num] = tracker.get_in_flight_seqs()
 
         self.dup_fences = cache.dup_fence_list
         self.dup_flushes = cache.dup_flush_list
@@ -281,6 +304,20 @@ class OpTraceEntry:
         global_logger.info("unflushed stores: %s" % (self.unflushed_stores.__str__()))
         global_logger.info("write dep seq map: %s" % (str(self.write_dep_seq_map)))
 
+    def __add_in_flight_cluster(self, tracker : InFlightTracker, cluster_num):
+        tmp_dep_map = tracker.get_new_write_dep_seq_map()
+        for k_seq, v_set in tmp_dep_map.items():
+            if k_seq not in self.write_dep_seq_map:
+                self.write_dep_seq_map[k_seq] = set()
+            self.write_dep_seq_map[k_seq] |= v_set
+
+        self.in_flight_cluster_flushing_map[cluster_num] = tracker.get_flushing_seqs()
+        self.in_flight_cluster_seq_map[cluster_num] = tracker.get_in_flight_seqs()
+        for seq in self.in_flight_cluster_seq_map[cluster_num]:
+            if seq not in self.in_flight_seq_cluster_map:
+                self.in_flight_seq_cluster_map[seq] = []
+            self.in_flight_seq_cluster_map[seq].append(cluster_num)
+
     def get_cache_analysis_result(self) -> str:
         def helper(lst):
             data = ""
@@ -1,6 +1,6 @@
 import os
 import sys
-from intervaltree import Interval, IntervalTree
+from bisect import bisect_left
 
 codebase_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../.."))
 sys.path.append(codebase_dir)
@@ -17,44 +17,27 @@ class AddrToStInfoEntry:
         # the struct info
         self.stinfo : StructInfo = stinfo
 
-        # the beginning addr of variables
-        self.var_addr_set = set()
-
-        # address interval to variable map
-        self.addr_to_var_iv = IntervalTree()
-
-        self.__init()
-
     def contains(self, begin, end) -> bool:
         return (self.addr <= begin and end <= self.addr + self.stinfo.size_bytes)
 
     def aligned_addr(self, addr) -> bool:
         '''return true if the addr is aligned to variable's addr'''
-        return addr in self.var_addr_set
+        offset = addr - self.addr
+        if offset == 0:
+            return True
+        _, offsets = self.stinfo.get_sorted_vars()
+        i = bisect_left(offsets, offset)
+        return i < len(offsets) and offsets[i] == offset
 
     def get_var_by_addr(self, addr) -> StructMemberVar:
-        ivs = self.addr_to_var_iv[addr]
-        if len(ivs) == 0:
+        vars = self.get_vars_by_iv(addr, addr + 1)
+        if len(vars) == 0:
             return None
-        return list(ivs)[0].data
+        return vars[0]
 
     def get_vars_by_iv(self, begin, end) -> list:
         '''return a list of StructMemberVar, sorted by offset'''
-        rst = []
-        ivs = self.addr_to_var_iv[begin:end]
-        for iv in ivs:
-            rst.append(iv.data)
-        rst.sort(key = lambda x : x.offset_bytes)
-        return rst
-
-    def __init(self):
-        addr = self.addr
-        self.var_addr_set.add(addr)
-        for var in self.stinfo.children:
-            var : StructMemberVar
-
-            self.var_addr_set.add(addr + var.offset_bytes)
-            self.addr_to_var_iv[addr + var.offset_bytes : addr + var.offset_bytes + var.size_bytes] = var
+        return self.stinfo.get_vars_by_offset(begin - self.addr, end - self.addr)
 
     def __str__(self) -> str:
         return "[%s, %s, %s]" % (hex(self.addr), hex(self.addr + self.stinfo.size_bytes), str(self.stinfo.struct_name))
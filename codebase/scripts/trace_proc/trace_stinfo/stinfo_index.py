@@ -1,7 +1,10 @@
 import os
 import sys
 import time
-from intervaltree import Interval, IntervalTree
+from array import array
+from bisect import bisect_right
+from functools import lru_cache
+from intervaltree import Interval
 
 scripts_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
 sys.path.append(scripts_dir)
@@ -25,8 +28,73 @@ def timeit(func):
     return wrapper
 
 
+class StInfoSegIndex:
+    '''
+    Sorted, non-overlapping address segments of the struct casts in one pid.
+    The segment [bounds[i], bounds[i+1]) maps to the interned stinfo set of
+    set_ids[i], which is -1 if no struct covers the segment. A stinfo set is a
+    tuple sorted by the address and then the size, so that the inner struct
+    comes first when the structs start at the same address.
+    '''
+    def __init__(self, bounds : array, set_ids : array, stinfo_sets : list) -> None:
+        self.bounds = bounds
+        self.set_ids = set_ids
+        self.stinfo_sets = stinfo_sets
+
+    @classmethod
+    def build(cls, ranges : list, stinfo_set_ids : dict, stinfo_sets : list):
+        '''ranges is a list of [begin, end, AddrToStInfoEntry]'''
+        starts = dict()
+        ends = dict()
+        for begin, end, addr_stinfo in ranges:
+            if begin >= end:
+                continue
+            starts.setdefault(begin, []).append(addr_stinfo)
+            ends.setdefault(end, []).append(addr_stinfo)
+
+        bounds = array('Q', sorted(starts.keys() | ends.keys()))
+        set_ids = array('q')
+        # covering count of each struct in the current segment
+        active = dict()
+        for addr in bounds:
+            for addr_stinfo in ends.get(addr, []):
+                active[addr_stinfo] -= 1
+                if active[addr_stinfo] == 0:
+                    del active[addr_stinfo]
+            for addr_stinfo in starts.get(addr, []):
+                active[addr_stinfo] = active.get(addr_stinfo, 0) + 1
+
+            if len(active) == 0:
+                set_ids.append(-1)
+                continue
+            key = frozenset(active)
+            set_id = stinfo_set_ids.get(key)
+            if set_id == None:
+                set_id = len(stinfo_sets)
+                stinfo_set_ids[key] = set_id
+                stinfo_sets.append(tuple(sorted(key, key=lambda x : (x.addr, x.stinfo.size_bytes, x.stinfo.struct_name))))
+            set_ids.append(set_id)
+        return cls(bounds, set_ids, stinfo_sets)
+
+    def query(self, addr) -> Interval:
+        '''return the segment that contains the addr, or None'''
+        i = bisect_right(self.bounds, addr) - 1
+        if i < 0 or i >= len(self.set_ids) or self.set_ids[i] < 0:
+            return None
+        return Interval(self.bounds[i], self.bounds[i + 1], self.stinfo_sets[self.set_ids[i]])
+
+    def __iter__(self):
+        for i in range(len(self.set_ids)):
+            if self.set_ids[i] >= 0:
+                yield Interval(self.bounds[i], self.bounds[i + 1], self.stinfo_sets[self.set_ids[i]])
+
+    def __len__(self):
+        return sum(1 for x in self.set_ids if x >= 0)
+
 class StInfoIndex:
     PADDING_MIN_SIZE = 16
+    # the max number of (struct name, offset, size) kept by the member variable memo
+    VAR_MEMO_SIZE = 65536
     def __init__(self, trace_reader : TraceReader, stinfo_reader : StructInfoReader) -> None:
         self.trace_reader = trace_reader
         self.stinfo_reader = stinfo_reader
@@ -34,14 +102,35 @@ class StInfoIndex:
         # use to record the min structure size
         self.min_st_size = sys.maxsize
 
-        # the key is pid, the value is a interval tree
+        # the key is pid, the value is a StInfoSegIndex
         self.pid_addr_to_stinfo_iv = dict()
 
+        # interned stinfo sets shared by the segments of all pids
+        self.stinfo_set_ids = dict()
+        self.stinfo_sets = []
+
+        # (struct name, offset, size) : member variables, the same instruction
+        # usually accesses the same variable of the same struct
+        self.__resolve_vars = lru_cache(maxsize=self.VAR_MEMO_SIZE)(self.__resolve_vars_nocache)
+
         self.__init()
         self.__init_trace_entry_stinfo()
 
+    def __resolve_vars_nocache(self, st_name, offset, size) -> tuple:
+        '''
+        Return the member variables of [offset, offset + size) in the struct,
+        or None if the struct cannot fully contain it.
+        '''
+        stinfo : StructInfo = self.stinfo_reader.struct_dict[st_name]
+        if offset < 0 or offset + size > stinfo.size_bytes:
+            return None
+        return tuple(stinfo.get_vars_by_offset(offset, offset + size))
+
     @timeit
     def __init(self):
+        # the key is pid, the value is a list of [begin, end, AddrToStInfoEntry]
+        pid_ranges = dict()
+
         def helper(pid, addr, size, st_name):
             if st_name in self.stinfo_reader.struct_dict:
                 stinfo : StructInfo = self.stinfo_reader.struct_dict[st_name]
@@ -58,19 +147,20 @@ class StInfoIndex:
                     stinfo.size_bits = size * 8
 
                 addr_stinfo = AddrToStInfoEntry(addr, stinfo)
-                self.pid_addr_to_stinfo_iv[pid][addr : addr + size] = set(addr_stinfo)
+                pid_ranges[pid].append([addr, addr + size, addr_stinfo])
                 self.min_st_size = min(self.min_st_size, addr_stinfo.stinfo.size_bytes)
 
-                log_msg = f'{pid}: {st_name} add range [{hex(addr)}, {hex(addr+size)}] -> {addr_stinfo}'
-                log.global_logger.debug(log_msg)
+                if log.debug:
+                    log_msg = f'{pid}: {st_name} add range [{hex(addr)}, {hex(addr+size)}] -> {addr_stinfo}'
+                    log.global_logger.debug(log_msg)
 
                 # add member variables if it is a nested structure
                 for var in stinfo.children:
                     helper(pid, addr + var.offset_bytes, size - var.offset_bytes, var.type_name)
 
         for pid, mp in self.trace_reader.pid_seq_entry_map.items():
-            if pid not in self.pid_addr_to_stinfo_iv:
-                self.pid_addr_to_stinfo_iv[pid] = IntervalTree()
+            if pid not in pid_ranges:
+                pid_ranges[pid] = []
             for seq, entry_list in mp.items():
                 for entry in entry_list:
                     entry : TraceEntry
@@ -85,26 +175,16 @@ class StInfoIndex:
 
                         helper(pid, addr, size, st_name)
 
-        # worst-case O(n^2*log n), best-case O(n*log n)
-        log.global_logger.debug("start split overlaps")
-        for pid, iv_tree in self.pid_addr_to_stinfo_iv.items():
-            iv_tree.split_overlaps()
-        log.global_logger.debug("end split overlaps")
-
-        # Completes in O(n*log n)
-        log.global_logger.debug("start merge equals")
-        def data_reducer(s1, s2):
-            return s1 | s2
-        for pid, iv_tree in self.pid_addr_to_stinfo_iv.items():
-            iv_tree.merge_equals(data_reducer)
-        log.global_logger.debug("end merge equals")
+        # one sweep over the sorted range boundaries, O(n*log n)
+        for pid, ranges in pid_ranges.items():
+            self.pid_addr_to_stinfo_iv[pid] = StInfoSegIndex.build(ranges, self.stinfo_set_ids, self.stinfo_sets)
 
         if log.debug:
             log_msg = "struct info index intervals: \n"
             log.global_logger.debug(log_msg)
-            for pid, iv_tree in self.pid_addr_to_stinfo_iv.items():
-                for iv in iv_tree:
-                    log_msg = "%d: [%s, %s] %s" % (pid, hex(iv.begin), hex(iv.end), str(iv.data))
+            for pid, seg_index in self.pid_addr_to_stinfo_iv.items():
+                for iv in seg_index:
+                    log_msg = "%d: [%s, %s] %s" % (pid, hex(iv.begin), hex(iv.end), str(set(iv.data)))
                     log.global_logger.debug(log_msg)
 
     @timeit
@@ -121,27 +201,25 @@ class StInfoIndex:
                             (entry.type.isStoreSeries() or entry.type.isLoadSeries())):
                         continue
 
-                    iv_set = self.pid_addr_to_stinfo_iv[pid][addr]
-                    if len(iv_set) == 0:
+                    iv = self.pid_addr_to_stinfo_iv[pid].query(addr)
+                    if not iv:
                         # if no data type, e.g., PMFS's extent tree
-                        log_msg = "no intervals match the point query, %s, %s" \
-                                % (str(entry), str(iv_set))
+                        log_msg = "no intervals match the point query, %s" % (str(entry))
                         log.global_logger.warning(log_msg)
-                    elif len(iv_set) > 1:
-                        # Is this should be okay? Length-vairable structure?
-                        err_msg = "more than one intervals match the point query, %s, %s" \
-                                % (str(entry), str(iv_set))
-                        log.global_logger.warning(err_msg)
                     else:
-                        stinfo_list = list(iv_set)[0].data
-                        log_msg = f"{pid}: found struct info for op, {str(entry)}, {str(stinfo_list)}"
-                        log.global_logger.debug(log_msg)
-
-                        # filter out stinfo that cannot fully contain this entry
-                        stinfo_list = [x for x in stinfo_list if x.contains(entry.addr, entry.addr + entry.size)]
+                        stinfo_list = iv.data
+                        if log.debug:
+                            log_msg = f"{pid}: found struct info for op, {str(entry)}, {str(set(stinfo_list))}"
+                            log.global_logger.debug(log_msg)
 
-                        # get the corresponding variables
-                        stinfo_list = [[x, x.get_vars_by_iv(entry.addr, entry.addr + entry.size)] for x in stinfo_list]
+                        # filter out stinfo that cannot fully contain this entry,
+                        # and get the corresponding variables
+                        candidates = stinfo_list
+                        stinfo_list = []
+                        for x in candidates:
+                            vars = self.__resolve_vars(x.stinfo.struct_name, entry.addr - x.addr, entry.size)
+                            if vars != None:
+                                stinfo_list.append([x, list(vars)])
                         last_stinfo_list = stinfo_list
 
                         if len(stinfo_list) > 1:
@@ -153,8 +231,9 @@ class StInfoIndex:
                             entry.stinfo_list = stinfo_list
                             entry.stinfo_match = stinfo_list[0][0]
                             entry.var_list = sorted(list(stinfo_list[0][1]), key = lambda x : x.offset_bytes)
-                            log_msg = "found one matched struct info for entry, %s, %s, %s" % (str(entry), str(entry.stinfo_match), str(entry.stinfo_list))
-                            log.global_logger.debug(log_msg)
+                            if log.debug:
+                                log_msg = "found one matched struct info for entry, %s, %s, %s" % (str(entry), str(entry.stinfo_match), str(entry.stinfo_list))
+                                log.global_logger.debug(log_msg)
                         else:
                             # elif len(stinfo_list) == 0:
                             entry.stinfo_list = last_stinfo_list
@@ -162,24 +241,19 @@ class StInfoIndex:
                             log_msg = "does not find matched struct info for entry, %s, %s, %s" % (str(entry), str(entry.stinfo_match), str(entry.stinfo_list))
                             log.global_logger.warning(log_msg)
 
+        memo_info = self.__resolve_vars.cache_info()
+        log.time_logger.info(f"count.guest.stinfo_index.var_memo_hits:{memo_info.hits}")
+        log.time_logger.info(f"count.guest.stinfo_index.var_memo_misses:{memo_info.misses}")
 
     def point_query_iv(self, pid, addr) -> Interval:
         if pid not in self.pid_addr_to_stinfo_iv:
             return None
-        iv_set = self.pid_addr_to_stinfo_iv[pid][addr]
-        if len(iv_set) == 0:
+        iv = self.pid_addr_to_stinfo_iv[pid].query(addr)
+        if not iv:
             # if there is an operation 'memcpy(src, dst, size)' without
             # the struct cast of the dst address, the point query in
-            # the intervaltree will return None.
-            log_msg = "no intervals match the point query, %s, %s" \
-                    % (hex(addr), str(iv_set))
+            # the index will return None.
+            log_msg = "no intervals match the point query, %s" % (hex(addr))
             log.global_logger.warning(log_msg)
             return None
-        elif len(iv_set) > 1:
-            err_msg = "more than one intervals match the point query, %s, %s" \
-                    % (hex(addr), str(iv_set))
-            log.global_logger.error(err_msg)
-            assert False, err_msg
-        else:
-            pass
-        return list(iv_set)[0]
+        return iv
@@ -1,4 +1,5 @@
 CACHELINE_BYTES=64
+PAGE_BYTES=4096
 ATOMIC_WRITE_BYTES=8
 
 # min space in the image device, in GiB
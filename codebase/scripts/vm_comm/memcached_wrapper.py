@@ -4,6 +4,7 @@ from distutils.util import strtobool
 import traceback
 import socket
 import time
+import threading
 import pymemcache.exceptions as pymc_exception
 from pymemcache.client.base import _readline
 from pymemcache.client.base import Client as CMClient
@@ -21,11 +22,16 @@ import scripts.utils.logger as log
 MC_CONNECT_TIMEOUT = 5
 MC_CMD_TIMEOUT = 5
 MC_CMD_RETRY_TIMES = 5
+# flush the batch client when it buffers this number of ops
+MC_BATCH_MAX_OPS = 256
+# flush the batch client every this seconds
+MC_BATCH_FLUSH_INTERVAL = 1.0
 
 glo_vm_id = None
 glo_mc_server = None
 glo_mc_port = None
 glo_mc_pool_client : CMPooledClient = None
+glo_mc_batch_client = None
 
 def timeit(func):
     """Decorator that prints the time a function takes to execute."""
@@ -342,7 +348,7 @@ def custom_raw_incr(mc_client : CMPooledClient, key, num):
     finally:
         log.flush_all()
 
-def mc_add_wrapper(mc_client : CMPooledClient, key, value, noreply=False):
+def mc_add_wrapper(mc_client : CMPooledClient, key, value, noreply=False, expire=0):
     ret = None
     try:
         retry_times = MC_CMD_RETRY_TIMES
@@ -354,7 +360,7 @@ def mc_add_wrapper(mc_client : CMPooledClient, key, value, noreply=False):
             retry_times -= 1
             try:
                 # use pymemcached and the custom raw add in interleaving
-                return mc_client.add(key, value, noreply=noreply)
+                return mc_client.add(key, value, expire=expire, noreply=noreply)
 
             except Exception as e:
                 msg = f"mc add exception: {e} at the {MC_CMD_RETRY_TIMES-retry_times}-th try"
@@ -505,3 +511,241 @@ def mc_flush_all_wrapper(mc_client : CMPooledClient):
         raise GuestExceptionForDebug(msg)
     finally:
         log.flush_all()
+
+def _run_on_client(mc_client : CMPooledClient, func):
+    '''Run func with a Client, since PooledClient does not export the pipelined commands.'''
+    if isinstance(mc_client, CMPooledClient):
+        with mc_client.client_pool.get_and_release(destroy_on_fail=True) as client:
+            return func(client)
+    return func(mc_client)
+
+def _mc_many_retry(mc_client : CMPooledClient, cmd_name : str, func, key_value_map : dict, idempotent=True) -> dict:
+    '''
+    Run func(client, key_value_map) that pipelines a command of all keys in a
+    round trip and returns {key : result}. A key whose result is None is
+    retried, like the single-key wrappers.
+    If func raises, some of the commands may have been applied. The commands
+    are sent again only if they are idempotent (e.g., set). Otherwise, an incr
+    would be applied twice, and an add would return NOT_STORED for a key that
+    it has stored, thus MemcachedOPFailed is raised.
+    '''
+    rst = dict()
+    try:
+        remaining = dict(key_value_map)
+        retry_times = MC_CMD_RETRY_TIMES
+        while retry_times > 0 and len(remaining) > 0:
+            if retry_times != MC_CMD_RETRY_TIMES:
+                # the connection will be reestablishes when issusing cmd
+                mc_client.close()
+
+            retry_times -= 1
+            try:
+                for key, ret in _run_on_client(mc_client, lambda client: func(client, remaining)).items():
+                    if ret != None:
+                        rst[key] = ret
+                        del remaining[key]
+            except Exception as e:
+                msg = f"mc {cmd_name} exception: {e} at the {MC_CMD_RETRY_TIMES-retry_times}-th try"
+                log.global_logger.error(msg)
+                if not idempotent:
+                    msg = f"{traceback.format_exc()}\nmc {cmd_name} is not retried after an exception, the results of the keys are unknown: {list(remaining.keys())}"
+                    log.global_logger.error(msg)
+                    raise MemcachedOPFailed(msg)
+            finally:
+                log.flush_all()
+
+        if len(remaining) == 0:
+            return rst
+
+        msg = f"{traceback.format_exc()}\nmc {cmd_name} failed after trying {MC_CMD_RETRY_TIMES} times, keys: {list(remaining.keys())}"
+        log.global_logger.error(msg)
+        raise MemcachedOPFailed(msg)
+    except MemcachedOPFailed as e:
+        raise
+    except MemcacheUnexpectedCloseError as e:
+        msg = f"{traceback.format_exc()}\nmc {cmd_name} exception: {e}"
+        log.global_logger.error(msg)
+        raise GuestExceptionForDebug(msg)
+    except TimeoutError as e:
+        msg = f"{traceback.format_exc()}\nmc {cmd_name} timeout: {e}"
+        log.global_logger.error(msg)
+        raise MemcachedOPFailed(msg)
+    except Exception as e:
+        msg = f"{traceback.format_exc()}\nmc {cmd_name} unknown exceptions: {e}"
+        log.global_logger.error(msg)
+        raise GuestExceptionForDebug(msg)
+    finally:
+        log.flush_all()
+
+def _pymc_pipelined_cmd(client : CMClient, cmd_name : bytes, key_value_map : dict, expire=0) -> dict:
+    '''
+    Send the add or incr commands of all keys in a round trip, returns {key : result}.
+    pymemcache does not export them, the batched commands use its private
+    methods only here: Client._store_cmd, Client._misc_cmd and
+    Client._check_integer, as of pymemcache 4.0.0. Check them when upgrading.
+    '''
+    if cmd_name == b"add":
+        # {key : True if stored, False if NOT_STORED}
+        return client._store_cmd(b"add", key_value_map, expire, False)
+
+    assert cmd_name == b"incr", f"unsupported pipelined command: {cmd_name}"
+    keys = list(key_value_map.keys())
+    cmds = []
+    for key in keys:
+        cmds.append(b"incr " + client.check_key(key, client.key_prefix) + b" " + client._check_integer(key_value_map[key], "value") + b"\r\n")
+    results = client._misc_cmd(cmds, b"incr", False)
+    return {key : None if line == b"NOT_FOUND" else int(line) for key, line in zip(keys, results)}
+
+def _set_many(client : CMClient, key_value_map : dict) -> dict:
+    failed_keys = set(client.set_many(key_value_map, noreply=False))
+    return {key : None if key in failed_keys else True for key in key_value_map}
+
+def _incr_many(client : CMClient, key_num_map : dict) -> dict:
+    # NOT_FOUND is retried, nothing is incremented for it
+    return _pymc_pipelined_cmd(client, b"incr", key_num_map)
+
+@timeit
+def mc_set_many_wrapper(mc_client : CMPooledClient, key_value_map : dict):
+    '''Set the keys in a pipelined round trip.'''
+    if len(key_value_map) == 0:
+        return True
+    _mc_many_retry(mc_client, 'set_many', _set_many, key_value_map)
+    return True
+
+@timeit
+def mc_incr_many_wrapper(mc_client : CMPooledClient, key_num_map : dict) -> dict:
+    '''Incr the keys in a pipelined round trip, returns {key : incremented number}.'''
+    if len(key_num_map) == 0:
+        return dict()
+    return _mc_many_retry(mc_client, 'incr_many', _incr_many, key_num_map, idempotent=False)
+
+@timeit
+def mc_add_many_wrapper(mc_client : CMPooledClient, key_value_map : dict, expire=0) -> dict:
+    '''Add the keys in a pipelined round trip, returns {key : whether it is added}.'''
+    if len(key_value_map) == 0:
+        return dict()
+    return _mc_many_retry(mc_client, 'add_many', lambda client, values: _pymc_pipelined_cmd(client, b"add", values, expire), key_value_map, idempotent=False)
+
+class MemcachedBatchClient:
+    '''
+    Buffer the sets and the incrs whose results are not used by the callers
+    (e.g., the reports and the counters), and send them by a pipelined set_many
+    and a pipelined incr of the aggregated numbers. The buffer is flushed when
+    it has max_ops ops, or every flush_interval seconds by a daemon thread.
+    The sets are sent before the incrs, thus a key that is both set and
+    incremented flushes the buffer first to keep the order.
+    '''
+    def __init__(self, mc_client : CMPooledClient, max_ops=MC_BATCH_MAX_OPS, flush_interval=MC_BATCH_FLUSH_INTERVAL):
+        self.mc_client = mc_client
+        self.max_ops = max_ops
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        # the flushes are serialized, so that the ops of a key are sent in order
+        self.flush_lock = threading.Lock()
+        self.pending_sets = dict()
+        self.pending_incrs = dict()
+        self.num_ops = 0
+
+        self.stop_event = threading.Event()
+        self.flush_thread = None
+        if self.flush_interval > 0:
+            self.flush_thread = threading.Thread(target=self.__flush_periodically, daemon=True)
+            self.flush_thread.start()
+
+    def __flush_periodically(self):
+        while not self.stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                # the ops are kept and sent by the next flush
+                msg = f"periodic flush of memcached batch client failed: {e}"
+                log.global_logger.error(msg)
+
+    def set(self, key, value):
+        with self.lock:
+            conflict = key in self.pending_incrs
+        if conflict:
+            self.flush()
+        with self.lock:
+            self.pending_sets[key] = value
+            self.num_ops += 1
+            full = self.num_ops >= self.max_ops
+        if full:
+            self.flush()
+
+    def incr(self, key, num):
+        with self.lock:
+            conflict = key in self.pending_sets
+        if conflict:
+            self.flush()
+        with self.lock:
+            self.pending_incrs[key] = self.pending_incrs.get(key, 0) + num
+            self.num_ops += 1
+            full = self.num_ops >= self.max_ops
+        if full:
+            self.flush()
+
+    def flush(self, timeout=-1) -> bool:
+        '''
+        Send the buffered ops. Returns False if the locks are not acquired in
+        timeout seconds, e.g., in a signal handler that interrupts a flush.
+        '''
+        if not self.flush_lock.acquire(timeout=timeout):
+            return False
+        try:
+            if not self.lock.acquire(timeout=timeout):
+                return False
+            pending_sets = self.pending_sets
+            pending_incrs = self.pending_incrs
+            self.pending_sets = dict()
+            self.pending_incrs = dict()
+            self.num_ops = 0
+            self.lock.release()
+
+            try:
+                mc_set_many_wrapper(self.mc_client, pending_sets)
+            except Exception:
+                # put back the ops that are not sent, the new sets are newer
+                with self.lock:
+                    for key, value in pending_sets.items():
+                        self.pending_sets.setdefault(key, value)
+                    for key, num in pending_incrs.items():
+                        self.pending_incrs[key] = self.pending_incrs.get(key, 0) + num
+                    self.num_ops = len(self.pending_sets) + len(self.pending_incrs)
+                raise
+            # the incrs are not put back if failed, since some of them may
+            # have been incremented
+            mc_incr_many_wrapper(self.mc_client, pending_incrs)
+            return True
+        finally:
+            self.flush_lock.release()
+
+    def close(self):
+        self.stop_event.set()
+        if self.flush_thread:
+            self.flush_thread.join()
+        self.flush()
+
+def setup_memcached_batch_client(mc_client : CMPooledClient, max_ops=MC_BATCH_MAX_OPS, flush_interval=MC_BATCH_FLUSH_INTERVAL):
+    global glo_mc_batch_client
+    glo_mc_batch_client = MemcachedBatchClient(mc_client, max_ops, flush_interval)
+    return glo_mc_batch_client
+
+def mc_set_deferred(mc_client : CMPooledClient, key, value):
+    '''Set by the batch client if it is set up, otherwise set now. The value must not be read back soon.'''
+    if glo_mc_batch_client != None:
+        glo_mc_batch_client.set(key, value)
+    else:
+        mc_set_wrapper(mc_client, key, value)
+
+def mc_incr_deferred(mc_client : CMPooledClient, key, num):
+    '''Incr by the batch client if it is set up, otherwise incr now. The incremented number is not returned.'''
+    if glo_mc_batch_client != None:
+        glo_mc_batch_client.incr(key, num)
+    else:
+        mc_incr_wrapper(mc_client, key, num)
+
+def mc_flush_deferred(timeout=-1) -> bool:
+    if glo_mc_batch_client != None:
+        return glo_mc_batch_client.flush(timeout)
+    return True
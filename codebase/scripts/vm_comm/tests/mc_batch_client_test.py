@@ -0,0 +1,139 @@
+import os
+import sys
+import time
+import logging
+from pymemcache.client.base import PooledClient as CMPooledClient
+
+codebase_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../.."))
+sys.path.append(codebase_dir)
+
+import scripts.utils.logger as log
+import scripts.vm_comm.memcached_wrapper as mc_wrapper
+from scripts.vm_comm.memcached_wrapper import setup_memcached_pooled_client, MemcachedBatchClient
+from scripts.utils.exceptions import MemcachedOPFailed
+
+# the tests need a memcached server
+MC_HOST = '127.0.0.1'
+MC_PORT = 11211
+
+def get_passed_str():
+    return '\033[92m' + 'passed' + '\033[0m'
+
+def get_failed_str():
+    return '\033[91m' + 'failed' + '\033[0m'
+
+def log_result(name, ok):
+    if ok:
+        log.global_logger.info("%s: %s" % (name, get_passed_str()))
+    else:
+        log.global_logger.info("%s: %s" % (name, get_failed_str()))
+
+def gen_key(name):
+    # the keys of each run are new, since the tests do not delete them
+    return f'test_mc_batch.{time.time_ns()}.{name}'
+
+def get_int(memcached_client : CMPooledClient, key):
+    value = memcached_client.get(key)
+    return int(value) if value != None else None
+
+def test_set_then_incr(memcached_client : CMPooledClient):
+    '''The incrs of a key that has a buffered set are sent after the set.'''
+    key = gen_key('set_then_incr')
+    batch_client = MemcachedBatchClient(memcached_client, max_ops=1000, flush_interval=0)
+    batch_client.set(key, 10)
+    for i in range(5):
+        batch_client.incr(key, 1)
+    # the first incr flushes the set
+    ok = get_int(memcached_client, key) == 10
+    ok = ok and batch_client.flush() and get_int(memcached_client, key) == 15
+    batch_client.close()
+    log_result("test_set_then_incr", ok)
+
+def test_incr_then_set(memcached_client : CMPooledClient):
+    '''A set of a key that has buffered incrs overwrites the incremented number.'''
+    key = gen_key('incr_then_set')
+    memcached_client.set(key, 0)
+    batch_client = MemcachedBatchClient(memcached_client, max_ops=1000, flush_interval=0)
+    batch_client.incr(key, 3)
+    batch_client.set(key, 100)
+    ok = get_int(memcached_client, key) == 3
+    ok = ok and batch_client.flush() and get_int(memcached_client, key) == 100
+    batch_client.close()
+    log_result("test_incr_then_set", ok)
+
+def test_aggregated_incrs(memcached_client : CMPooledClient):
+    key_list = [gen_key(f'aggr_{i}') for i in range(3)]
+    for key in key_list:
+        memcached_client.set(key, 0)
+    batch_client = MemcachedBatchClient(memcached_client, max_ops=1000, flush_interval=0)
+    for i in range(30):
+        batch_client.incr(key_list[i % 3], i)
+    ok = batch_client.num_ops == 30 and len(batch_client.pending_incrs) == 3
+    ok = ok and all(get_int(memcached_client, key) == 0 for key in key_list)
+    batch_client.close()
+    ok = ok and [get_int(memcached_client, key) for key in key_list] == [sum(range(i, 30, 3)) for i in range(3)]
+    log_result("test_aggregated_incrs", ok)
+
+def test_flush_when_full(memcached_client : CMPooledClient):
+    key_list = [gen_key(f'full_{i}') for i in range(8)]
+    batch_client = MemcachedBatchClient(memcached_client, max_ops=4, flush_interval=0)
+    for i, key in enumerate(key_list[:6]):
+        batch_client.set(key, i)
+    ok = [get_int(memcached_client, key) for key in key_list[:4]] == [0, 1, 2, 3]
+    ok = ok and get_int(memcached_client, key_list[4]) == None and batch_client.num_ops == 2
+    batch_client.close()
+    ok = ok and [get_int(memcached_client, key) for key in key_list[4:6]] == [4, 5]
+    log_result("test_flush_when_full", ok)
+
+def test_periodic_flush(memcached_client : CMPooledClient):
+    key = gen_key('periodic')
+    batch_client = MemcachedBatchClient(memcached_client, max_ops=1000, flush_interval=0.1)
+    batch_client.set(key, 7)
+    time.sleep(0.5)
+    ok = get_int(memcached_client, key) == 7 and batch_client.num_ops == 0
+    batch_client.close()
+    log_result("test_periodic_flush", ok)
+
+def test_add_many(memcached_client : CMPooledClient):
+    key_list = [gen_key(f'add_{i}') for i in range(4)]
+    memcached_client.set(key_list[1], 1)
+    added_map = mc_wrapper.mc_add_many_wrapper(memcached_client, {key : 1 for key in key_list})
+    ok = added_map == {key_list[0] : True, key_list[1] : False, key_list[2] : True, key_list[3] : True}
+    added_map = mc_wrapper.mc_add_many_wrapper(memcached_client, {key : 1 for key in key_list})
+    ok = ok and not any(added_map.values())
+    log_result("test_add_many", ok)
+
+def test_incr_many_not_resent(memcached_client : CMPooledClient):
+    '''An incr_many that raises after sending the incrs is not sent again.'''
+    key = gen_key('not_resent')
+    memcached_client.set(key, 0)
+    num_calls = [0]
+    def incr_then_raise(client, key_num_map):
+        num_calls[0] += 1
+        mc_wrapper._incr_many(client, key_num_map)
+        raise TimeoutError("the connection is lost after sending")
+
+    try:
+        mc_wrapper._mc_many_retry(memcached_client, 'incr_many', incr_then_raise, {key : 1}, idempotent=False)
+        ok = False
+    except MemcachedOPFailed:
+        ok = True
+    ok = ok and num_calls[0] == 1 and get_int(memcached_client, key) == 1
+    log_result("test_incr_many_not_resent", ok)
+
+def main():
+    log.setup_global_logger(stm=sys.stderr, stm_lv=logging.INFO)
+    memcached_client : CMPooledClient = setup_memcached_pooled_client(MC_HOST, MC_PORT)
+
+    test_set_then_incr(memcached_client)
+    test_incr_then_set(memcached_client)
+    test_aggregated_incrs(memcached_client)
+    test_flush_when_full(memcached_client)
+    test_periodic_flush(memcached_client)
+    test_add_many(memcached_client)
+    test_incr_many_not_resent(memcached_client)
+
+    memcached_client.close()
+
+if __name__ == "__main__":
+    main()
@@ -11,8 +11,16 @@ from scripts.vm_mgr.guest_state import GuestState
 import scripts.vm_comm.memcached_wrapper as mc_wrapper
 import scripts.utils.logger as log
 
+MC_FLUSH_TIMEOUT = 5
+
 def handle_uncaught_exception(exc_type, exc_value, exc_traceback):
     """ handle all uncaught exceptions """
+    try:
+        # send the buffered reports before the host sees the state
+        mc_wrapper.mc_flush_deferred(timeout=MC_FLUSH_TIMEOUT)
+    except Exception:
+        pass
+
     if issubclass(exc_type, GuestExceptionToRestartVM):
         if mc_wrapper.glo_mc_pool_client != None and mc_wrapper.glo_vm_id != None:
             key = f'{mc_wrapper.glo_vm_id}.state'
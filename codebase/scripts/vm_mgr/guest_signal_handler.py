@@ -8,10 +8,17 @@ from scripts.vm_comm.heartbeat_guest import stop_heartbeat_service
 import scripts.vm_comm.memcached_wrapper as mc_wrapper
 import scripts.utils.logger as log
 
+MC_FLUSH_TIMEOUT = 5
+
 def signal_handler(signum, frame):
     msg = f"handle signale {signum} {frame} on {mc_wrapper.glo_vm_id}"
     log.global_logger.debug(msg)
     if mc_wrapper.glo_mc_pool_client != None:
+        try:
+            # the signal may interrupt a flush, do not wait for it too long
+            mc_wrapper.mc_flush_deferred(timeout=MC_FLUSH_TIMEOUT)
+        except Exception:
+            pass
         stop_heartbeat_service()
         mc_wrapper.glo_mc_pool_client.close()
 
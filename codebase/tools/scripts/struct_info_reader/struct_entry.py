@@ -1,5 +1,6 @@
 import os
 import sys
+from bisect import bisect_left
 
 codebase_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../.."))
 sys.path.append(codebase_dir)
@@ -73,6 +74,10 @@ class StructInfo:
 
         self.children = []
 
+        # member variables sorted by offset, and their offsets, built on first use
+        self._sorted_vars = None
+        self._sorted_var_offsets = None
+
     def __str__(self) -> str:
         data = "struct %s, %d, %d\n" % (self.struct_name, self.size_bits, self.size_bytes)
         for child in self.children:
@@ -125,6 +130,24 @@ class StructInfo:
 
         child = StructMemberVar(self.struct_name, line)
         self.children.append(child)
+        self._sorted_vars = None
+        self._sorted_var_offsets = None
+
+    def get_sorted_vars(self) -> tuple:
+        '''return (vars, offsets), the member variables are sorted by offset'''
+        if self._sorted_vars == None:
+            self._sorted_vars = sorted(self.children, key = lambda x : x.offset_bytes)
+            self._sorted_var_offsets = [x.offset_bytes for x in self._sorted_vars]
+        return self._sorted_vars, self._sorted_var_offsets
+
+    def get_vars_by_offset(self, begin, end) -> list:
+        '''return the member variables overlapped with [begin, end), sorted by offset'''
+        if begin >= end:
+            return []
+        vars, offsets = self.get_sorted_vars()
+        # the variables start before the end, keep the ones end after the begin
+        return [var for var in vars[:bisect_left(offsets, end)] \
+                if var.size_bytes > 0 and var.offset_bytes + var.size_bytes > begin]
 
     def finalize(self):
         assert self.struct_name != None, "invalid struct info, %s" % (self.__str__())
@@ -13,6 +13,11 @@ class StructInfoReader:
 
         self.__init(fname)
 
+        # struct name : (size in bits, size in bytes) from the layout file,
+        # since the struct index trusts the sizes in the trace
+        self.struct_size_dict = {name : (stinfo.size_bits, stinfo.size_bytes) \
+                                 for name, stinfo in self.struct_dict.items()}
+
         # map a struct name to its father struct name and the offset
         # parent struct name : set of tuple(var's struct (type) name, offset in parent struct)
         self.nested_stname_to_var_stname_dict = dict()
@@ -21,6 +26,12 @@ class StructInfoReader:
         self.nested_var_stname_to_parent_stname_dict = dict()
         self.__init_nested()
 
+    def reset_struct_sizes(self):
+        for name, (size_bits, size_bytes) in self.struct_size_dict.items():
+            stinfo : StructInfo = self.struct_dict[name]
+            stinfo.size_bits = size_bits
+            stinfo.size_bytes = size_bytes
+
     def contains_stname(self, stname):
         return stname in self.struct_dict
 